@@ -2,6 +2,8 @@
 ASGI config for simple_viewer project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are handled by Django through viewer.streaming.StreamingASGIHandler, which streams downloads off the
+event loop. Websockets are routed to the consumers in viewer.routing.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -9,8 +11,20 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'simple_viewer.settings')
 
-application = get_asgi_application()
+# Django must be set up before the consumers (and so the models) are imported, as get_asgi_application() does
+django.setup(set_prefix=False)
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.security.websocket import AllowedHostsOriginValidator  # noqa: E402
+
+from viewer import routing  # noqa: E402
+from viewer.streaming import StreamingASGIHandler  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': StreamingASGIHandler(),
+    'websocket': AllowedHostsOriginValidator(URLRouter(routing.websocket_urlpatterns)),
+})
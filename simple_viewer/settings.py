@@ -32,6 +32,7 @@ ALLOWED_HOSTS = []
 
 INSTALLED_APPS = [
     'viewer.apps.ViewerConfig',
+    'channels',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -42,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that it measures every other middleware too
+    'viewer.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,6 +75,16 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'simple_viewer.wsgi.application'
 
+ASGI_APPLICATION = 'simple_viewer.asgi.application'
+
+# Websocket messages are only passed around inside one server process, events from the workers arrive through the
+# database instead (see viewer.models.DirectoryEvent)
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+    }
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
@@ -80,6 +93,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Directories refreshed in parallel take turns writing, wait for each other rather than failing
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -121,3 +136,121 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Directory listings
+
+# Number of files shown per page, with further pages loaded as the browse page is scrolled
+BROWSE_PAGE_SIZE = 100
+
+# Rendered listings are cached by each process, keyed on when their directory last changed (see views.cached_listing)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    }
+}
+
+# Seconds a rendered listing is cached for, which also bounds how outdated times like "refreshed 5 minutes ago" get
+LISTING_CACHE_TIMEOUT = 5 * 60
+
+
+# Refreshing
+
+# Threads refreshing directories at once in `manage.py refresh_all` and the admin action
+REFRESH_THREADS = 4
+
+# Seconds before a refresh's lease on its directory expires, letting another refresh take over if it died. Refreshes
+# renew their lease while scanning, so it only has to outlast reading a single directory and writing what was found.
+REFRESH_LEASE_TIMEOUT = 60 * 60
+
+# Days the metadata probed from a file is kept for after its last use, see viewer.models.MediaProbe
+PROBE_CACHE_RETENTION = 180
+
+
+# Metrics
+# Timings, query counts and bytes served by each process, see viewer.metrics.
+
+# Record metrics and expose them at /metrics in the Prometheus text format
+METRICS_ENABLED = False
+
+# Add a Server-Timing header with the time and database queries spent on each response, shown by browser devtools
+METRICS_DEBUG_HEADER = False
+
+
+# File serving
+
+# Hand file delivery off to a fronting web server instead of streaming it through Python.
+# None, 'x-sendfile' (Apache mod_xsendfile, lighttpd) or 'x-accel-redirect' (nginx).
+FILE_SENDFILE = None
+
+# For X-Accel-Redirect, the internal nginx location mapped onto the filesystem root, e.g.
+#     location /protected/ { internal; alias /; }
+FILE_ACCEL_REDIRECT_PREFIX = '/protected/'
+
+# Under ASGI, downloads are streamed by viewer.streaming.StreamingASGIHandler, reading each chunk off the event loop.
+# Most files streamed at once, further requests are answered with 503 Service Unavailable
+FILE_STREAM_LIMIT = 500
+
+# Threads reading chunks for every open stream, one chunk at a time
+FILE_STREAM_THREADS = 8
+
+
+# Live updates
+# Open browse pages are sent changes to their directory over a websocket, when served through ASGI.
+
+# Seconds between checks for new directory events, made once per server process however many pages are open
+DIRECTORY_EVENT_POLL_INTERVAL = 1.0
+
+# Seconds directory events are kept for before being pruned
+DIRECTORY_EVENT_RETENTION = 300
+
+# Changes to a directory beyond this many at once are sent as a single event asking pages to reload their listing,
+# rather than file by file
+DIRECTORY_EVENT_LIMIT = 200
+
+
+# Thumbnail worker
+# Thumbnails are generated in the background by `manage.py thumbnail_worker`.
+
+THUMBNAIL_WORKER_PROCESSES = os.cpu_count() or 1
+
+# Files handed to a worker process at once, saving a round trip per file
+THUMBNAIL_BATCH_SIZE = 8
+
+THUMBNAIL_MAX_ATTEMPTS = 5
+
+# Seconds before the first retry of a failed thumbnail, doubled after every further failure
+THUMBNAIL_RETRY_BACKOFF = 30
+
+# Seconds before a running job's lease expires, letting another worker take it over if its worker died. Workers renew
+# the leases of the jobs they hold well before then.
+THUMBNAIL_LEASE_TIMEOUT = 5 * 60
+
+# Bounding box of each thumbnail size in pixels
+THUMBNAIL_SIZES = {'small': 150, 'medium': 300, 'large': 600}
+
+# The size shown in directory listings, which is always generated as a JPEG
+THUMBNAIL_DEFAULT_SIZE = 'medium'
+
+# Formats thumbnails can be served in, in order of preference when negotiated through the Accept header
+THUMBNAIL_FORMATS = ['avif', 'webp', 'jpeg']
+
+# Variants generated by the worker alongside the default JPEG, every other variant is produced on first request
+THUMBNAIL_EAGER_VARIANTS = [('medium', 'webp')]
+
+# Number of frames sampled across each video for its hover preview, 0 to disable previews
+THUMBNAIL_SPRITE_FRAMES = 10
+
+# The thumbnail size each hover preview frame is scaled to
+THUMBNAIL_SPRITE_SIZE = 'small'
+
+# Pillow encoder options for each format, trading CPU time for smaller files
+THUMBNAIL_ENCODING = {
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+    'webp': {'quality': 78, 'method': 4},
+    'avif': {'quality': 60, 'speed': 6},
+}
+
+# Maximum total size of all thumbnails in bytes, beyond which the least recently used are evicted. None for no limit.
+THUMBNAIL_CACHE_BUDGET = 2 * 1024 ** 3
@@ -1,3 +1,19 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-# Register your models here.
+from viewer.models import ServedDirectory
+
+
+@admin.register(ServedDirectory)
+class ServedDirectoryAdmin(admin.ModelAdmin):
+    list_display = ['path', 'recursive', 'regex', 'file_count', 'lastRefreshed']
+    actions = ['refresh_directories']
+
+    def refresh_directories(self, request, queryset):
+        """Refreshes the selected directories several at once, as `manage.py refresh_all` does."""
+        for directory, result, error in ServedDirectory.refresh_many(list(queryset)):
+            if error:
+                self.message_user(request, f'Could not refresh {directory.path}: {error}', messages.ERROR)
+            else:
+                self.message_user(request, f'{directory.path}: {result}', messages.SUCCESS)
+
+    refresh_directories.short_description = 'Refresh selected directories'
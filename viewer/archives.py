@@ -0,0 +1,216 @@
+"""
+archives.py
+
+Contains the writers streaming ZIP and tar archives of many files at once. Archives are generated on the fly while they
+are sent, reading a single chunk at a time, and their exact length is known before the first byte.
+"""
+import os
+import struct
+import tarfile
+import time
+import zlib
+from typing import Iterable, Iterator, List, NamedTuple, Tuple
+
+from viewer.serving import CHUNK_SIZE
+
+# Sizes, offsets and counts at or beyond these need the ZIP64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+
+# The CRC-32 follows the data in a data descriptor, and names are UTF-8
+ZIP_FLAGS = 0x08 | 0x800
+ZIP_STORED = 0
+ZIP_VERSION, ZIP64_VERSION = 20, 45
+# Entries are marked as regular files created on Unix, readable by everyone
+ZIP_CREATE_SYSTEM = 3
+ZIP_EXTERNAL_ATTRIBUTES = 0o100644 << 16
+
+
+class ArchiveEntry(NamedTuple):
+    """A file to be archived, stat-ed up front so that the length of the archive is known before it is sent."""
+    name: str
+    path: str
+    size: int
+    mtime: float
+
+
+def get_entries(files: Iterable[Tuple[str, str]]) -> List[ArchiveEntry]:
+    """
+    Stats every file to be archived, skipping any that have gone missing since they were indexed.
+
+    :param files: The name within the archive and the absolute path of each file.
+    """
+    entries = []
+    for name, path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append(ArchiveEntry(name, path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def read_entry(entry: ArchiveEntry) -> Iterator[bytes]:
+    """
+    Reads exactly as many bytes of a file as it had when it was stat-ed, which the archive's length depends on.
+
+    :raises OSError: If the file has shrunk since, which would leave the archive corrupt.
+    """
+    with open(entry.path, 'rb') as file:
+        remaining = entry.size
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise OSError(f'{entry.path} was truncated while it was being archived')
+            remaining -= len(chunk)
+            yield chunk
+
+
+def dos_datetime(mtime: float) -> Tuple[int, int]:
+    """The modification time of a ZIP entry as its MS-DOS (time, date), which can only hold the years 1980 to 2107."""
+    year, month, day, hour, minute, second, *_ = time.localtime(mtime)
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    elif year > 2107:
+        year, month, day, hour, minute, second = 2107, 12, 31, 23, 59, 58
+    return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+
+
+class ZipStream:
+    """
+    A ZIP archive of stored (uncompressed) entries. Media is already compressed, and storing it keeps the size of every
+    entry, and so the length of the whole archive, known up front so that downloads can show their progress.
+
+    The CRC-32 of each entry is only known once it has been read, so it is sent after the data in a data descriptor,
+    and again in the central directory which every reader relies on. ZIP64 extensions are added to whichever entries,
+    offsets and counts exceed the limits of the original format, so archives of any size can be streamed.
+    """
+
+    content_type = 'application/zip'
+    extension = 'zip'
+
+    def __init__(self, entries: List[ArchiveEntry]):
+        self.entries = entries
+        # The offset of every entry's local header, and where the central directory will start
+        self.offsets, offset = [], 0
+        for entry in entries:
+            self.offsets.append(offset)
+            offset += len(self.local_header(entry)) + entry.size + len(self.data_descriptor(entry, 0))
+        self.directory_offset = offset
+        self.directory_size = sum(len(self.central_header(entry, offset, 0))
+                                  for entry, offset in zip(entries, self.offsets))
+        self.length = offset + self.directory_size + len(self.end_of_directory())
+
+    @staticmethod
+    def encode_name(entry: ArchiveEntry) -> bytes:
+        return entry.name.encode('utf-8', 'surrogateescape')
+
+    @classmethod
+    def local_header(cls, entry: ArchiveEntry) -> bytes:
+        name = cls.encode_name(entry)
+        modified_time, modified_date = dos_datetime(entry.mtime)
+        if entry.size >= ZIP64_LIMIT:
+            # The actual sizes follow in the data descriptor, the extra field only marks the entry as ZIP64
+            version, size, extra = ZIP64_VERSION, ZIP64_LIMIT, struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        else:
+            version, size, extra = ZIP_VERSION, 0, b''
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, ZIP_FLAGS, ZIP_STORED, modified_time,
+                           modified_date, 0, size, size, len(name), len(extra)) + name + extra
+
+    @staticmethod
+    def data_descriptor(entry: ArchiveEntry, crc: int) -> bytes:
+        if entry.size >= ZIP64_LIMIT:
+            return struct.pack('<IIQQ', 0x08074b50, crc, entry.size, entry.size)
+        return struct.pack('<IIII', 0x08074b50, crc, entry.size, entry.size)
+
+    @classmethod
+    def central_header(cls, entry: ArchiveEntry, offset: int, crc: int) -> bytes:
+        name = cls.encode_name(entry)
+        modified_time, modified_date = dos_datetime(entry.mtime)
+        extra = b''
+        if entry.size >= ZIP64_LIMIT:
+            extra += struct.pack('<QQ', entry.size, entry.size)
+        if offset >= ZIP64_LIMIT:
+            extra += struct.pack('<Q', offset)
+        version = ZIP64_VERSION if extra else ZIP_VERSION
+        if extra:
+            extra = struct.pack('<HH', 0x0001, len(extra)) + extra
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, ZIP_CREATE_SYSTEM << 8 | version, version, ZIP_FLAGS,
+                           ZIP_STORED, modified_time, modified_date, crc, min(entry.size, ZIP64_LIMIT),
+                           min(entry.size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0, ZIP_EXTERNAL_ATTRIBUTES,
+                           min(offset, ZIP64_LIMIT)) + name + extra
+
+    def end_of_directory(self) -> bytes:
+        count, size, offset = len(self.entries), self.directory_size, self.directory_offset
+        end = b''
+        if count >= ZIP_COUNT_LIMIT or size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT:
+            # The ZIP64 end of central directory record, followed by the locator pointing back at it
+            end = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, ZIP_CREATE_SYSTEM << 8 | ZIP64_VERSION, ZIP64_VERSION,
+                              0, 0, count, count, size, offset)
+            end += struct.pack('<IIQI', 0x07064b50, 0, offset + size, 1)
+        return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP_COUNT_LIMIT),
+                                 min(count, ZIP_COUNT_LIMIT), min(size, ZIP64_LIMIT), min(offset, ZIP64_LIMIT), 0)
+
+    def __iter__(self) -> Iterator[bytes]:
+        crcs = []
+        for entry in self.entries:
+            yield self.local_header(entry)
+            crc = 0
+            for chunk in read_entry(entry):
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            yield self.data_descriptor(entry, crc)
+            crcs.append(crc)
+
+        # Central directory headers are small, so they are sent in batches rather than one at a time
+        batch = []
+        for entry, offset, crc in zip(self.entries, self.offsets, crcs):
+            batch.append(self.central_header(entry, offset, crc))
+            if len(batch) >= 500:
+                yield b''.join(batch)
+                batch = []
+        yield b''.join(batch) + self.end_of_directory()
+
+
+class TarStream:
+    """
+    A POSIX tar archive, using pax headers only for the entries whose names or sizes do not fit a plain ustar header.
+    """
+
+    content_type = 'application/x-tar'
+    extension = 'tar'
+
+    def __init__(self, entries: List[ArchiveEntry]):
+        self.entries = entries
+        length = sum(len(self.header(entry)) + entry.size + self.padding(entry.size) for entry in entries)
+        # The archive ends with two empty blocks, and is padded to a whole record as tarfile does
+        self.length = length + self.end_padding(length)
+
+    @staticmethod
+    def header(entry: ArchiveEntry) -> bytes:
+        info = tarfile.TarInfo(entry.name)
+        info.size, info.mtime, info.mode = entry.size, int(entry.mtime), 0o644
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+    @staticmethod
+    def padding(size: int) -> int:
+        return -size % tarfile.BLOCKSIZE
+
+    @staticmethod
+    def end_padding(length: int) -> int:
+        return 2 * tarfile.BLOCKSIZE + -(length + 2 * tarfile.BLOCKSIZE) % tarfile.RECORDSIZE
+
+    def __iter__(self) -> Iterator[bytes]:
+        length = 0
+        for entry in self.entries:
+            header = self.header(entry)
+            yield header
+            yield from read_entry(entry)
+            padding = self.padding(entry.size)
+            if padding:
+                yield bytes(padding)
+            length += len(header) + entry.size + padding
+        yield bytes(self.end_padding(length))
+
+
+FORMATS = {'zip': ZipStream, 'tar': TarStream}
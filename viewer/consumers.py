@@ -0,0 +1,166 @@
+"""
+consumers.py
+
+Contains the websocket consumer pushing live changes to open browse pages, and the relay feeding it from the
+DirectoryEvent table.
+"""
+import asyncio
+import json
+import logging
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from viewer import helpers
+from viewer.models import DirectoryEvent, ServedDirectory, ThumbnailJob
+
+logger = logging.getLogger(__name__)
+
+
+def group_name(directory_id: uuid.UUID) -> str:
+    """The channel layer group every consumer watching a directory belongs to."""
+    return f'directory-{directory_id}'
+
+
+class DirectoryConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Sends every change to a directory's listing to a single browse page, along with the thumbnail job counts.
+
+    Messages are JSON objects with `files` (serialized Files added or changed), `removed` (ids of removed Files),
+    `file_count` and `thumbnails` (see `ThumbnailJob.status_counts`). The first message only holds the job counts.
+    When too many files changed at once, `reload` is set in place of `files` and `removed`, and the page is expected to
+    load its listing again.
+    """
+
+    async def connect(self):
+        self.directory_id = self.scope['url_route']['kwargs']['directory_id']
+        counts = await database_sync_to_async(self.get_status_counts)()
+        if counts is None:
+            await self.close()
+            return
+
+        self.group = group_name(self.directory_id)
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+        relay.subscribe()
+        await self.send_json({'thumbnails': counts})
+
+    async def disconnect(self, code):
+        if hasattr(self, 'group'):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+            relay.unsubscribe()
+
+    async def directory_changes(self, event):
+        await self.send(text_data=event['text'])
+
+    @classmethod
+    async def encode_json(cls, content) -> str:
+        return json.dumps(content, cls=DjangoJSONEncoder)
+
+    def get_status_counts(self) -> Optional[Dict[str, int]]:
+        directory = ServedDirectory.objects.filter(id=self.directory_id).first()
+        return ThumbnailJob.status_counts(directory) if directory else None
+
+
+class EventRelay:
+    """
+    Polls the DirectoryEvent table and broadcasts the changes to the consumers of each directory.
+
+    A single relay runs per server process while any consumer is connected, so the database is polled at the same rate
+    however many pages are open, and each message is only encoded once before being fanned out to every page.
+    """
+
+    def __init__(self):
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> None:
+        self.subscribers += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def unsubscribe(self) -> None:
+        self.subscribers -= 1
+
+    async def run(self) -> None:
+        channel_layer = get_channel_layer()
+        # Only events written after the first page connected are sent
+        last_id = await database_sync_to_async(self.get_last_id)()
+        while self.subscribers > 0:
+            await asyncio.sleep(settings.DIRECTORY_EVENT_POLL_INTERVAL)
+            try:
+                last_id, changes = await database_sync_to_async(self.collect)(last_id)
+            except Exception:
+                logger.exception('Could not collect directory events')
+                continue
+
+            for directory_id, message in changes.items():
+                await channel_layer.group_send(group_name(directory_id), {
+                    'type': 'directory.changes',
+                    'text': json.dumps(message, cls=DjangoJSONEncoder)
+                })
+
+    @staticmethod
+    def get_last_id() -> int:
+        event = DirectoryEvent.objects.order_by('-id').only('id').first()
+        return event.id if event else 0
+
+    @staticmethod
+    def collect(last_id: int) -> Tuple[int, Dict[uuid.UUID, dict]]:
+        """
+        Gathers every event since the last one seen into a single message per directory. Directories with more than
+        DIRECTORY_EVENT_LIMIT changes between them are sent a reload instead, keeping every message small.
+
+        :return: The id of the newest event seen, and the message for each directory with any events.
+        """
+        changed: Dict[uuid.UUID, set] = defaultdict(set)
+        removed: Dict[uuid.UUID, List[int]] = defaultdict(list)
+        reload = set()
+        for event_id, directory_id, kind, relative_path, file_id in DirectoryEvent.objects.filter(id__gt=last_id) \
+                .order_by('id').values_list('id', 'directory_id', 'kind', 'relative_path', 'file_id').iterator():
+            last_id = event_id
+            if directory_id in reload:
+                continue
+            if kind == DirectoryEvent.CHANGED:
+                changed[directory_id].add(relative_path)
+            elif kind == DirectoryEvent.REMOVED:
+                removed[directory_id].append(file_id)
+            if kind == DirectoryEvent.RELOAD or \
+                    len(changed[directory_id]) + len(removed[directory_id]) > settings.DIRECTORY_EVENT_LIMIT:
+                reload.add(directory_id)
+                changed.pop(directory_id, None)
+                removed.pop(directory_id, None)
+
+        messages = {}
+        for directory_id in changed.keys() | removed.keys() | reload:
+            directory = ServedDirectory.objects.filter(id=directory_id).first()
+            if directory is None:
+                continue
+            if directory_id in reload:
+                messages[directory_id] = {
+                    'reload': True,
+                    'file_count': directory.file_count,
+                    'thumbnails': ThumbnailJob.status_counts(directory)
+                }
+                continue
+
+            files = []
+            for chunk in helpers.chunked(list(changed[directory_id]), 500):
+                files.extend(file.serialize() for file in directory.files.filter(relative_path__in=chunk)
+                             .select_related('thumbnail'))
+            messages[directory_id] = {
+                'files': files,
+                'removed': removed[directory_id],
+                'file_count': directory.file_count,
+                'thumbnails': ThumbnailJob.status_counts(directory)
+            }
+        return last_id, messages
+
+
+relay = EventRelay()
@@ -3,38 +3,336 @@ helpers.py
 
 Contains helper functions used as refactored shortcuts or in order to separate code for readability.
 """
-from typing import Tuple
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import cv2
-from PIL import Image
+import numpy
+from PIL import Image, UnidentifiedImageError
 
 
-def generate_thumbnail(path: str, output_path: str) -> None:
+# Pillow format names for each thumbnail file extension
+IMAGE_FORMATS = {'jpeg': 'JPEG', 'webp': 'WEBP', 'avif': 'AVIF'}
+
+# How much larger than a thumbnail an image is decoded or reduced to before the final resample, see `Image.thumbnail`
+THUMBNAIL_REDUCING_GAP = 2.0
+
+# Image formats (as named by Pillow) which OpenCV can decode at a reduced scale, and the flags for each scale
+OPENCV_REDUCED_FORMATS = {'PNG', 'TIFF', 'WEBP', 'BMP', 'PPM'}
+OPENCV_REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+class MediaInfo(NamedTuple):
+    """The metadata read from a single image or video."""
+
+    width: int
+    height: int
+    duration: Optional[float] = None
+    frame_count: Optional[int] = None
+    codec: Optional[str] = None
+
+    @property
+    def resolution(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+
+def probe(path: str, thumbnail_size: Optional[Tuple[int, int]] = None, samples: int = 0,
+          sample_size: Optional[Tuple[int, int]] = None) -> Tuple[MediaInfo, Optional[Image.Image], List[Image.Image]]:
     """
-    Helper function which completes the process of generating thumbnails for both pictures and videos.
+    Reads the metadata of an image or video, and optionally a thumbnail frame, while opening the file only once.
+
+    Images are read through Pillow, which only parses the header until pixel data is actually needed and can decode
+    JPEGs at a reduced scale. Everything else (and any image Pillow cannot identify) is opened with OpenCV.
 
     :param path: The absolute path to the file.
-    :param output_path: The absolute path to the intended output thumbnail file.
+    :param thumbnail_size: The bounding box of the thumbnail to produce, or None to skip decoding entirely.
+    :param samples: The number of frames to sample evenly across a video, for hover previews.
+    :param sample_size: The bounding box of each sampled frame.
+    :return: The file's metadata, the RGB thumbnail image (if one was requested and a frame could be read) and the
+             sampled frames, which are only ever taken from videos.
     """
-    file = cv2.VideoCapture(path)
-    success, image = file.read()
-    if success:
-        img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        im_pil = Image.fromarray(img)
+    mimetype = mimetypes.guess_type(path)[0]
+    if mimetype is not None and mimetype.startswith('image'):
+        try:
+            return probe_image(path, thumbnail_size)
+        except UnidentifiedImageError:
+            pass
+    return probe_video(path, thumbnail_size, samples, sample_size)
 
-        # Resize, crop, thumbnail
-        im_pil.thumbnail((300, 300))
-        # im_pil.crop((0, 0, 200, 66))
-        # im_pil.resize((200, 66))
 
-        im_pil.save(output_path)
+def probe_image(path: str, thumbnail_size: Optional[Tuple[int, int]] = None) \
+        -> Tuple[MediaInfo, Optional[Image.Image], List[Image.Image]]:
+    """
+    Probes an image with Pillow, see `probe`.
+
+    The header is enough for the metadata. For the thumbnail, JPEGs are decoded by Pillow at up to 1/8 scale (see
+    `Image.draft`). Large images in other formats are decoded by OpenCV at 1/2, 1/4 or 1/8 scale straight into 8 bit
+    BGR, which needs far less memory than Pillow decoding them in full, and anything else is left to Pillow. Only the
+    thumbnail is ever converted to RGB, except for images in modes other than RGB or greyscale, which are converted
+    before resizing (dropping any alpha channel) as resizing RGBA would take another full size premultiplied copy.
+    """
+    with Image.open(path) as image:
+        info = MediaInfo(*image.size, codec=image.format)
+        if thumbnail_size is None:
+            return info, None, []
+
+        factor = get_reduction(image.size, thumbnail_size)
+        if factor > 1 and image.format in OPENCV_REDUCED_FORMATS:
+            frame = cv2.imread(path, OPENCV_REDUCED_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION)
+            if frame is not None:
+                return info, frame_to_image(frame, thumbnail_size), []
+
+        gap = THUMBNAIL_REDUCING_GAP
+        image.draft('RGB', (int(thumbnail_size[0] * gap), int(thumbnail_size[1] * gap)))
+        if image.mode in ('RGB', 'L'):
+            image.thumbnail(thumbnail_size, reducing_gap=gap)
+            # Detached from the file, which is closed on leaving this block
+            thumbnail = image.copy()
+        else:
+            thumbnail = image.convert('RGB')
+            image.close()
+            thumbnail.thumbnail(thumbnail_size, reducing_gap=gap)
+    return info, thumbnail, []
 
 
-def get_resolution(path: str) -> Tuple[int, int]:
+def get_reduction(size: Tuple[int, int], thumbnail_size: Tuple[int, int]) -> int:
     """
-    Retrieves the resolution of a image or video
+    The largest factor (1, 2, 4 or 8) an image can be scaled down by while decoding, while staying at least
+    THUMBNAIL_REDUCING_GAP times larger than its thumbnail.
+    """
+    scale = min(thumbnail_size[0] / size[0], thumbnail_size[1] / size[1], 1)
+    for factor in (8, 4, 2):
+        if factor * scale * THUMBNAIL_REDUCING_GAP <= 1:
+            return factor
+    return 1
+
 
-    :return: A tuple containing two positive integers representing width and height
+def probe_video(path: str, thumbnail_size: Optional[Tuple[int, int]] = None, samples: int = 0,
+                sample_size: Optional[Tuple[int, int]] = None) \
+        -> Tuple[MediaInfo, Optional[Image.Image], List[Image.Image]]:
     """
-    file = cv2.VideoCapture(path)
-    return file.get(cv2.CAP_PROP_FRAME_WIDTH), file.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    Probes a video (or anything else OpenCV can open) with a single capture, see `probe`.
+    Frames are sampled by seeking to the middle of each of `samples` equal segments, rather than decoding the whole
+    video, and are skipped entirely if the frame count is unknown.
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            return MediaInfo(0, 0), None, []
+
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+        codec = fourcc.to_bytes(4, 'little').decode('ascii', 'replace').strip('\0 ') if fourcc > 0 else None
+        info = MediaInfo(
+            width=int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            height=int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            duration=frame_count / fps if fps > 0 and frame_count > 0 else None,
+            frame_count=frame_count if frame_count > 0 else None,
+            codec=codec or None
+        )
+
+        thumbnail = None
+        if thumbnail_size is not None:
+            success, frame = capture.read()
+            if success:
+                thumbnail = frame_to_image(frame, thumbnail_size)
+
+        sampled = []
+        if samples and info.frame_count and info.frame_count >= samples:
+            for i in range(samples):
+                capture.set(cv2.CAP_PROP_POS_FRAMES, int((i + 0.5) * info.frame_count / samples))
+                success, frame = capture.read()
+                if not success:
+                    break
+                sampled.append(frame_to_image(frame, sample_size))
+        return info, thumbnail, sampled
+    finally:
+        capture.release()
+
+
+def frame_to_image(frame: numpy.ndarray, size: Tuple[int, int]) -> Image.Image:
+    """
+    Scales a BGR frame decoded by OpenCV down to fit within `size`, and only then hands it to Pillow as RGB.
+    Shrinking first means the colour conversion and copy into Pillow only ever touch a thumbnail's worth of pixels.
+    """
+    height, width = frame.shape[:2]
+    scale = min(size[0] / width, size[1] / height)
+    if scale < 1:
+        frame = cv2.resize(frame, (max(round(width * scale), 1), max(round(height * scale), 1)),
+                           interpolation=cv2.INTER_AREA)
+    # Read with Pillow's BGR raw mode, rather than converting into yet another array first
+    return Image.frombuffer('RGB', (frame.shape[1], frame.shape[0]), numpy.ascontiguousarray(frame), 'raw', 'BGR',
+                            0, 1)
+
+
+def supported_formats() -> List[str]:
+    """The thumbnail formats (see IMAGE_FORMATS) the installed Pillow is able to encode."""
+    Image.init()
+    return [extension for extension, name in IMAGE_FORMATS.items() if name in Image.SAVE]
+
+
+def save_thumbnail(image: Image.Image, output_path: str, extension: str, options: Dict[str, dict]) -> int:
+    """
+    Encodes a thumbnail, replacing any existing file atomically so it is never served half written.
+
+    :param extension: The thumbnail format, one of IMAGE_FORMATS.
+    :param options: Pillow encoder options for each format, e.g. {'jpeg': {'quality': 80}}.
+    :return: The size of the written file in bytes.
+    """
+    temporary_path = f'{output_path}.{os.getpid()}.tmp'
+    image.save(temporary_path, IMAGE_FORMATS[extension], **options.get(extension, {}))
+    os.replace(temporary_path, output_path)
+    return os.path.getsize(output_path)
+
+
+def create_thumbnail(path: str, outputs: Sequence[Tuple[str, int, str]], options: Dict[str, dict],
+                     sprite: Optional[Tuple[str, int, int]] = None) \
+        -> Tuple[MediaInfo, List[Tuple[int, int]], int, int]:
+    """
+    Generates every requested thumbnail size and format from a single decoded frame, reading the file's metadata from
+    the same probe. Smaller sizes are scaled down from the next larger one rather than the full frame.
+    For videos, a sprite sheet of frames sampled across the video can be produced from the same capture.
+    Meant to be run inside a worker process, so it only deals with paths and never touches the database.
+
+    :param path: The absolute path to the file.
+    :param outputs: The output path, bounding box size and format (see IMAGE_FORMATS) of each thumbnail.
+    :param options: Pillow encoder options for each format.
+    :param sprite: The output path, number of frames and bounding box of each frame for the sprite sheet, if wanted.
+    :return: The metadata of the original file, the resolution of each thumbnail (in the order given), the total
+             number of bytes written and the number of frames in the sprite sheet (0 if none was made).
+    :raises ValueError: If no frame could be read from the file.
+    """
+    largest = max(box for _, box, _ in outputs)
+    sprite_path, samples, sample_box = sprite or (None, 0, None)
+    info, image, sampled = probe(path, (largest, largest), samples,
+                                 (sample_box, sample_box) if sample_box else None)
+    if image is None:
+        raise ValueError(f'No frame could be read from {path}')
+
+    resolutions, written = {}, 0
+    for index in sorted(range(len(outputs)), key=lambda i: outputs[i][1], reverse=True):
+        output_path, box, extension = outputs[index]
+        if max(image.size) > box:
+            image = image.copy()
+            image.thumbnail((box, box))
+        written += save_thumbnail(image, output_path, extension, options)
+        resolutions[index] = image.size
+
+    if sampled:
+        written += save_thumbnail(make_sprite(sampled), sprite_path, 'jpeg', options)
+    return info, [resolutions[i] for i in range(len(outputs))], written, len(sampled)
+
+
+def create_thumbnails(tasks: Sequence[Tuple[str, Sequence[Tuple[str, int, str]], Optional[Tuple[str, int, int]]]],
+                      options: Dict[str, dict]) -> List[Union[Tuple[MediaInfo, List[Tuple[int, int]], int, int],
+                                                              Exception]]:
+    """
+    Runs `create_thumbnail` for a batch of files in a row, so that a worker process is handed several files per round
+    trip rather than one. A file that fails does not stop the rest of the batch.
+
+    :param tasks: The path, outputs and sprite (see `create_thumbnail`) of each file.
+    :param options: Pillow encoder options for each format.
+    :return: The result of each file in the order given, or the exception it raised.
+    """
+    results = []
+    for path, outputs, sprite in tasks:
+        try:
+            results.append(create_thumbnail(path, outputs, options, sprite))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def make_sprite(frames: Sequence[Image.Image]) -> Image.Image:
+    """Lays out equally sized frames left to right in a single image."""
+    width, height = frames[0].size
+    sprite = Image.new('RGB', (width * len(frames), height))
+    for i, frame in enumerate(frames):
+        sprite.paste(frame, (i * width, 0))
+    return sprite
+
+
+def resize_thumbnail(path: str, output_path: str, box: int, extension: str, options: Dict[str, dict]) \
+        -> Tuple[Tuple[int, int], int]:
+    """
+    Produces a smaller thumbnail (or another format) from an existing one, without going back to the source file.
+
+    :return: The resolution of the new thumbnail and its size in bytes.
+    """
+    with Image.open(path) as image:
+        image.draft('RGB', (box, box))
+        image = image.convert('RGB')
+    image.thumbnail((box, box))
+    return image.size, save_thumbnail(image, output_path, extension, options)
+
+
+def file_identity(stat: os.stat_result) -> str:
+    """
+    A key identifying a file's exact content without reading it, derived from its device, inode, size and modification
+    time. The same file reached through different paths has the same identity, and any modification changes it.
+    """
+    identity = f'{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def chunked(items: Sequence, size: int) -> Iterator[List]:
+    """
+    Splits a sequence into lists of at most `size` items, keeping queries under SQLite's bound parameter limit.
+
+    :param items: The sequence to be split.
+    :param size: The maximum size of each chunk.
+    """
+    for i in range(0, len(items), size):
+        yield list(items[i:i + size])
+
+
+class FileFilter:
+    """
+    Decides which files in a directory should be indexed, compiled once so it can be applied to every directory entry
+    before any stat or database work happens.
+
+    Include and exclude patterns are each combined into a single alternation, and an extension allowlist is checked
+    with a simple set lookup, so the common case of filtering by extension never touches a regular expression.
+    """
+
+    def __init__(self, include: Iterable[str] = (), exclude: Iterable[str] = (), extensions: Iterable[str] = (),
+                 match_filename: bool = True):
+        """
+        :param include: RegEx patterns, at least one of which must match for a file to be kept.
+        :param exclude: RegEx patterns, none of which may match for a file to be kept.
+        :param extensions: File extensions (with or without the leading dot) to allow. Any extension if empty.
+        :param match_filename: Match patterns against just the filename instead of the full path.
+        :raises re.error: If any of the patterns are invalid.
+        """
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+        self.extensions = {f'.{extension.lower().lstrip(".")}' for extension in extensions if extension}
+        self.match_filename = match_filename
+
+    @staticmethod
+    def compile(patterns: Iterable[str]) -> Optional[re.Pattern]:
+        """Compiles a list of patterns into one, or None if there are no patterns at all."""
+        patterns = [pattern for pattern in patterns if pattern]
+        if not patterns:
+            return None
+        return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+    def matches(self, filename: str, path: str) -> bool:
+        """
+        :param filename: The name of the file.
+        :param path: The full path to the file.
+        :return: True if the file should be indexed.
+        """
+        if self.extensions and os.path.splitext(filename)[1].lower() not in self.extensions:
+            return False
+        if self.include is None and self.exclude is None:
+            return True
+
+        subject = filename if self.match_filename else path
+        if self.include is not None and self.include.search(subject) is None:
+            return False
+        return self.exclude is None or self.exclude.search(subject) is None
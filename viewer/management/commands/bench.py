@@ -0,0 +1,316 @@
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import django
+import humanize
+import numpy
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.utils import timezone
+from PIL import Image
+
+from viewer import helpers
+from viewer.models import File, ServedDirectory
+
+BENCHMARKS = ['refresh', 'thumbnails', 'browse', 'file']
+
+# Colours the generated media is made of
+PALETTE = [(200, 40, 40), (40, 160, 60), (40, 60, 200), (220, 200, 60), (120, 60, 160), (30, 30, 30),
+           (240, 240, 240), (90, 160, 200)]
+
+
+def generate_image(path: str, rng: random.Random, size: int) -> None:
+    """An image of random blocks, so that it does not compress down to nothing, in the format of its extension."""
+    blocks = numpy.array([[rng.choice(PALETTE) for _ in range(8)] for _ in range(8)], dtype=numpy.uint8)
+    Image.fromarray(blocks).resize((size, size * 3 // 4), Image.NEAREST).save(path, quality=85)
+
+
+def generate_video(path: str, rng: random.Random, size: int, frames: int) -> None:
+    """A short Motion JPEG video of a square moving across a random background, written with OpenCV."""
+    width, height = size, size * 3 // 4
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (width, height))
+    try:
+        background = numpy.full((height, width, 3), rng.choice(PALETTE), dtype=numpy.uint8)
+        for i in range(frames):
+            frame = background.copy()
+            x = i * (width - height // 4) // max(frames - 1, 1)
+            frame[height // 3:height // 3 + height // 4, x:x + height // 4] = (255, 255, 255)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+
+def create_thumbnails(tasks, options) -> Tuple[int, int]:
+    """
+    Runs a batch through `helpers.create_thumbnails` in a worker process, as the thumbnail worker does.
+
+    :return: The bytes written, and the peak resident memory of the process so far in bytes.
+    """
+    written = 0
+    for result in helpers.create_thumbnails(tasks, options):
+        if isinstance(result, Exception):
+            raise result
+        written += result[2]
+    # Linux reports the high water mark in kilobytes, macOS in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return written, peak if platform.system() == 'Darwin' else peak * 1024
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks refreshing, thumbnailing, browsing and file serving against a synthetic media tree of tiny ' \
+           'generated images and videos, and prints the results as JSON so that commits can be compared.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=500,
+                            help='Images in the synthetic tree.')
+        parser.add_argument('--videos', type=int, default=20,
+                            help='Videos in the synthetic tree.')
+        parser.add_argument('--directories', type=int, default=20,
+                            help='Subdirectories the media is spread over, nested two levels deep.')
+        parser.add_argument('--media-size', type=int, default=640,
+                            help='Width in pixels of the generated media.')
+        parser.add_argument('--large-images', type=int, default=4,
+                            help='Large JPEG and PNG images in the tree, showing the memory needed to decode them.')
+        parser.add_argument('--large-size', type=int, default=6000,
+                            help='Width in pixels of the large images.')
+        parser.add_argument('--browse-sizes', default='1000,10000,100000',
+                            help='Comma separated numbers of Files in the directories whose listing is rendered.')
+        parser.add_argument('--processes', type=int, default=settings.THUMBNAIL_WORKER_PROCESSES,
+                            help='Processes generating thumbnails at once, compared against a single process.')
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_BATCH_SIZE,
+                            help='Files handed to a thumbnail process at once.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Times each request is timed.')
+        parser.add_argument('--only', action='append', choices=BENCHMARKS,
+                            help='Run only the given benchmark, may be given several times.')
+        parser.add_argument('--output',
+                            help='Write the JSON results to this file instead of standard output.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the generated tree, the same seed always generates the same tree.')
+
+    def handle(self, *args, **options):
+        try:
+            browse_sizes = [int(size) for size in options['browse_sizes'].split(',') if size]
+        except ValueError:
+            raise CommandError(f'Invalid --browse-sizes: {options["browse_sizes"]!r}')
+        benchmarks = options['only'] or BENCHMARKS
+        results = {
+            'commit': self.get_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1],
+            'cpus': os.cpu_count(),
+            'options': {key: options[key] for key in ('images', 'videos', 'directories', 'media_size', 'large_images',
+                                                      'large_size', 'processes', 'batch_size', 'repeat', 'seed')},
+            'results': {},
+        }
+
+        with tempfile.TemporaryDirectory(prefix='simple-viewer-bench-') as root:
+            tree = os.path.join(root, 'tree')
+            start = time.perf_counter()
+            media = self.generate_tree(tree, options)
+            self.log(f'Generated {len(media)} files ({humanize.naturalsize(self.tree_size(media))}) in '
+                     f'{time.perf_counter() - start:.1f}s')
+
+            if 'refresh' in benchmarks:
+                results['results']['refresh'] = self.bench_refresh(tree)
+            if 'thumbnails' in benchmarks:
+                results['results']['thumbnails'] = self.bench_thumbnails(media, os.path.join(root, 'thumbnails'),
+                                                                         options['processes'], options['batch_size'])
+            if 'browse' in benchmarks:
+                results['results']['browse'] = self.bench_browse(root, browse_sizes, options['repeat'])
+            if 'file' in benchmarks:
+                results['results']['file'] = self.bench_file(tree, media, options['repeat'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+            self.log(f'Results written to {options["output"]}')
+        else:
+            self.stdout.write(output)
+
+    def log(self, message: str) -> None:
+        # Progress goes to stderr, keeping stdout for the JSON results
+        self.stderr.write(message)
+
+    @staticmethod
+    def get_commit() -> str:
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+
+    @staticmethod
+    def generate_tree(root: str, options) -> List[str]:
+        """Writes the synthetic images and videos, spread over nested subdirectories, returning their paths."""
+        rng = random.Random(options['seed'])
+        directories = [root] + [os.path.join(root, f'group{i % 5}', f'album{i:03d}')
+                                for i in range(options['directories'])]
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+
+        paths = []
+        for i in range(options['images']):
+            path = os.path.join(rng.choice(directories), f'IMG_{i:05d}.jpg')
+            generate_image(path, rng, options['media_size'])
+            paths.append(path)
+        for i in range(options['videos']):
+            path = os.path.join(rng.choice(directories), f'VID_{i:05d}.avi')
+            generate_video(path, rng, options['media_size'], 30)
+            paths.append(path)
+        for i in range(options['large_images']):
+            extension = ('jpg', 'png')[i % 2]
+            path = os.path.join(root, f'LARGE_{i:03d}.{extension}')
+            generate_image(path, rng, options['large_size'])
+            paths.append(path)
+        return paths
+
+    @staticmethod
+    def tree_size(paths: List[str]) -> int:
+        return sum(os.path.getsize(path) for path in paths)
+
+    def bench_refresh(self, tree: str) -> Dict[str, float]:
+        """Times the first refresh of the tree, a refresh with nothing changed, and a full rescan."""
+        directory = ServedDirectory.objects.create(path=tree, recursive=True)
+        try:
+            timings = {}
+            for name, full in (('cold', False), ('warm', False), ('warm_full', True)):
+                start = time.perf_counter()
+                result = directory.refresh(full)
+                timings[f'{name}_seconds'] = time.perf_counter() - start
+                self.log(f'Refresh {name}: {result}')
+            timings['files'] = directory.files.count()
+            return timings
+        finally:
+            self.remove(directory)
+
+    def bench_thumbnails(self, media: List[str], output: str, processes: int, batch_size: int) -> Dict[str, dict]:
+        """
+        Generates the thumbnails of every file as the thumbnail worker does, in batches, with one process and then
+        with several, writing them outside of the thumbnail store. Along with the throughput, the highest peak memory
+        of any of the processes is reported, which decides how many processes a machine can afford.
+        """
+        os.makedirs(output, exist_ok=True)
+        tasks = [(path, self.outputs(output, i), None) for i, path in enumerate(media)]
+        results = {}
+        for count in sorted({1, processes}):
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=count) as pool:
+                futures = [pool.submit(create_thumbnails, batch, settings.THUMBNAIL_ENCODING)
+                           for batch in helpers.chunked(tasks, max(batch_size, 1))]
+                written, peaks = zip(*(future.result() for future in futures))
+            elapsed = time.perf_counter() - start
+            results[f'{count}_processes'] = {
+                'seconds': elapsed,
+                'files_per_second': len(media) / elapsed,
+                'files_per_second_per_process': len(media) / elapsed / count,
+                'bytes_written': sum(written),
+                'peak_memory_bytes': max(peaks),
+            }
+            self.log(f'Thumbnails with {count} processes: {len(media) / elapsed:,.1f} files/s '
+                     f'({len(media) / elapsed / count:,.1f} per process), peak memory '
+                     f'{humanize.naturalsize(max(peaks))} per process')
+        return results
+
+    @staticmethod
+    def outputs(root: str, index: int):
+        """The variants the thumbnail worker generates up front, see `thumbnail_worker.Command.outputs`."""
+        variants = [(settings.THUMBNAIL_DEFAULT_SIZE, 'jpeg')] + [
+            (size, extension) for size, extension in settings.THUMBNAIL_EAGER_VARIANTS
+            if extension in helpers.supported_formats()]
+        return [(os.path.join(root, f'{index}@{size}.{extension}'), settings.THUMBNAIL_SIZES[size], extension)
+                for size, extension in dict.fromkeys(variants)]
+
+    def bench_browse(self, root: str, sizes: List[int], repeat: int) -> Dict[str, dict]:
+        """Renders the first page of directories with the given numbers of Files, which only exist in the database."""
+        client = Client(HTTP_HOST='localhost')
+        results = {}
+        for size in sizes:
+            path = os.path.join(root, f'browse{size}')
+            os.makedirs(path, exist_ok=True)
+            directory = ServedDirectory.objects.create(path=path)
+            try:
+                self.create_files(directory, size)
+                results[str(size)] = {
+                    # Rendered listings are cached, so each request after the first is answered from the cache
+                    'browse_uncached': self.measure(lambda: cache.clear() or client.get(f'/{directory.id}/'), repeat),
+                    'browse': self.measure(lambda: client.get(f'/{directory.id}/'), repeat),
+                    'by_size': self.measure(
+                        lambda: client.get(f'/{directory.id}/?sort=size&order=desc'), repeat),
+                }
+                self.log(f'Browse {size} files: p50 {results[str(size)]["browse_uncached"]["p50_ms"]:.1f}ms, '
+                         f'{results[str(size)]["browse"]["p50_ms"]:.1f}ms cached')
+            finally:
+                self.remove(directory)
+        return results
+
+    @staticmethod
+    def create_files(directory: ServedDirectory, count: int, batch_size: int = 5000) -> None:
+        rng = random.Random(count)
+        now = timezone.now()
+        for offset in range(0, count, batch_size):
+            File.objects.bulk_create([File(
+                path=os.path.join(directory.path, f'{i:07d}.jpg'),
+                relative_path=f'{i:07d}.jpg',
+                filename=f'{i:07d}.jpg',
+                mediatype='image',
+                directory=directory,
+                size=rng.randrange(1, 10 ** 7),
+                width=1920,
+                height=1080,
+                fileLastModified=now - timedelta(seconds=rng.randrange(10 ** 8))
+            ) for i in range(offset, min(offset + batch_size, count))])
+        directory.update_stats()
+
+    def bench_file(self, tree: str, media: List[str], repeat: int) -> Dict[str, float]:
+        """Serves every file in the tree in full, `repeat` times over, through Django."""
+        directory = ServedDirectory.objects.create(path=tree, recursive=True)
+        client = Client(HTTP_HOST='localhost')
+        urls = [f'/{directory.id}/{os.path.relpath(path, tree)}/' for path in media]
+        try:
+            received = requests = 0
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for url in urls:
+                    response = client.get(url)
+                    received += sum(len(chunk) for chunk in response.streaming_content)
+                    response.close()
+                    requests += 1
+            elapsed = time.perf_counter() - start
+            self.log(f'Files: {requests / elapsed:,.0f} requests/s, {humanize.naturalsize(received / elapsed)}/s')
+            return {'requests': requests, 'bytes': received, 'seconds': elapsed,
+                    'requests_per_second': requests / elapsed, 'bytes_per_second': received / elapsed}
+        finally:
+            self.remove(directory)
+
+    @staticmethod
+    def measure(request: Callable, repeat: int) -> Dict[str, float]:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = request()
+            timings.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f'Request failed with status {response.status_code}')
+        return {'p50_ms': statistics.median(timings), 'min_ms': min(timings), 'max_ms': max(timings)}
+
+    @staticmethod
+    def remove(directory: ServedDirectory) -> None:
+        # Run inline rather than in the background, so that nothing is left once the benchmark exits
+        directory.remove().run()
@@ -0,0 +1,63 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from viewer.models import File, ServedDirectory, Thumbnail
+from viewer.views import SORT_KEYS, get_file_page
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks writing Files and paging through directory listings, using a synthetic directory which is ' \
+           'removed again afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=20000,
+                            help='Number of Files in the synthetic directory.')
+
+    def handle(self, *args, **options):
+        count = options['files']
+        now = timezone.now()
+        directory = ServedDirectory.objects.create(path='/nonexistent/bench_listing')
+        thumbnail = Thumbnail.objects.create(key=f'bench-{directory.id.hex}', size=0, width=300, height=169,
+                                             source_width=1920, source_height=1080)
+        try:
+            start = time.perf_counter()
+            with transaction.atomic():
+                File.objects.bulk_create([File(
+                    path=f'/nonexistent/bench_listing/{i:07d}.jpg',
+                    relative_path=f'{i:07d}.jpg',
+                    filename=f'{i:07d}.jpg',
+                    mediatype='image',
+                    directory=directory,
+                    size=random.randrange(1, 10 ** 8),
+                    fileLastModified=now - timedelta(seconds=random.randrange(10 ** 8))
+                ) for i in range(count)], batch_size=500)
+            self.report('Insert', count, time.perf_counter() - start)
+
+            # As done by the thumbnail worker for every media file
+            files = list(directory.files.all())
+            start = time.perf_counter()
+            with transaction.atomic():
+                for file in files:
+                    file.apply_thumbnail(thumbnail)
+            self.report('Apply thumbnail', count, time.perf_counter() - start)
+
+            for sort in SORT_KEYS:
+                start = time.perf_counter()
+                rows, cursor = 0, None
+                while True:
+                    page, cursor = get_file_page(directory, sort, False, cursor)
+                    rows += len([file.serialize() for file in page])
+                    if cursor is None:
+                        break
+                self.report(f'List by {sort}', rows, time.perf_counter() - start)
+        finally:
+            directory.delete()
+            thumbnail.delete()
+
+    def report(self, name: str, rows: int, elapsed: float) -> None:
+        self.stdout.write(f'{name}: {rows} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s)')
@@ -0,0 +1,116 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from viewer.models import File, ServedDirectory
+from viewer.search import search_files, uses_fts
+
+WORDS = ['holiday', 'beach', 'family', 'IMG', 'DSC', 'video', 'clip', 'render', 'final', 'draft', 'summer', 'winter',
+         'party', 'trip', 'camera', 'export', 'scan', 'photo', 'wedding', 'archive']
+EXTENSIONS = {'jpg': 'image', 'png': 'image', 'gif': 'image', 'mp4': 'video', 'mkv': 'video', 'webm': 'video',
+              'txt': 'file', 'pdf': 'file'}
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080), (2560, 1440), (3840, 2160), (4000, 3000)]
+
+QUERIES = [
+    ('Common word', {'q': 'holiday'}),
+    ('Two words', {'q': 'beach party'}),
+    ('Rare substring', {'q': '31337'}),
+    ('No match', {'q': 'zzzzz'}),
+    ('Word, type and size', {'q': 'wedding', 'mediatype': 'video', 'size_min': '500M'}),
+    ('Word and resolution', {'q': 'trip', 'resolution_min': '3840x2160'}),
+    ('Word and modified range', {'q': 'camera', 'modified_after': '2019-01-01', 'modified_before': '2019-06-30'}),
+    ('Filters only', {'mediatype': 'image', 'size_max': '1M'}),
+]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the global search against a synthetic index spread over several directories, which is ' \
+           'removed again afterwards unless --keep is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=1_000_000,
+                            help='Number of Files in the synthetic index.')
+        parser.add_argument('--directories', type=int, default=20,
+                            help='Number of directories the Files are spread over.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Times each query is run.')
+        parser.add_argument('--pages', type=int, default=10,
+                            help='Pages followed for the deep paging query.')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the synthetic directories, e.g. to try searching them from the browser.')
+
+    def handle(self, *args, **options):
+        if not uses_fts():
+            self.stderr.write(f'The {connection.vendor} database has no FTS5 search index, queries will scan.')
+
+        directories = [ServedDirectory.objects.create(path=f'/nonexistent/bench_search/library{i}')
+                       for i in range(options['directories'])]
+        try:
+            start = time.perf_counter()
+            self.generate(directories, options['files'])
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'Indexed {options["files"]} files in {elapsed:.1f}s '
+                              f'({options["files"] / elapsed:,.0f} rows/s)')
+
+            for name, params in QUERIES:
+                self.measure(name, options['repeat'], lambda: len(search_files(params)[0]))
+
+            def deep_page() -> int:
+                cursor, page = None, []
+                for _ in range(options['pages']):
+                    page, cursor = search_files({'q': 'photo'}, cursor)
+                return len(page)
+
+            self.measure(f'Common word, {options["pages"]} pages', options['repeat'], deep_page)
+        finally:
+            if not options['keep']:
+                start = time.perf_counter()
+                with connection.cursor() as cursor:
+                    cursor.execute(f'DELETE FROM {File._meta.db_table} WHERE directory_id IN '
+                                   f'({", ".join(["%s"] * len(directories))})',
+                                   [directory.id.hex if connection.vendor == 'sqlite' else directory.id
+                                    for directory in directories])
+                ServedDirectory.objects.filter(id__in=[directory.id for directory in directories]).delete()
+                self.stdout.write(f'Removed the synthetic index in {time.perf_counter() - start:.1f}s')
+
+    @staticmethod
+    def generate(directories, count: int, batch_size: int = 10000) -> None:
+        """Bulk inserts Files with plausible paths, sizes, resolutions and modification times."""
+        rng = random.Random(0)
+        now = timezone.now()
+        for offset in range(0, count, batch_size):
+            files = []
+            for i in range(offset, min(offset + batch_size, count)):
+                directory = directories[i % len(directories)]
+                extension = rng.choice(list(EXTENSIONS))
+                filename = f'{rng.choice(WORDS)}_{rng.randrange(10 ** 8):08d}.{extension}'
+                relative_path = f'{rng.choice(WORDS)}/{rng.choice(WORDS)} {rng.randrange(100)}/{filename}'
+                mediatype = EXTENSIONS[extension]
+                width, height = rng.choice(RESOLUTIONS) if mediatype != 'file' else (None, None)
+                files.append(File(
+                    path=f'{directory.path}/{relative_path}',
+                    relative_path=relative_path,
+                    filename=filename,
+                    mediatype=mediatype,
+                    directory=directory,
+                    size=rng.randrange(10 ** (9 if mediatype == 'video' else 7)),
+                    width=width,
+                    height=height,
+                    fileLastModified=now - timedelta(seconds=rng.randrange(10 * 365 * 86400))
+                ))
+            with transaction.atomic():
+                File.objects.bulk_create(files)
+
+    def measure(self, name: str, repeat: int, query) -> None:
+        timings, rows = [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = query()
+            timings.append(time.perf_counter() - start)
+        self.stdout.write(f'{name}: {rows} rows, p50 {statistics.median(timings) * 1000:.1f}ms '
+                          f'max {max(timings) * 1000:.1f}ms')
@@ -0,0 +1,166 @@
+import asyncio
+import io
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import humanize
+from django.core.management.base import BaseCommand
+
+from viewer.models import ServedDirectory
+from viewer.serving import CHUNK_SIZE
+
+
+class StreamStats:
+    """Timings of every stream in one benchmark run, and how many streams were receiving data at once."""
+
+    def __init__(self):
+        self.first_byte: List[float] = []
+        self.received = 0
+        self.active = self.peak = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def opened(self) -> None:
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def closed(self) -> None:
+        with self.lock:
+            self.active -= 1
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks how many slow clients can stream a file at once under uvicorn, compared to a WSGI server with ' \
+           'a fixed pool of threads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200,
+                            help='Number of clients streaming the file at the same time.')
+        parser.add_argument('--threads', type=int, default=40,
+                            help='Size of the WSGI server\'s thread pool.')
+        parser.add_argument('--size', type=int, default=4,
+                            help='Size of the streamed file in MiB.')
+        parser.add_argument('--delay', type=float, default=0.01,
+                            help='Seconds each client takes to receive a chunk, simulating a slow connection.')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'stream.bin'), 'wb') as file:
+                file.write(os.urandom(1024 * 1024) * options['size'])
+            directory = ServedDirectory.objects.create(path=root)
+            url = f'/{directory.id}/stream.bin/'
+
+            self.stdout.write(f'{options["clients"]} clients streaming {options["size"]} MiB each, '
+                              f'{options["delay"] * 1000:.0f}ms per chunk')
+            try:
+                self.report('WSGI', *self.bench_wsgi(url, options))
+                self.report('ASGI', *self.bench_asgi(url, options))
+            finally:
+                directory.delete()
+
+    def report(self, name: str, stats: StreamStats, elapsed: float) -> None:
+        first_byte = sorted(stats.first_byte) or [0.0]
+        self.stdout.write(
+            f'{name}: {stats.peak} concurrent streams, first byte p50 {statistics.median(first_byte) * 1000:.0f}ms '
+            f'p95 {first_byte[int(len(first_byte) * 0.95) - 1] * 1000:.0f}ms, {elapsed:.2f}s total, '
+            f'{humanize.naturalsize(stats.received / elapsed)}/s, {stats.errors} errors'
+        )
+
+    @staticmethod
+    def bench_wsgi(url: str, options) -> Tuple[StreamStats, float]:
+        """Streams to every client from a fixed pool of threads, as a threaded WSGI server would."""
+        from simple_viewer.wsgi import application
+        stats = StreamStats()
+
+        def client(queued: float) -> None:
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': url, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+                'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'wsgi.input': io.BytesIO(), 'wsgi.url_scheme': 'http',
+                'wsgi.errors': io.StringIO(),
+            }
+            status = []
+            result = application(environ, lambda line, headers, exc_info=None: status.append(line))
+            chunks = 0
+            try:
+                for chunk in result:
+                    if chunks == 0:
+                        stats.first_byte.append(time.perf_counter() - queued)
+                        stats.opened()
+                    chunks += 1
+                    stats.received += len(chunk)
+                    time.sleep(options['delay'])
+            finally:
+                result.close()
+                if chunks:
+                    stats.closed()
+            if not status[0].startswith('200'):
+                stats.errors += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            for future in [pool.submit(client, start) for _ in range(options['clients'])]:
+                future.result()
+        return stats, time.perf_counter() - start
+
+    @staticmethod
+    def bench_asgi(url: str, options) -> Tuple[StreamStats, float]:
+        """
+        Streams to every client over a socket through uvicorn, the server the project is deployed with, so that slow
+        clients hold the server back as they would in production, by filling their receive buffers.
+        """
+        import uvicorn
+        from simple_viewer.asgi import application
+        stats = StreamStats()
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(options['clients'])
+        port = listener.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(application, lifespan='off', log_level='warning'))
+        thread = threading.Thread(target=asyncio.run, args=(server.serve(sockets=[listener]),), daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.01)
+
+        async def client(queued: float) -> None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'GET {url} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode('ascii'))
+            chunks = 0
+            try:
+                status = (await reader.readline()).split()[1]
+                await reader.readuntil(b'\r\n\r\n')
+                while True:
+                    chunk = await reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if chunks == 0:
+                        stats.first_byte.append(time.perf_counter() - queued)
+                        stats.opened()
+                    chunks += 1
+                    stats.received += len(chunk)
+                    await asyncio.sleep(options['delay'])
+            finally:
+                writer.close()
+                if chunks:
+                    stats.closed()
+            if status != b'200':
+                stats.errors += 1
+
+        async def run() -> float:
+            start = time.perf_counter()
+            await asyncio.gather(*(client(start) for _ in range(options['clients'])))
+            return time.perf_counter() - start
+
+        try:
+            return stats, asyncio.run(run())
+        finally:
+            server.should_exit = True
+            thread.join()
+            listener.close()
@@ -0,0 +1,56 @@
+import cProfile
+import io
+import pstats
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from viewer import metrics
+from viewer.models import ServedDirectory
+
+SORT_KEYS = ['cumulative', 'tottime', 'ncalls', 'filename']
+
+
+class Command(BaseCommand):
+    help = 'Refreshes a single served directory under cProfile and prints the functions it spent the most time in, ' \
+           'along with the database queries it made.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory',
+                            help='Id or path of the directory to refresh.')
+        parser.add_argument('--full', action='store_true',
+                            help='Scan every subdirectory, even those that appear unchanged.')
+        parser.add_argument('--sort', choices=SORT_KEYS, default='cumulative',
+                            help='Order of the report.')
+        parser.add_argument('--limit', type=int, default=40,
+                            help='Functions shown in the report.')
+        parser.add_argument('--output',
+                            help='Also dump the raw profile to this file, e.g. for snakeviz or pstats.')
+
+    def handle(self, *args, **options):
+        try:
+            directory = ServedDirectory.objects.filter(id=options['directory']).first()
+        except ValidationError:
+            directory = ServedDirectory.objects.filter(path=options['directory']).first()
+        if directory is None:
+            raise CommandError(f'No served directory {options["directory"]!r}')
+
+        profiler = cProfile.Profile()
+        with metrics.measure() as measurement:
+            profiler.enable()
+            try:
+                result = directory.refresh(options['full'])
+            finally:
+                profiler.disable()
+
+        if options['output']:
+            profiler.dump_stats(options['output'])
+
+        report = io.StringIO()
+        stats = pstats.Stats(profiler, stream=report).strip_dirs().sort_stats(options['sort'])
+        stats.print_stats(options['limit'])
+        self.stdout.write(report.getvalue().strip('\n'))
+        self.stdout.write('')
+        self.stdout.write(f'{directory.path}: {result}')
+        self.stdout.write(f'{measurement.queries} queries in {measurement.query_seconds:.3f}s of '
+                          f'{measurement.seconds:.3f}s')
@@ -0,0 +1,50 @@
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from viewer.models import ServedDirectory
+
+
+class Command(BaseCommand):
+    help = 'Refreshes every served directory, or those given by id, several at once on a pool of threads. ' \
+           'Directories already being refreshed elsewhere are coalesced into that refresh.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directories', nargs='*',
+                            help='Ids of the directories to refresh, every directory by default.')
+        parser.add_argument('--threads', type=int, default=settings.REFRESH_THREADS,
+                            help='Directories refreshed at once.')
+        parser.add_argument('--full', action='store_true',
+                            help='Scan every subdirectory, even those that appear unchanged.')
+
+    def handle(self, *args, **options):
+        directories = ServedDirectory.objects.all()
+        if options['directories']:
+            try:
+                directories = directories.filter(id__in=options['directories'])
+            except ValidationError as e:
+                raise CommandError(e.messages[0])
+
+        start = time.perf_counter()
+        results = ServedDirectory.refresh_many(list(directories), options['threads'], options['full'])
+        elapsed = time.perf_counter() - start
+
+        rows = [['Directory', 'Time', 'Added', 'Updated', 'Moved', 'Removed', 'Unchanged', 'Probes Cached', 'Status']]
+        for directory, result, error in sorted(results, key=lambda item: item[1].elapsed, reverse=True):
+            status = f'failed: {error}' if error else 'coalesced' if result.coalesced else 'ok'
+            rows.append([directory.path, f'{result.elapsed:.2f}s', result.added, result.updated, result.moved,
+                         result.removed, result.unchanged,
+                         f'{result.probe_hits}/{result.probe_hits + result.probe_misses}', status])
+
+        widths = [max(len(str(row[column])) for row in rows) for column in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write('  '.join(str(value).ljust(width) if column in (0, 8) else str(value).rjust(width)
+                                        for column, (value, width) in enumerate(zip(row, widths))).rstrip())
+
+        failed = sum(1 for _, _, error in results if error)
+        self.stdout.write(f'Refreshed {len(results) - failed} of {len(results)} directories in {elapsed:.2f}s '
+                          f'({sum(result.elapsed for _, result, _ in results):.2f}s spent scanning)')
+        if failed:
+            raise CommandError(f'{failed} directories could not be refreshed')
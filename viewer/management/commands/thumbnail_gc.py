@@ -0,0 +1,76 @@
+import os
+import time
+from datetime import timedelta
+
+import humanize
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+
+from viewer.models import THUMBNAILS_DIR, MediaProbe, Thumbnail, ThumbnailCleanup
+
+
+class Command(BaseCommand):
+    help = 'Removes thumbnails no longer used by any file, along with stray thumbnail files, and enforces the ' \
+           'thumbnail store\'s size budget.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=3600,
+                            help='Seconds a stray thumbnail file is kept for, as it may still be in the process of '
+                                 'being generated.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be removed.')
+
+    def handle(self, *args, **options):
+        cutoff = time.time() - options['grace']
+        dry_run = options['dry_run']
+
+        if not dry_run:
+            resumed = ThumbnailCleanup.resume()
+            self.stdout.write(f'Interrupted cleanups of deleted directories finished: {resumed}')
+
+        # Thumbnails with no File referencing them
+        unreferenced = Thumbnail.objects.annotate(references=Count('files')).filter(references=0)
+        if dry_run:
+            count, reclaimed = unreferenced.count(), sum(unreferenced.values_list('size', flat=True))
+        else:
+            count, reclaimed = len(unreferenced), Thumbnail.remove(unreferenced)
+        self.stdout.write(f'Unreferenced thumbnails: {count} ({humanize.naturalsize(reclaimed)})')
+        total = reclaimed
+
+        # Thumbnail rows whose file has gone missing, so their files are queued again on the next refresh
+        missing = [key for key in Thumbnail.objects.values_list('key', flat=True)
+                   if not os.path.exists(Thumbnail.path_for(key))]
+        if not dry_run:
+            Thumbnail.remove(Thumbnail.objects.filter(key__in=missing))
+        self.stdout.write(f'Thumbnails missing from disk: {len(missing)}')
+
+        # Files on disk that no Thumbnail row knows about, e.g. left behind by older versions
+        known = set(Thumbnail.objects.values_list('key', flat=True))
+        strays, reclaimed = 0, 0
+        with os.scandir(THUMBNAILS_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and Thumbnail.key_from_filename(entry.name) not in known \
+                        and entry.stat().st_mtime < cutoff:
+                    strays += 1
+                    reclaimed += entry.stat().st_size
+                    if not dry_run:
+                        os.remove(entry.path)
+        self.stdout.write(f'Stray thumbnail files: {strays} ({humanize.naturalsize(reclaimed)})')
+        total += reclaimed
+
+        if not dry_run:
+            reclaimed = Thumbnail.evict(settings.THUMBNAIL_CACHE_BUDGET)
+            self.stdout.write(f'Evicted to stay within budget: {humanize.naturalsize(reclaimed)}')
+            total += reclaimed
+
+        # Probes are cheap to keep, but files not seen for a long time are unlikely to come back
+        retention = timedelta(days=settings.PROBE_CACHE_RETENTION)
+        if dry_run:
+            pruned = MediaProbe.objects.filter(lastUsed__lt=timezone.now() - retention).count()
+        else:
+            pruned = MediaProbe.prune(retention)
+        self.stdout.write(f'Unused cached probes: {pruned}')
+
+        self.stdout.write(f'Reclaimed {humanize.naturalsize(total)} in total.')
@@ -0,0 +1,169 @@
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from viewer import helpers
+from viewer.models import MediaProbe, Thumbnail, ThumbnailCleanup, ThumbnailJob
+
+logger = logging.getLogger(__name__)
+
+# Number of new thumbnails generated between checks of the thumbnail store's size budget
+EVICTION_INTERVAL = 100
+
+
+class Command(BaseCommand):
+    help = 'Drains the thumbnail job queue using a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.THUMBNAIL_WORKER_PROCESSES,
+                            help='Number of worker processes decoding thumbnails.')
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_BATCH_SIZE,
+                            help='Files handed to a worker process at once.')
+        parser.add_argument('--poll', type=float, default=2.0,
+                            help='Seconds to wait between checks of an empty queue.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no jobs are available instead of polling forever.')
+
+    def handle(self, *args, **options):
+        self.release_expired()
+
+        batch_size = max(options['batch_size'], 1)
+        # Keep a small backlog of batches per process so workers never sit idle waiting on the database
+        capacity = options['processes'] * batch_size * 2
+        # Jobs for files with the same identity share a single thumbnail, and so a single place in a batch
+        pending: Dict[Future, List[str]] = {}
+        in_flight: Dict[str, List[ThumbnailJob]] = {}
+        self.done = self.shared = self.failed = 0
+        since_eviction = 0
+        # Leases are renewed a few times over before they would expire
+        renew_interval = settings.THUMBNAIL_LEASE_TIMEOUT / 3
+        next_renewal = time.monotonic() + renew_interval
+
+        with ProcessPoolExecutor(max_workers=options['processes']) as pool:
+            while True:
+                if len(in_flight) < capacity:
+                    tasks = []
+                    for job in ThumbnailJob.claim(capacity - len(in_flight)):
+                        try:
+                            key = helpers.file_identity(os.stat(job.file.path))
+                        except OSError as e:
+                            self.fail([job], e)
+                            continue
+
+                        if key in in_flight:
+                            in_flight[key].append(job)
+                            continue
+
+                        thumbnail = Thumbnail.objects.filter(key=key).first()
+                        if thumbnail is not None and os.path.exists(thumbnail.path):
+                            Thumbnail.touch([key])
+                            self.complete([job], thumbnail)
+                            self.shared += 1
+                            continue
+
+                        sprite = None
+                        if job.file.mediatype == 'video' and settings.THUMBNAIL_SPRITE_FRAMES:
+                            sprite = (Thumbnail.sprite_path_for(key), settings.THUMBNAIL_SPRITE_FRAMES,
+                                      settings.THUMBNAIL_SIZES[settings.THUMBNAIL_SPRITE_SIZE])
+                        in_flight[key] = [job]
+                        tasks.append((key, (job.file.path, self.outputs(key), sprite)))
+
+                    for batch in helpers.chunked(tasks, batch_size):
+                        future = pool.submit(helpers.create_thumbnails, [task for _, task in batch],
+                                             settings.THUMBNAIL_ENCODING)
+                        pending[future] = [key for key, _ in batch]
+
+                if time.monotonic() >= next_renewal:
+                    ThumbnailJob.renew(job.id for jobs in in_flight.values() for job in jobs)
+                    next_renewal = time.monotonic() + renew_interval
+
+                if not pending:
+                    # Pick up the jobs of any other worker that died
+                    self.release_expired()
+                    # Finish removing the thumbnails of deleted directories whose server went away part way through
+                    resumed = ThumbnailCleanup.resume()
+                    if resumed:
+                        self.stdout.write(f'Finished {resumed} interrupted thumbnail cleanups.')
+                    if since_eviction:
+                        self.evict()
+                        since_eviction = 0
+                    if options['once']:
+                        break
+                    time.sleep(options['poll'])
+                    continue
+
+                finished, _ = wait(pending, timeout=options['poll'], return_when=FIRST_COMPLETED)
+                for future in finished:
+                    keys = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        # The whole batch was lost, e.g. as its worker process died
+                        results = [e] * len(keys)
+
+                    for key, result in zip(keys, results):
+                        jobs = in_flight.pop(key)
+                        if isinstance(result, Exception):
+                            self.fail(jobs, result)
+                            continue
+
+                        info, resolutions, written, sprite_frames = result
+                        (width, height), *_ = resolutions
+                        MediaProbe.record(key, info)
+                        thumbnail, _ = Thumbnail.objects.update_or_create(key=key, defaults={
+                            'size': written,
+                            'width': width,
+                            'height': height,
+                            'source_width': info.width,
+                            'source_height': info.height,
+                            'sprite_frames': sprite_frames
+                        })
+                        self.complete(jobs, thumbnail)
+                        since_eviction += 1
+
+                if since_eviction >= EVICTION_INTERVAL:
+                    self.evict()
+                    since_eviction = 0
+
+        self.stdout.write(f'Generated {self.done} thumbnails ({self.shared} shared with existing thumbnails), '
+                          f'{self.failed} failed.')
+
+    @staticmethod
+    def outputs(key: str) -> List[Tuple[str, int, str]]:
+        """Every thumbnail variant generated up front, starting with the default size as a JPEG."""
+        variants = [(settings.THUMBNAIL_DEFAULT_SIZE, 'jpeg')] + [
+            (size, extension) for size, extension in settings.THUMBNAIL_EAGER_VARIANTS
+            if extension in helpers.supported_formats()]
+        return [(Thumbnail.path_for(key, size, extension), settings.THUMBNAIL_SIZES[size], extension)
+                for size, extension in dict.fromkeys(variants)]
+
+    def complete(self, jobs: List[ThumbnailJob], thumbnail: Thumbnail) -> None:
+        for job in jobs:
+            try:
+                job.complete(thumbnail)
+                self.done += 1
+            except DatabaseError:
+                # The File was removed while its thumbnail was being generated
+                Thumbnail.release([thumbnail.key])
+
+    def fail(self, jobs: List[ThumbnailJob], error: Exception) -> None:
+        for job in jobs:
+            logger.warning(f'Could not thumbnail {job.file.path}: {error}')
+            job.fail(str(error))
+            self.failed += 1
+
+    def release_expired(self) -> None:
+        released = ThumbnailJob.release_expired()
+        if released:
+            self.stdout.write(f'Returned {released} interrupted jobs to the queue.')
+
+    def evict(self) -> None:
+        reclaimed = Thumbnail.evict(settings.THUMBNAIL_CACHE_BUDGET)
+        if reclaimed:
+            logger.info(f'Evicted {reclaimed} bytes of thumbnails to stay within budget.')
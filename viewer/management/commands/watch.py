@@ -0,0 +1,131 @@
+import functools
+import logging
+import time
+import uuid
+from typing import Dict, Optional, Set, Tuple
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from viewer.models import ServedDirectory
+from viewer.watcher import Inotify, Watcher
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Watches every served directory with inotify, applying changes as they happen instead of waiting for a ' \
+           'refresh. Directories that cannot be watched are refreshed periodically instead.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debounce', type=float, default=1.0,
+                            help='Seconds without events to wait for before applying a batch of changes.')
+        parser.add_argument('--max-delay', type=float, default=10.0,
+                            help='Most seconds to hold changes back while events keep arriving.')
+        parser.add_argument('--interval', type=float, default=30.0,
+                            help='Seconds between refreshes of directories which are polled rather than watched.')
+        parser.add_argument('--sync', type=float, default=30.0,
+                            help='Seconds between checks for directories being added, removed or changed.')
+        parser.add_argument('--poll', action='store_true',
+                            help='Poll every directory rather than using inotify.')
+
+    def handle(self, *args, **options):
+        self.watcher: Optional[Watcher] = None
+        if not options['poll']:
+            try:
+                self.watcher = Watcher(Inotify(), options['debounce'], options['max_delay'])
+            except OSError as e:
+                self.stderr.write(f'Could not start inotify ({e}), falling back to polling.')
+
+        # The path and options each directory is being watched with, and the directories only polled
+        self.watched: Dict[uuid.UUID, Tuple[str, bool, str]] = {}
+        self.polled: Set[uuid.UUID] = set()
+        # Directories whose changes could not be written to the database, refreshed in full on the next poll
+        self.failed: Set[uuid.UUID] = set()
+        next_sync = next_poll = time.monotonic()
+
+        while True:
+            now = time.monotonic()
+            if now >= next_sync:
+                try:
+                    self.sync()
+                except DatabaseError as e:
+                    logger.warning(f'Could not check for changed directories: {e}')
+                next_sync = now + options['sync']
+            if now >= next_poll:
+                failed, self.failed = self.failed, set()
+                try:
+                    for directory in ServedDirectory.objects.filter(id__in=self.polled | failed):
+                        self.apply(directory, functools.partial(directory.refresh, directory.id in failed))
+                except DatabaseError as e:
+                    logger.warning(f'Could not refresh polled directories: {e}')
+                    self.failed |= failed
+                next_poll = now + options['interval']
+
+            if self.watcher is None:
+                time.sleep(min(next_sync, next_poll) - now)
+                continue
+
+            self.watcher.poll(min(options['debounce'], 1.0))
+            if self.watcher.ready():
+                batches = self.watcher.take()
+                try:
+                    directories = list(ServedDirectory.objects.filter(id__in=batches))
+                except DatabaseError as e:
+                    logger.warning(f'Could not apply changes: {e}')
+                    self.failed.update(batches)
+                    continue
+                for directory in directories:
+                    batch = batches[directory.id]
+                    if batch.overflow:
+                        self.apply(directory, directory.refresh)
+                    else:
+                        self.apply(directory, functools.partial(directory.apply_changes, batch.changed, batch.moves))
+
+    def sync(self) -> None:
+        """
+        Starts watching directories which were added or changed since the last sync, and stops watching those removed.
+        Each newly watched directory is refreshed, to pick up anything changed while it was not being watched.
+        """
+        directories = {directory.id: directory for directory in ServedDirectory.objects.all()}
+        for directory_id in set(self.watched) - set(directories):
+            if self.watcher is not None:
+                self.watcher.unwatch(directory_id)
+            del self.watched[directory_id]
+            self.polled.discard(directory_id)
+
+        for directory in directories.values():
+            state = directory.path, directory.recursive, directory.get_scan_options()
+            if self.watched.get(directory.id) == state:
+                continue
+
+            self.polled.add(directory.id)
+            if self.watcher is not None:
+                self.watcher.unwatch(directory.id)
+                try:
+                    # Watched before refreshing, so that nothing changed in between is missed
+                    self.watcher.watch(directory.id, directory.path, directory.recursive)
+                    self.polled.discard(directory.id)
+                except OSError as e:
+                    self.stderr.write(f'Could not watch {directory.path} ({e}), polling it instead.')
+
+            self.watched[directory.id] = state
+            self.apply(directory, directory.refresh)
+
+    def apply(self, directory: ServedDirectory, method) -> None:
+        """
+        Runs a refresh or applies a batch of changes, logging rather than raising any error. Changes that could not be
+        written to the database, e.g. while it is locked by a refresh in another process, are lost, so the directory is
+        refreshed in full on the next poll instead.
+        """
+        try:
+            result = method()
+        except (OSError, ServedDirectory.DoesNotExist) as e:
+            logger.warning(f'Could not update {directory.path}: {e}')
+            return
+        except DatabaseError as e:
+            logger.warning(f'Could not update {directory.path}, refreshing it on the next poll: {e}')
+            self.failed.add(directory.id)
+            return
+        if result.added or result.updated or result.moved or result.removed:
+            self.stdout.write(f'{directory.path}: {result}')
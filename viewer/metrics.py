@@ -0,0 +1,145 @@
+"""
+metrics.py
+
+Contains the opt-in instrumentation of the hot paths: how long they take, how many database queries they make and how
+many bytes are served, kept in memory by each process and exposed in the Prometheus text format by `views.metrics`.
+
+Nothing is recorded unless METRICS_ENABLED is set, so that the instrumented paths pay for no more than a settings
+lookup by default. Thumbnails generated by `manage.py thumbnail_worker` and changes applied by `manage.py watch`
+happen in other processes, and are not included.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+# Every metric that can be recorded, with its Prometheus type and help text
+METRICS = {
+    'request_seconds': ('summary', 'Time spent answering requests, until the response headers are ready.'),
+    'request_queries': ('counter', 'Database queries made while answering requests.'),
+    'bytes_served': ('counter', 'Bytes of content sent in responses, as given by their Content-Length.'),
+    'refresh_seconds': ('summary', 'Time spent scanning served directories, by whether the scan was full.'),
+    'refresh_queries': ('counter', 'Database queries made while refreshing directories.'),
+    'refresh_files': ('counter', 'Files examined while refreshing directories, by outcome.'),
+    'probe_cache_lookups': ('counter', 'Lookups of new and changed media in the probe cache, by result.'),
+    'listing_cache_lookups': ('counter', 'Lookups of rendered directory listings and index pages, by result.'),
+    'file_refresh_seconds': ('summary', 'Time spent refreshing single Files.'),
+    'thumbnail_seconds': ('summary', 'Time spent producing thumbnail variants on request, by whether the source file '
+                                     'was decoded or an existing thumbnail resized.'),
+}
+
+PREFIX = 'simple_viewer_'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+# Running totals for each metric and set of labels, and for summaries the number of observations
+_totals: Dict[str, Dict[Labels, float]] = {name: {} for name in METRICS}
+_counts: Dict[str, Dict[Labels, int]] = {name: {} for name in METRICS}
+
+
+class Measurement:
+    """The time taken by a block of code, and the database queries it made on its thread's connection."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installed as a database execute wrapper, see `measure`
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - start
+
+
+def enabled() -> bool:
+    return settings.METRICS_ENABLED
+
+
+def get_labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Records a single observation of a summary, such as the duration of one request."""
+    if not settings.METRICS_ENABLED:
+        return
+    key = get_labels(labels)
+    with _lock:
+        _totals[name][key] = _totals[name].get(key, 0.0) + value
+        _counts[name][key] = _counts[name].get(key, 0) + 1
+
+
+def increment(name: str, amount: float = 1, **labels) -> None:
+    """Adds to a counter."""
+    if not settings.METRICS_ENABLED or not amount:
+        return
+    key = get_labels(labels)
+    with _lock:
+        _totals[name][key] = _totals[name].get(key, 0.0) + amount
+
+
+@contextmanager
+def measure(name: Optional[str] = None, **labels) -> Iterator[Measurement]:
+    """
+    Times a block of code and counts the queries it makes, recording them as `<name>_seconds` and `<name>_queries`
+    (if such a metric exists). Blocks may be nested, each counting every query made within it.
+
+    :param name: The metric to record, or None to only measure (even if metrics are disabled) and record nothing.
+    """
+    measurement = Measurement()
+    if name is not None and not settings.METRICS_ENABLED:
+        yield measurement
+        return
+
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(measurement):
+            yield measurement
+    finally:
+        measurement.seconds = time.perf_counter() - start
+        if name is not None:
+            observe(f'{name}_seconds', measurement.seconds, **labels)
+            if f'{name}_queries' in METRICS:
+                increment(f'{name}_queries', measurement.queries, **labels)
+
+
+def record_refresh(result, **labels) -> None:
+    """Counts the files examined by a refresh (a RefreshResult) by outcome, and its probe cache lookups."""
+    if not settings.METRICS_ENABLED:
+        return
+    for outcome in ('added', 'updated', 'moved', 'removed', 'unchanged', 'filtered'):
+        increment('refresh_files', getattr(result, outcome), outcome=outcome, **labels)
+    increment('probe_cache_lookups', result.probe_hits, result='hit')
+    increment('probe_cache_lookups', result.probe_misses, result='miss')
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def render() -> str:
+    """Every metric recorded by this process, in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for name, (kind, description) in METRICS.items():
+            full_name = PREFIX + name + ('_total' if kind == 'counter' else '')
+            lines.append(f'# HELP {full_name} {description}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for labels, total in sorted(_totals[name].items()):
+                if kind == 'summary':
+                    lines.append(f'{full_name}_count{format_labels(labels)} {_counts[name][labels]}')
+                    lines.append(f'{full_name}_sum{format_labels(labels)} {total!r}')
+                else:
+                    lines.append(f'{full_name}{format_labels(labels)} {total!r}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,40 @@
+"""
+middleware.py
+
+Contains the middleware measuring every request handled by Django, see viewer.metrics.
+"""
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from viewer import metrics
+
+
+class MetricsMiddleware:
+    """
+    Records the time and database queries spent on each request by view, along with the bytes served, when
+    METRICS_ENABLED is set. With METRICS_DEBUG_HEADER set, each response also carries a Server-Timing header with the
+    same figures, shown alongside the request in a browser's developer tools.
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED and not settings.METRICS_DEBUG_HEADER:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with metrics.measure() as measurement:
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name else 'unresolved'
+        if metrics.enabled():
+            metrics.observe('request_seconds', measurement.seconds, view=view)
+            metrics.increment('request_queries', measurement.queries, view=view)
+            if request.method != 'HEAD' and response.has_header('Content-Length'):
+                metrics.increment('bytes_served', int(response['Content-Length']), view=view)
+
+        if settings.METRICS_DEBUG_HEADER:
+            response['Server-Timing'] = f'app;dur={measurement.seconds * 1000:.1f}, ' \
+                                        f'db;dur={measurement.query_seconds * 1000:.1f};desc="{measurement.queries} ' \
+                                        f'queries"'
+        return response
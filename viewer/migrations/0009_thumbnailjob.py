@@ -0,0 +1,32 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0008_auto_20201103_1918'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10, verbose_name='Job Status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Failed Attempts')),
+                ('available', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next Attempt')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Last Error')),
+                ('lastModified', models.DateTimeField(auto_now=True)),
+                ('initialCreation', models.DateTimeField(auto_now_add=True)),
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnail_job', to='viewer.file')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='thumbnailjob',
+            index=models.Index(fields=['status', 'available'], name='viewer_thum_status_30bf9f_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_relative_paths(apps, schema_editor):
+    """Every File indexed so far sits directly inside its directory."""
+    File = apps.get_model('viewer', 'File')
+    File.objects.update(relative_path=models.F('filename'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0009_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='relative_path',
+            field=models.CharField(default='', max_length=300, verbose_name='Path Relative To Directory'),
+        ),
+        migrations.RunPython(fill_relative_paths, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='scan_options',
+            field=models.CharField(default='', max_length=300, verbose_name='Options Used For Last Scan'),
+        ),
+        migrations.CreateModel(
+            name='IndexedDirectory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('relative_path', models.CharField(max_length=300, verbose_name='Relative Path')),
+                ('mtime', models.BigIntegerField(verbose_name='Directory Last Modified (ns)')),
+                ('directory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='indexed_directories', to='viewer.serveddirectory')),
+            ],
+            options={
+                'unique_together': {('directory', 'relative_path')},
+            },
+        ),
+    ]
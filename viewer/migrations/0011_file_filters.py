@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0010_recursive_indexing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='exclude_pattern',
+            field=models.TextField(blank=True, default='', verbose_name='RegEx Exclude Patterns'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='extensions',
+            field=models.CharField(blank=True, default='', max_length=200, verbose_name='Allowed File Extensions'),
+        ),
+        migrations.AlterField(
+            model_name='serveddirectory',
+            name='regex_pattern',
+            field=models.TextField(blank=True, default='', verbose_name='RegEx Include Patterns'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:10
+
+import os
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+THUMBNAILS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'thumbnails')
+
+
+def adopt_thumbnails(apps, schema_editor):
+    """
+    Creates a Thumbnail for every existing thumbnail file, keyed by its old random name without the extension.
+    Files whose thumbnail is missing from disk are left without one, to be queued again on their next refresh.
+    """
+    File = apps.get_model('viewer', 'File')
+    Thumbnail = apps.get_model('viewer', 'Thumbnail')
+
+    for file in File.objects.exclude(thumbnail__isnull=True).select_related('resolution', 'thumbnailResolution'):
+        path = os.path.join(THUMBNAILS_DIR, file.thumbnail)
+        if not os.path.exists(path):
+            File.objects.filter(id=file.id).update(thumbnail=None)
+            continue
+
+        key = os.path.splitext(file.thumbnail)[0]
+        Thumbnail.objects.get_or_create(key=key, defaults={
+            'size': os.path.getsize(path),
+            'width': file.thumbnailResolution.x if file.thumbnailResolution else None,
+            'height': file.thumbnailResolution.y if file.thumbnailResolution else None,
+            'source_width': file.resolution.x if file.resolution else None,
+            'source_height': file.resolution.y if file.resolution else None
+        })
+        File.objects.filter(id=file.id).update(thumbnail=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0011_file_filters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Identity Hash')),
+                ('size', models.PositiveIntegerField(default=0, verbose_name='Size In Bytes')),
+                ('width', models.PositiveIntegerField(null=True)),
+                ('height', models.PositiveIntegerField(null=True)),
+                ('source_width', models.PositiveIntegerField(null=True)),
+                ('source_height', models.PositiveIntegerField(null=True)),
+                ('lastUsed', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('initialCreation', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(adopt_thumbnails, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='file',
+            name='thumbnail',
+            field=models.ForeignKey(db_column='thumbnail', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='files', to='viewer.thumbnail'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0012_shared_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='sprite_frames',
+            field=models.PositiveIntegerField(default=0, verbose_name='Hover Preview Frames'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0013_thumbnail_sprites'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('changed', 'Changed'), ('removed', 'Removed')], max_length=10, verbose_name='Event Kind')),
+                ('relative_path', models.CharField(blank=True, default='', max_length=300, verbose_name='Path Relative To Directory')),
+                ('file_id', models.PositiveIntegerField(null=True, verbose_name='Removed File ID')),
+                ('initialCreation', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('directory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='viewer.serveddirectory')),
+            ],
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:27
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def inline_resolutions(apps, schema_editor):
+    """Copies both resolutions of every File onto its own columns, in a single UPDATE statement."""
+    File = apps.get_model('viewer', 'File')
+    ImageResolution = apps.get_model('viewer', 'ImageResolution')
+
+    def column(relation, field):
+        return Subquery(ImageResolution.objects.filter(id=OuterRef(f'{relation}_id')).values(field)[:1])
+
+    File.objects.filter(models.Q(resolution__isnull=False) | models.Q(thumbnailResolution__isnull=False)).update(
+        width=column('resolution', 'x'),
+        height=column('resolution', 'y'),
+        thumbnail_width=column('thumbnailResolution', 'x'),
+        thumbnail_height=column('thumbnailResolution', 'y')
+    )
+
+    # Listings sorted by modification time read it straight from the new index, which requires it to be set
+    File.objects.filter(fileLastModified__isnull=True).update(fileLastModified=F('initialCreation'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0014_directory_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='height',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='thumbnail_height',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='thumbnail_width',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='width',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(inline_resolutions, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='file',
+            name='resolution',
+        ),
+        migrations.RemoveField(
+            model_name='file',
+            name='thumbnailResolution',
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['directory', 'relative_path'], name='viewer_file_directo_c5c711_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['directory', 'filename'], name='viewer_file_directo_03f41e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['directory', 'fileLastModified'], name='viewer_file_directo_5deb3d_idx'),
+        ),
+        migrations.DeleteModel(
+            name='ImageResolution',
+        ),
+    ]
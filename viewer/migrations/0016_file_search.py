@@ -0,0 +1,62 @@
+import sqlite3
+
+from django.db import migrations
+
+# The statements are copied here rather than imported from viewer.search, so that this migration never changes
+
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE viewer_file_search USING fts5(path, content='viewer_file', content_rowid='id', "
+    "tokenize='trigram')",
+    "INSERT INTO viewer_file_search(viewer_file_search) VALUES ('rebuild')",
+]
+
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER viewer_file_search_insert AFTER INSERT ON viewer_file BEGIN
+        INSERT INTO viewer_file_search(rowid, path) VALUES (new.id, new.path);
+    END""",
+    """CREATE TRIGGER viewer_file_search_delete AFTER DELETE ON viewer_file BEGIN
+        INSERT INTO viewer_file_search(viewer_file_search, rowid, path) VALUES ('delete', old.id, old.path);
+    END""",
+    """CREATE TRIGGER viewer_file_search_update AFTER UPDATE OF path ON viewer_file WHEN old.path IS NOT new.path BEGIN
+        INSERT INTO viewer_file_search(viewer_file_search, rowid, path) VALUES ('delete', old.id, old.path);
+        INSERT INTO viewer_file_search(rowid, path) VALUES (new.id, new.path);
+    END""",
+]
+
+POSTGRESQL_INDEX = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    # Django's icontains compares UPPER() of both sides
+    'CREATE INDEX viewer_file_search ON viewer_file USING gin (UPPER(path) gin_trgm_ops)',
+]
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    # The trigram tokenizer was added in SQLite 3.34, earlier versions are left scanning
+    if vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 34):
+        for statement in SQLITE_INDEX + SQLITE_TRIGGERS:
+            schema_editor.execute(statement)
+    elif vendor == 'postgresql':
+        for statement in POSTGRESQL_INDEX:
+            schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS viewer_file_search_{trigger}')
+        schema_editor.execute('DROP TABLE IF EXISTS viewer_file_search')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS viewer_file_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0015_inline_resolutions'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+# Copied from 0016_file_search rather than imported from viewer.search, so that this migration never changes
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER viewer_file_search_insert AFTER INSERT ON viewer_file BEGIN
+        INSERT INTO viewer_file_search(rowid, path) VALUES (new.id, new.path);
+    END""",
+    """CREATE TRIGGER viewer_file_search_delete AFTER DELETE ON viewer_file BEGIN
+        INSERT INTO viewer_file_search(viewer_file_search, rowid, path) VALUES ('delete', old.id, old.path);
+    END""",
+    """CREATE TRIGGER viewer_file_search_update AFTER UPDATE OF path ON viewer_file WHEN old.path IS NOT new.path BEGIN
+        INSERT INTO viewer_file_search(viewer_file_search, rowid, path) VALUES ('delete', old.id, old.path);
+        INSERT INTO viewer_file_search(rowid, path) VALUES (new.id, new.path);
+    END""",
+]
+
+
+def remove_duplicate_files(apps, schema_editor):
+    """Keeps the oldest File of any created twice by concurrent refreshes, so that the constraint can be added."""
+    File = apps.get_model('viewer', 'File')
+    duplicates = File.objects.values('directory', 'relative_path').annotate(count=Count('id'), first=Min('id')) \
+        .filter(count__gt=1)
+    for duplicate in duplicates:
+        File.objects.filter(directory=duplicate['directory'], relative_path=duplicate['relative_path']) \
+            .exclude(id=duplicate['first']).delete()
+
+
+def create_search_triggers(apps, schema_editor):
+    # Adding the constraint remakes viewer_file on SQLite, dropping its triggers
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or 'viewer_file_search' not in connection.introspection.table_names():
+        return
+    for trigger in ('insert', 'delete', 'update'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS viewer_file_search_{trigger}')
+    for statement in SQLITE_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0016_file_search'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='file',
+            name='viewer_file_directo_c5c711_idx',
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='refreshLeaseExpires',
+            field=models.DateTimeField(default=None, null=True, verbose_name='Running Refresh Lease Expiry'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='refresh_requested',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Not Requested'), (1, 'Requested'), (2, 'Full Requested')], default=0, verbose_name='Refresh Requested While Running'),
+        ),
+        migrations.RunPython(remove_duplicate_files, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='file',
+            constraint=models.UniqueConstraint(fields=('directory', 'relative_path'), name='unique_file_path'),
+        ),
+        migrations.RunPython(create_search_triggers, create_search_triggers),
+    ]
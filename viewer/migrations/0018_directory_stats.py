@@ -0,0 +1,70 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:55
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def count_files(apps, schema_editor):
+    """Fills in the aggregates of every existing directory, as `ServedDirectory.update_stats` does."""
+    ServedDirectory = apps.get_model('viewer', 'ServedDirectory')
+    File = apps.get_model('viewer', 'File')
+    fields = {'image': 'image_count', 'video': 'video_count'}
+
+    totals = {}
+    for row in File.objects.values('directory', 'mediatype').annotate(count=Count('id'), size=Sum('size'),
+                                                                      thumbnails=Count('thumbnail')):
+        directory = totals.setdefault(row['directory'], dict.fromkeys(
+            ['file_count', 'total_size', 'image_count', 'video_count', 'other_count', 'thumbnail_count'], 0))
+        directory['file_count'] += row['count']
+        directory['total_size'] += row['size'] or 0
+        directory[fields.get(row['mediatype'], 'other_count')] += row['count']
+        directory['thumbnail_count'] += row['thumbnails']
+
+    for directory_id, values in totals.items():
+        ServedDirectory.objects.filter(id=directory_id).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0017_refresh_leases'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number Of Files'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number Of Images'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='lastRefreshDuration',
+            field=models.FloatField(default=None, null=True, verbose_name='Last Refresh Duration (s)'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='other_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number Of Other Files'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='thumbnail_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number Of Files With Thumbnails'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='total_size',
+            field=models.BigIntegerField(default=0, verbose_name='Total Size In Bytes'),
+        ),
+        migrations.AddField(
+            model_name='serveddirectory',
+            name='video_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number Of Videos'),
+        ),
+        migrations.RunPython(count_files, migrations.RunPython.noop),
+    ]
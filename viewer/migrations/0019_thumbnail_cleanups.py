@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 07:58
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0018_directory_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailCleanup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=260, verbose_name='Deleted Directory Path')),
+                ('keys', jsonfield.fields.JSONField(default=list, verbose_name='Thumbnail Keys')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Number Of Thumbnails')),
+                ('done', models.PositiveIntegerField(default=0, verbose_name='Thumbnails Checked')),
+                ('reclaimed', models.BigIntegerField(default=0, verbose_name='Bytes Reclaimed')),
+                ('finished', models.DateTimeField(default=None, null=True)),
+                ('lastModified', models.DateTimeField(auto_now=True)),
+                ('initialCreation', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-18 08:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def seed_probes(apps, schema_editor):
+    """Seeds the cache with the source resolution stored alongside every existing thumbnail."""
+    MediaProbe = apps.get_model('viewer', 'MediaProbe')
+    Thumbnail = apps.get_model('viewer', 'Thumbnail')
+    MediaProbe.objects.bulk_create([
+        MediaProbe(key=key, width=width, height=height)
+        for key, width, height in Thumbnail.objects.filter(source_width__isnull=False, source_height__isnull=False)
+        .values_list('key', 'source_width', 'source_height').iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0019_thumbnail_cleanups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaProbe',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Identity Hash')),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('duration', models.FloatField(default=None, null=True, verbose_name='Duration In Seconds')),
+                ('frame_count', models.PositiveIntegerField(default=None, null=True)),
+                ('codec', models.CharField(blank=True, default='', max_length=16)),
+                ('lastUsed', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(seed_probes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0020_media_probes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='directoryevent',
+            name='kind',
+            field=models.CharField(choices=[('changed', 'Changed'), ('removed', 'Removed'), ('reload', 'Reload')], max_length=10, verbose_name='Event Kind'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0021_directory_event_reload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnailjob',
+            name='leaseExpires',
+            field=models.DateTimeField(default=None, null=True, verbose_name='Running Lease Expiry'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.1.14 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+# Copied from 0016_file_search rather than imported from viewer.search, so that this migration never changes
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER viewer_file_search_insert AFTER INSERT ON viewer_file BEGIN
+        INSERT INTO viewer_file_search(rowid, path) VALUES (new.id, new.path);
+    END""",
+    """CREATE TRIGGER viewer_file_search_delete AFTER DELETE ON viewer_file BEGIN
+        INSERT INTO viewer_file_search(viewer_file_search, rowid, path) VALUES ('delete', old.id, old.path);
+    END""",
+    """CREATE TRIGGER viewer_file_search_update AFTER UPDATE OF path ON viewer_file WHEN old.path IS NOT new.path BEGIN
+        INSERT INTO viewer_file_search(viewer_file_search, rowid, path) VALUES ('delete', old.id, old.path);
+        INSERT INTO viewer_file_search(rowid, path) VALUES (new.id, new.path);
+    END""",
+]
+
+
+def create_search_triggers(apps, schema_editor):
+    # Altering the fields remakes viewer_file on SQLite, dropping its triggers
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or 'viewer_file_search' not in connection.introspection.table_names():
+        return
+    for trigger in ('insert', 'delete', 'update'):
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS viewer_file_search_{trigger}')
+    for statement in SQLITE_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewer', '0022_thumbnail_job_leases'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='height',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='size',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='width',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(create_search_triggers, create_search_triggers),
+    ]
@@ -1,96 +1,793 @@
+import hashlib
+import logging
 import mimetypes
 import os
-import traceback
+import posixpath
+import stat as stat_module
+import time
 import uuid
-from datetime import datetime
-from typing import Tuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as datetime_timezone
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import humanize
 import jsonfield
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Greatest
 from django.urls import reverse
-from dateutil.tz import tzlocal
 from django.utils import timezone
+from django.utils._os import safe_join
 
-from viewer import helpers
+from viewer import helpers, metrics
+
+logger = logging.getLogger(__name__)
+
+THUMBNAILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'thumbnails')
 
 try:
-    os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'thumbnails'))
+    os.makedirs(THUMBNAILS_DIR)
 except FileExistsError:
     pass
 
+# Compiled filters for each ServedDirectory, alongside the scan options they were compiled from
+_filters: Dict[uuid.UUID, Tuple[str, helpers.FileFilter]] = {}
+
+# When this process last pruned old directory events
+_last_pruned = 0.0
+
+# Removes the thumbnails of deleted directories in the background, one cleanup at a time
+_cleanup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnail-cleanup')
+
+
+@contextmanager
+def write_transaction():
+    """
+    An atomic block which holds the database's write lock from the start.
+
+    SQLite transactions only ask for the write lock on their first write. One which has read anything by then (as the
+    triggers keeping the search index in sync do) and finds another connection writing fails with 'database is locked'
+    straight away, rather than waiting for the other to finish, so a write matching nothing is made first.
+    """
+    with transaction.atomic():
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {DirectoryEvent._meta.db_table} WHERE 0')
+        yield
+
 
 class ServedDirectory(models.Model):
     """
     A reference to a specific directory on the host machine for hosting files.
 
-    A regex pattern is stored for filtering files in the directory down to what is intended.
+    Regex patterns are stored for filtering files in the directory down to what is intended, one pattern per line.
+    A file must match at least one include pattern (if any are given) and none of the exclude patterns.
     A recursive option is also stored, in case the user wishes to serve files in directories below the one specified.
-    The regex pattern can be turned on or off using the boolean field.
-    The regex pattern can be matched against the file path (False), or just the filename (True).
+    The regex patterns can be turned on or off using the boolean field.
+    The regex patterns can be matched against the file path (False), or just the filename (True).
+    An extension allowlist can additionally be given, which is checked without any regex at all.
     """
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
     path = models.CharField('Directory Path', max_length=260)
 
     recursive = models.BooleanField('Files Are Matched Recursively', default=False)
-    regex_pattern = models.CharField('RegEx Matching Pattern', max_length=100, default='')
+    regex_pattern = models.TextField('RegEx Include Patterns', blank=True, default='')
+    exclude_pattern = models.TextField('RegEx Exclude Patterns', blank=True, default='')
+    extensions = models.CharField('Allowed File Extensions', max_length=200, blank=True, default='')
     regex = models.BooleanField('Directory RegEx Option', default=False)
     match_filename = models.BooleanField('RegEx Matches Against Filename', default=True)
     known_subdirectories = jsonfield.JSONField('Tracked Subdirectories JSON', default=[])
+    scan_options = models.CharField('Options Used For Last Scan', max_length=300, default='')
+
+    # Refreshes requested while another was running, which the running refresh performs once it is done
+    NOT_REQUESTED, REQUESTED, FULL_REQUESTED = 0, 1, 2
+    REQUEST_CHOICES = [(NOT_REQUESTED, 'Not Requested'), (REQUESTED, 'Requested'), (FULL_REQUESTED, 'Full Requested')]
+
+    refreshLeaseExpires = models.DateTimeField('Running Refresh Lease Expiry', null=True, default=None)
+    refresh_requested = models.PositiveSmallIntegerField('Refresh Requested While Running', choices=REQUEST_CHOICES,
+                                                         default=NOT_REQUESTED)
+
+    # Aggregates over this directory's Files, kept up to date as they are written so that listings never count rows
+    file_count = models.PositiveIntegerField('Number Of Files', default=0)
+    total_size = models.BigIntegerField('Total Size In Bytes', default=0)
+    image_count = models.PositiveIntegerField('Number Of Images', default=0)
+    video_count = models.PositiveIntegerField('Number Of Videos', default=0)
+    other_count = models.PositiveIntegerField('Number Of Other Files', default=0)
+    thumbnail_count = models.PositiveIntegerField('Number Of Files With Thumbnails', default=0)
+    lastRefreshDuration = models.FloatField('Last Refresh Duration (s)', null=True, default=None)
+
+    STAT_FIELDS = ['file_count', 'total_size', 'image_count', 'video_count', 'other_count', 'thumbnail_count']
 
     lastModified = models.DateTimeField(auto_now=True)
     lastRefreshed = models.DateTimeField(default=timezone.now)
     initialCreation = models.DateTimeField(auto_now_add=True)
 
-    def refresh(self):
-        """Refresh the directory listing to see if any new files have appeared and add them to the list."""
-        # TODO: Implement separate recursive file matching implementation
-        # TODO: Implement RegEx filtering step
-        directories = []
-        filenames = os.listdir(self.path)
-
-        for i, filename in enumerate(filenames):
-            file_path = os.path.join(self.path, filename)
-
-            if os.path.isfile(file_path):
-                # Check if the file has been entered before
-                file: File
-                file = self.files.filter(filename__exact=filename).first()
-
-                if file is None:
-                    # create the file entry
-                    file = File.create(full_path=file_path, parent=self)
-                    file.save()
-                else:
-                    file.refresh()
-            else:
-                # directory found, remember it
-                directories.append(file_path)
+    def refresh(self, full: bool = False) -> 'RefreshResult':
+        """
+        Refresh the directory listing (see `scan`), unless another refresh of this directory is already running.
+
+        A refresh holds a lease on its directory, taken with a conditional update so that it is exclusive across
+        threads and processes. Overlapping refreshes are coalesced: rather than scanning the same directory twice at
+        once, a refresh that finds the lease taken asks the running one to scan once more when it is done, and returns
+        straight away. The lease expires after REFRESH_LEASE_TIMEOUT in case its holder died, and is renewed while the
+        directory is being scanned (see `renew_lease`) so that long scans are not taken over.
+
+        :param full: Scan every directory, even those that appear unchanged.
+        :return: The combined result of every scan made, or a result marked `coalesced` if the refresh was handed off.
+        :raises ServedDirectory.DoesNotExist: If the directory has been deleted.
+        """
+        directories = ServedDirectory.objects.filter(id=self.id)
+        request = ServedDirectory.FULL_REQUESTED if full else ServedDirectory.REQUESTED
+        while True:
+            now = timezone.now()
+            if directories.filter(Q(refreshLeaseExpires__isnull=True) | Q(refreshLeaseExpires__lt=now)).update(
+                    refreshLeaseExpires=now + timedelta(seconds=settings.REFRESH_LEASE_TIMEOUT),
+                    refresh_requested=ServedDirectory.NOT_REQUESTED):
+                break
+            # Only handed off while the lease is still held, otherwise it is taken over on the next attempt
+            if directories.filter(refreshLeaseExpires__gte=now).update(
+                    refresh_requested=Greatest('refresh_requested', request)):
+                result = RefreshResult()
+                result.coalesced = True
+                logger.info(f'Refresh of {self.path} coalesced into the one already running')
+                return result
+            # Neither update matched, either because the lease expired in between or because the directory is gone
+            if not directories.exists():
+                raise ServedDirectory.DoesNotExist(f'{self.path} was deleted before it could be refreshed')
+
+        result = RefreshResult()
+        try:
+            while True:
+                kind = 'full' if full else 'incremental'
+                with metrics.measure('refresh', kind=kind):
+                    scanned = self.scan(full)
+                metrics.record_refresh(scanned, kind=kind)
+                result.add(scanned)
+                # Let go of the lease, unless another refresh was requested in the meantime
+                if directories.filter(refresh_requested=ServedDirectory.NOT_REQUESTED) \
+                        .update(refreshLeaseExpires=None):
+                    break
+                requested = directories.values_list('refresh_requested', flat=True).first()
+                if requested is None:
+                    # Deleted while it was being scanned, leaving nothing to release or rescan
+                    break
+                full = requested == ServedDirectory.FULL_REQUESTED
+                expires = timezone.now() + timedelta(seconds=settings.REFRESH_LEASE_TIMEOUT)
+                directories.update(refresh_requested=ServedDirectory.NOT_REQUESTED, refreshLeaseExpires=expires)
+        except BaseException:
+            directories.update(refreshLeaseExpires=None)
+            raise
+        return result
+
+    @staticmethod
+    def refresh_many(directories: Iterable['ServedDirectory'], workers: int = settings.REFRESH_THREADS,
+                     full: bool = False) -> List[Tuple['ServedDirectory', 'RefreshResult', Optional[Exception]]]:
+        """
+        Refreshes several directories at once on a pool of threads, as scanning is mostly spent waiting on the disk.
+
+        :return: Each directory alongside its result, and the error that stopped its refresh if there was one.
+        """
+
+        def refresh(directory: ServedDirectory) -> Tuple[ServedDirectory, RefreshResult, Optional[Exception]]:
+            start = time.perf_counter()
+            try:
+                return directory, directory.refresh(full), None
+            except Exception as e:
+                logger.exception(f'Could not refresh {directory.path}')
+                result = RefreshResult()
+                result.elapsed = time.perf_counter() - start
+                return directory, result, e
+            finally:
+                # Every thread has its own connection, which would otherwise be left open
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refresh') as pool:
+            return list(pool.map(refresh, directories))
+
+    def renew_lease(self) -> None:
+        """Extends the lease held by the refresh running on this directory, which is still scanning it."""
+        ServedDirectory.objects.filter(id=self.id, refreshLeaseExpires__isnull=False).update(
+            refreshLeaseExpires=timezone.now() + timedelta(seconds=settings.REFRESH_LEASE_TIMEOUT))
+
+    def scan(self, full: bool = False) -> 'RefreshResult':
+        """
+        Refresh the directory listing to see if any new files have appeared and add them to the list.
+
+        Each directory is read once with os.scandir and every entry is run through the directory's filter before it is
+        stat-ed, reusing the stat information cached on the entry, and compared against every known File row (loaded
+        in a single query). Files that no longer match the filter are removed along with those missing from disk.
+        When matching recursively, every subdirectory's modification time is remembered so that directories whose
+        direct contents have not changed since the last refresh are skipped without listing or stat-ing their files.
+        New, changed and missing files are then written in bulk inside one transaction, and thumbnail jobs are queued
+        for any media that needs them. A file that disappeared and reappeared under another name with the same
+        identity is treated as moved, keeping its row and thumbnail.
+
+        Note that editing a file in place does not touch its directory's modification time, so pass `full` to
+        re-examine every file regardless.
+
+        :param full: Scan every directory, even those that appear unchanged.
+        """
+        result = RefreshResult()
+        start = time.perf_counter()
+        now = timezone.now()
+
+        # Anything that changes which files are matched invalidates the remembered directory state
+        scan_options = self.get_scan_options()
+        if scan_options != self.scan_options:
+            full = True
+        file_filter = self.get_filter()
+
+        existing: Dict[str, File] = {file.relative_path: file for file in self.files.only(*File.REFRESH_FIELDS)}
+        files_by_parent = defaultdict(list)
+        for relative_path in existing:
+            files_by_parent[posixpath.dirname(relative_path)].append(relative_path)
+
+        known: Dict[str, IndexedDirectory] = {record.relative_path: record for record in self.indexed_directories.all()}
+        children_by_parent = defaultdict(list)
+        for relative_path in known:
+            if relative_path:
+                children_by_parent[posixpath.dirname(relative_path)].append(relative_path)
+
+        created: List[File] = []
+        created_stats: List[os.stat_result] = []
+        updated: List[File] = []
+        updated_stats: List[os.stat_result] = []
+        released_thumbnails: List[str] = []
+        scanned: List[IndexedDirectory] = []
+        visited = set()
+        directories = None
+        # The lease is renewed a few times over before it would expire
+        renew_interval = settings.REFRESH_LEASE_TIMEOUT / 3
+        next_renewal = start + renew_interval
+
+        # Directories still to be visited, alongside a stat result if one is already known
+        stack: List[Tuple[str, Optional[os.stat_result]]] = [('', None)]
+        while stack:
+            if time.perf_counter() >= next_renewal:
+                self.renew_lease()
+                next_renewal = time.perf_counter() + renew_interval
+            relative_dir, stat = stack.pop()
+            absolute_dir = os.path.join(self.path, relative_dir)
+            try:
+                stat = stat or os.stat(absolute_dir)
+            except FileNotFoundError:
+                continue
+            visited.add(relative_dir)
+
+            record = known.get(relative_dir)
+            if not full and record is not None and record.mtime == stat.st_mtime_ns:
+                # Nothing was added, removed or renamed directly inside this directory
+                result.pruned += 1
+                for relative_path in files_by_parent.pop(relative_dir, []):
+                    del existing[relative_path]
+                    result.unchanged += 1
+                stack.extend((child, None) for child in children_by_parent[relative_dir])
+                continue
+
+            if record is None:
+                record = IndexedDirectory(directory=self, relative_path=relative_dir)
+            record.mtime = stat.st_mtime_ns
+            scanned.append(record)
+
+            subdirectories = []
+            with os.scandir(absolute_dir) as entries:
+                for entry in entries:
+                    relative_path = posixpath.join(relative_dir, entry.name) if relative_dir else entry.name
+                    if entry.is_dir():
+                        # directory found, remember it
+                        subdirectories.append(entry.path)
+                        if self.recursive:
+                            stack.append((relative_path, entry.stat()))
+                        continue
+                    elif not entry.is_file():
+                        continue
+                    elif not file_filter.matches(entry.name, entry.path):
+                        result.filtered += 1
+                        continue
+
+                    file, stat = existing.pop(relative_path, None), entry.stat()
+                    if file is None:
+                        file = File(
+                            path=entry.path,
+                            relative_path=relative_path,
+                            filename=entry.name,
+                            mediatype=File.guess_mediatype(entry.name),
+                            directory=self,
+                            lastRefreshed=now
+                        )
+                        file.apply_stat(stat)
+                        created.append(file)
+                        created_stats.append(stat)
+                    elif file.apply_stat(stat):
+                        # Changed media must be thumbnailed again, forget the old thumbnail
+                        if file.thumbnail_id:
+                            released_thumbnails.append(file.thumbnail_id)
+                            file.thumbnail = None
+                        file.lastRefreshed = now
+                        file.lastModified = now
+                        updated.append(file)
+                        updated_stats.append(stat)
+                    else:
+                        result.unchanged += 1
+
+            if not relative_dir:
+                directories = subdirectories
+
+        # Anything left over was not found on disk anymore, nor were directories that were not visited
+        removed = list(existing.values())
+        moved = self.pair_moves(created, created_stats, removed, now)
+        released_thumbnails.extend(file.thumbnail_id for file in removed if file.thumbnail_id)
+        self.apply_probes(created + updated, created_stats + updated_stats, result)
+        vanished = [record.id for relative_path, record in known.items() if relative_path not in visited]
+
+        with write_transaction():
+            self.save_files(created, updated, moved, removed)
+
+            IndexedDirectory.objects.bulk_create([record for record in scanned if record.id is None])
+            IndexedDirectory.objects.bulk_update([record for record in scanned if record.id is not None], ['mtime'])
+            for chunk in helpers.chunked(vanished, 500):
+                IndexedDirectory.objects.filter(id__in=chunk).delete()
+
+            # Dump subdirectories found, unless the top directory was skipped and they are already known
+            if directories is not None:
+                self.known_subdirectories = directories
+            # Incremental updates can drift when Files are written behind their back, a full scan counts afresh
+            if full:
+                self.update_stats()
+            self.scan_options = scan_options
+            self.lastRefreshed = now
+            self.lastRefreshDuration = time.perf_counter() - start
+            # The refresh lease and aggregates are only ever changed through updates of their own
+            self.save(update_fields=['known_subdirectories', 'scan_options', 'lastRefreshed', 'lastRefreshDuration',
+                                     'lastModified'])
+
+        self.queue_thumbnails(updated, released_thumbnails)
 
-        # Dump subdirectories found
-        self.known_subdirectories = directories
-        self.save()
+        result.added, result.updated, result.moved, result.removed = len(created), len(updated), len(moved), \
+            len(removed)
+        result.elapsed = time.perf_counter() - start
+        logger.info(f'Refreshed {self.path}: {result}')
+        return result
+
+    def apply_changes(self, changed: Iterable[str], moves: Iterable[Tuple[str, str]] = ()) -> 'RefreshResult':
+        """
+        Applies a batch of changes reported by a filesystem watcher, touching only the given paths rather than
+        rescanning the whole directory.
+
+        Moves are applied first and in order, renaming the affected rows in place so that they keep their id and
+        thumbnail. Every changed path (and both ends of every move) is then compared against the disk: files are added,
+        updated or removed, directories are scanned for files and anything below a missing path is removed. Changes
+        are written in bulk inside one transaction, as with a full refresh.
+
+        :param changed: Paths relative to this directory that were created, modified or deleted.
+        :param moves: Pairs of relative paths, for files or directories renamed within this directory.
+        """
+        result = RefreshResult()
+        start = time.perf_counter()
+        now = timezone.now()
+        file_filter = self.get_filter()
+        changed, moves = set(changed), list(moves)
+        changed.update(path for move in moves for path in move)
+        if not self.recursive:
+            changed = {relative_path for relative_path in changed if '/' not in relative_path}
+
+        # Every regular file at or below a changed path, as it is now on disk
+        found: Dict[str, os.stat_result] = {}
+        for relative_path in changed:
+            stack = [relative_path]
+            while stack:
+                current = stack.pop()
+                absolute_path = os.path.join(self.path, current)
+                try:
+                    stat = os.stat(absolute_path)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                if stat_module.S_ISREG(stat.st_mode):
+                    if file_filter.matches(posixpath.basename(current), absolute_path):
+                        found[current] = stat
+                    else:
+                        result.filtered += 1
+                elif stat_module.S_ISDIR(stat.st_mode) and (self.recursive or not current):
+                    with os.scandir(absolute_path) as entries:
+                        stack.extend(posixpath.join(current, entry.name) for entry in entries)
+
+        # Only paths that are not regular files could have had files below them
+        rows: Dict[str, File] = {file.relative_path: file for file in self.files_at(
+            [path for path in changed if path not in found], prefix=True)}
+        rows.update((file.relative_path, file) for file in self.files_at(list(found)))
+
+        moved: Dict[int, File] = {}
+        removed: Dict[int, File] = {}
+        for source, destination in moves:
+            # A rename replaces whatever file was at the destination
+            replaced = rows.pop(destination, None)
+            if replaced is not None:
+                removed[replaced.id] = replaced
+                moved.pop(replaced.id, None)
+
+            prefix = source + '/'
+            for relative_path in [source] if source in rows else [path for path in rows if path.startswith(prefix)]:
+                file = rows.pop(relative_path)
+                file.rename(destination + relative_path[len(source):], self)
+                file.lastRefreshed = file.lastModified = now
+                rows[file.relative_path] = file
+                moved[file.id] = file
+
+        created: List[File] = []
+        created_stats: List[os.stat_result] = []
+        updated: List[File] = []
+        updated_stats: List[os.stat_result] = []
+        released_thumbnails: List[str] = []
+        for relative_path, file in rows.items():
+            stat = found.pop(relative_path, None)
+            if stat is None:
+                removed[file.id] = file
+                moved.pop(file.id, None)
+            elif file.apply_stat(stat):
+                if file.thumbnail_id:
+                    released_thumbnails.append(file.thumbnail_id)
+                    file.thumbnail = None
+                file.lastRefreshed = file.lastModified = now
+                updated.append(file)
+                updated_stats.append(stat)
+            elif file.id not in moved:
+                result.unchanged += 1
+
+        for relative_path, stat in found.items():
+            file = File(
+                path=os.path.join(self.path, relative_path),
+                relative_path=relative_path,
+                filename=posixpath.basename(relative_path),
+                mediatype=File.guess_mediatype(relative_path),
+                directory=self,
+                lastRefreshed=now
+            )
+            file.apply_stat(stat)
+            created.append(file)
+            created_stats.append(stat)
+
+        # Moves whose halves arrived in separate batches are recognised by the file's identity instead
+        removed = list(removed.values())
+        moved = list(moved.values()) + self.pair_moves(created, created_stats, removed, now)
+        released_thumbnails.extend(file.thumbnail_id for file in removed if file.thumbnail_id)
+        self.apply_probes(created + updated, created_stats + updated_stats, result)
+
+        with write_transaction():
+            self.save_files(created, updated, moved, removed)
+        self.queue_thumbnails(updated, released_thumbnails)
+
+        result.added, result.updated, result.moved, result.removed = len(created), len(updated), len(moved), \
+            len(removed)
+        result.elapsed = time.perf_counter() - start
+        logger.info(f'Applied changes to {self.path}: {result}')
+        return result
+
+    def files_at(self, paths: List[str], prefix: bool = False) -> Iterable['File']:
+        """
+        Loads the Files at the given relative paths, with only the columns needed to compare them against the disk.
+
+        :param prefix: Also load every File below the paths, for paths which may be directories.
+        """
+        files = self.files.only(*File.REFRESH_FIELDS)
+        # Kept small, as each path is its own LIKE clause when matching prefixes
+        for chunk in helpers.chunked(paths, 100 if prefix else 500):
+            condition = Q(relative_path__in=chunk)
+            if prefix:
+                for path in chunk:
+                    condition |= Q(relative_path__startswith=f'{path}/' if path else '')
+            yield from files.filter(condition)
+
+    @staticmethod
+    def pair_moves(created: List['File'], created_stats: List[os.stat_result], removed: List['File'],
+                   now: datetime) -> List['File']:
+        """
+        Matches new files against removed ones sharing the same identity, which can only be the same file moved.
+        The removed File is renamed in place to keep its id and thumbnail, and all three lists are trimmed to match.
+
+        :return: The renamed Files.
+        """
+        candidates = {file.thumbnail_id: file for file in removed if file.thumbnail_id}
+        if not candidates:
+            return []
+
+        moved, remaining, remaining_stats = [], [], []
+        for file, stat in zip(created, created_stats):
+            source = candidates.pop(helpers.file_identity(stat), None)
+            if source is None:
+                remaining.append(file)
+                remaining_stats.append(stat)
+                continue
+            source.rename(file.relative_path, file.directory)
+            source.apply_stat(stat)
+            source.lastRefreshed = source.lastModified = now
+            moved.append(source)
+
+        moved_ids = {file.id for file in moved}
+        created[:] = remaining
+        created_stats[:] = remaining_stats
+        removed[:] = [file for file in removed if file.id not in moved_ids]
+        return moved
+
+    @staticmethod
+    def apply_probes(files: List['File'], stats: List[os.stat_result], result: 'RefreshResult') -> None:
+        """
+        Fills in the metadata of new and changed media from the probe cache, without opening any of them.
+        Media whose identity already has a thumbnail adopts it right away, rather than waiting on a thumbnail job.
+        The lookups are counted on the result as probe cache hits and misses.
+        """
+        media = [(file, helpers.file_identity(stat)) for file, stat in zip(files, stats)
+                 if file.mediatype in File.THUMBNAIL_MEDIATYPES]
+        if not media:
+            return
+        probes = MediaProbe.lookup(key for _, key in media)
+        thumbnails: Dict[str, Thumbnail] = {}
+        for chunk in helpers.chunked(list(probes), 500):
+            thumbnails.update((thumbnail.key, thumbnail) for thumbnail in Thumbnail.objects.filter(key__in=chunk))
+
+        for file, key in media:
+            probe = probes.get(key)
+            if probe is None:
+                result.probe_misses += 1
+                continue
+            result.probe_hits += 1
+            file.width, file.height = probe.width, probe.height
+            thumbnail = thumbnails.get(key)
+            if thumbnail is not None:
+                file.thumbnail = thumbnail
+                file.thumbnail_width, file.thumbnail_height = thumbnail.width, thumbnail.height
+        Thumbnail.touch(thumbnails.keys())
+
+    def save_files(self, created: List['File'], updated: List['File'], moved: List['File'],
+                   removed: List['File']) -> None:
+        """
+        Writes the Files found by a refresh in bulk and reports them to open pages, inside a transaction.
+        The directory's aggregates are adjusted by the difference between the changed rows before and after. New Files
+        whose path has been indexed since they were found are left out of `created`, as they are already written.
+        """
+        changed_ids = [file.id for file in updated + moved + removed]
+        before = ServedDirectory.tally(file for chunk in helpers.chunked(changed_ids, 500)
+                                       for file in File.objects.filter(id__in=chunk).only('size', 'mediatype',
+                                                                                           'thumbnail'))
+
+        # Removed first, as a file may have been moved onto the path of one replaced by the move
+        for chunk in helpers.chunked([file.id for file in removed], 500):
+            File.objects.filter(id__in=chunk).delete()
+        # A file added by the watcher while this directory was being refreshed is already there, and already counted
+        existing = {path for chunk in helpers.chunked([file.relative_path for file in created], 500)
+                    for path in self.files.filter(relative_path__in=chunk).values_list('relative_path', flat=True)}
+        created[:] = [file for file in created if file.relative_path not in existing]
+        File.objects.bulk_create(created)
+        File.objects.bulk_update(updated, ['size', 'fileLastModified', 'thumbnail', 'width', 'height',
+                                           'thumbnail_width', 'thumbnail_height', 'lastRefreshed', 'lastModified'])
+        File.objects.bulk_update(moved, ['path', 'relative_path', 'filename', 'mediatype', 'size', 'fileLastModified',
+                                         'lastRefreshed', 'lastModified'])
+
+        DirectoryEvent.emit(self.id, changed=[file.relative_path for file in created + updated + moved],
+                            removed=[file.id for file in removed])
+
+        after = ServedDirectory.tally(created + updated + moved)
+        ServedDirectory.add_stats(self.id, {field: after[field] - before[field]
+                                            for field in ServedDirectory.STAT_FIELDS})
+
+    @staticmethod
+    def tally(files: Iterable['File']) -> Dict[str, int]:
+        """Adds up what the given Files contribute to each of their directory's aggregates."""
+        totals = dict.fromkeys(ServedDirectory.STAT_FIELDS, 0)
+        for file in files:
+            totals['file_count'] += 1
+            totals['total_size'] += file.size or 0
+            totals[ServedDirectory.mediatype_field(file.mediatype)] += 1
+            if file.thumbnail_id:
+                totals['thumbnail_count'] += 1
+        return totals
+
+    @staticmethod
+    def mediatype_field(mediatype: str) -> str:
+        """The aggregate counting Files of the given mediatype."""
+        return {'image': 'image_count', 'video': 'video_count'}.get(mediatype, 'other_count')
+
+    @staticmethod
+    def add_stats(directory_id: uuid.UUID, changes: Dict[str, int]) -> None:
+        """Adjusts a directory's aggregates in a single UPDATE, so that concurrent changes are not lost."""
+        changes = {field: F(field) + change for field, change in changes.items() if change}
+        if changes:
+            ServedDirectory.objects.filter(id=directory_id).update(**changes, lastModified=timezone.now())
+
+    @staticmethod
+    def mark_changed(directory_id: uuid.UUID) -> None:
+        """
+        Marks a directory's listing as changed by bumping its lastModified, which the cached listings of every server
+        process are keyed on (see `views.cached_listing`).
+        """
+        ServedDirectory.objects.filter(id=directory_id).update(lastModified=timezone.now())
+
+    def update_stats(self) -> None:
+        """Recounts every aggregate from this directory's Files."""
+        totals = dict.fromkeys(ServedDirectory.STAT_FIELDS, 0)
+        for row in self.files.values('mediatype').annotate(count=Count('id'), size=Sum('size'),
+                                                           thumbnails=Count('thumbnail')):
+            totals['file_count'] += row['count']
+            totals['total_size'] += row['size'] or 0
+            totals[ServedDirectory.mediatype_field(row['mediatype'])] += row['count']
+            totals['thumbnail_count'] += row['thumbnails']
+        self.lastModified = timezone.now()
+        ServedDirectory.objects.filter(id=self.id).update(**totals, lastModified=self.lastModified)
+        for field, value in totals.items():
+            setattr(self, field, value)
+
+    def queue_thumbnails(self, updated: List['File'], released_thumbnails: List[str]) -> None:
+        """Releases the thumbnails of changed and removed Files, then queues thumbnails for any media without one."""
+        # Thumbnails are shared between directories, so only those no longer used anywhere are removed
+        Thumbnail.release(released_thumbnails)
+
+        # New and changed media are left without a thumbnail, permanently failed jobs are only retried on change and
+        # jobs still waiting on the worker are left alone
+        pending = self.files.filter(mediatype__in=File.THUMBNAIL_MEDIATYPES, thumbnail__isnull=True) \
+            .exclude(thumbnail_job__status__in=[ThumbnailJob.FAILED, ThumbnailJob.QUEUED, ThumbnailJob.RUNNING]) \
+            .values_list('id', flat=True)
+        ThumbnailJob.enqueue(list(pending) + [file.id for file in updated if not file.thumbnail_id
+                                              and file.mediatype in File.THUMBNAIL_MEDIATYPES])
+
+    def resolve(self, relative_path: str) -> Optional[str]:
+        """
+        Resolves a path relative to this directory into an absolute path, as long as it stays within the directory.
+        Paths below subdirectories are allowed even when files are not matched recursively, as every subdirectory can
+        be browsed into (see `scan_subdirectory`).
+        """
+        try:
+            return safe_join(self.path, relative_path)
+        except SuspiciousFileOperation:
+            return None
+
+    def resolve_directory(self, relative_path: str) -> Optional[str]:
+        """Resolves a subdirectory of this directory into an absolute path, or None if it is outside or missing."""
+        path = self.resolve(relative_path)
+        return path if path is not None and os.path.isdir(path) else None
+
+    def indexes(self, relative_path: str) -> bool:
+        """Whether the Files in a subdirectory are indexed, rather than scanned on demand when browsed."""
+        return self.recursive or not relative_path
+
+    def scan_subdirectory(self, relative_path: str, files: bool = True) -> Tuple[List[str], List['File']]:
+        """
+        Lists a single subdirectory as it is on disk without indexing anything, so that large hierarchies can be
+        explored one level at a time.
+
+        :param relative_path: The subdirectory, relative to this directory.
+        :param files: Whether to list the files matching the filter as well, or only the child directories.
+        :return: The names of the child directories, and an unsaved File for each file found.
+        """
+        file_filter = self.get_filter()
+        directories, found = [], []
+        with os.scandir(os.path.join(self.path, relative_path)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.name)
+                elif files and entry.is_file() and file_filter.matches(entry.name, entry.path):
+                    file = File(path=entry.path, relative_path=posixpath.join(relative_path, entry.name),
+                                filename=entry.name, mediatype=File.guess_mediatype(entry.name), directory=self)
+                    file.apply_stat(entry.stat())
+                    found.append(file)
+        return sorted(directories, key=str.lower), found
+
+    def get_scan_options(self) -> str:
+        """A digest of every option affecting which files a refresh will match."""
+        options = '\0'.join(map(str, (self.recursive, self.regex, self.regex_pattern, self.exclude_pattern,
+                                      self.match_filename, self.extensions)))
+        return hashlib.sha1(options.encode()).hexdigest()
+
+    def get_filter(self) -> helpers.FileFilter:
+        """
+        Retrieves the compiled filter for this directory, compiling it only when the options have changed.
+
+        :raises re.error: If any of the patterns are invalid.
+        """
+        options = self.get_scan_options()
+        cached = _filters.get(self.id)
+        if cached is None or cached[0] != options:
+            cached = options, helpers.FileFilter(
+                include=self.regex_pattern.splitlines() if self.regex else (),
+                exclude=self.exclude_pattern.splitlines() if self.regex else (),
+                extensions=self.extensions.replace(',', ' ').split(),
+                match_filename=self.match_filename
+            )
+            _filters[self.id] = cached
+        return cached[1]
+
+    def remove(self) -> 'ThumbnailCleanup':
+        """
+        Deletes this directory along with everything known about its files, leaving the files themselves alone.
+
+        Nothing cascades from the tables referring to this directory and its Files, so each is cleared with a single
+        statement. The Files are deleted with one statement of their own once their thumbnail jobs are gone, as Django
+        would otherwise load every one of them to look for anything left to cascade to. Thumbnails are shared with
+        other directories, so those this directory used are handed to a ThumbnailCleanup, which removes the ones no
+        longer used by anything else in the background.
+
+        :return: The cleanup, which has to be started once this has been committed.
+        """
+        keys = list(self.files.exclude(thumbnail=None).order_by().values_list('thumbnail', flat=True).distinct())
+        with write_transaction():
+            for queryset in (ThumbnailJob.objects.filter(file__directory=self), self.events.all(),
+                             self.indexed_directories.all()):
+                queryset.delete()
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {File._meta.db_table} WHERE directory_id = %s',
+                               [File._meta.get_field('directory').get_db_prep_value(self.id, connection)])
+            self.delete()
+            return ThumbnailCleanup.objects.create(path=self.path, keys=keys, total=len(keys),
+                                                   finished=None if keys else timezone.now())
+
+    @property
+    def human_size(self) -> str:
+        """The total size of every file in this directory, in a human readable form."""
+        return humanize.naturalsize(self.total_size)
+
+    @property
+    def thumbnail_coverage(self) -> Optional[int]:
+        """The percentage of images and videos with a thumbnail, or None if there are none."""
+        media = self.image_count + self.video_count
+        if media:
+            return min(100, self.thumbnail_count * 100 // media)
 
     def __str__(self) -> str:
         return self.path
 
 
-class ImageResolution(models.Model):
+class RefreshResult:
     """
-    A simple model for storing the dimensions of a specific image. A tuple, in essence.
+    A summary of the work done by a single ServedDirectory refresh, used for tracking refresh cost.
     """
 
-    x = models.PositiveIntegerField(null=True)
-    y = models.PositiveIntegerField(null=True)
+    def __init__(self):
+        self.added = 0
+        self.updated = 0
+        self.moved = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.pruned = 0
+        self.filtered = 0
+        # New and changed media whose metadata was, or was not, found in the probe cache
+        self.probe_hits = 0
+        self.probe_misses = 0
+        self.elapsed = 0.0
+        # Handed off to a refresh of the same directory that was already running
+        self.coalesced = False
 
-    def set(self, size: Tuple[int, int]) -> None:
-        """Sets the X and Y attributes"""
-        self.x, self.y = size
-        self.save()
+    def add(self, other: 'RefreshResult') -> None:
+        """Adds the counts and time of another scan onto this result."""
+        for name in ('added', 'updated', 'moved', 'removed', 'unchanged', 'pruned', 'filtered', 'probe_hits',
+                     'probe_misses', 'elapsed'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
 
     def __str__(self) -> str:
-        return f'{self.x} x {self.y}'
+        if self.coalesced:
+            return 'coalesced into a refresh already running'
+        return f'{self.added} added, {self.updated} updated, {self.moved} moved, {self.removed} removed, ' \
+               f'{self.unchanged} unchanged, {self.filtered} filtered ({self.pruned} directories skipped), ' \
+               f'{self.probe_hits} of {self.probe_hits + self.probe_misses} probes cached in {self.elapsed:.3f}s'
+
+
+class IndexedDirectory(models.Model):
+    """
+    The state of a single directory below (or at) a ServedDirectory as of its last scan.
+    The modification time is compared on each refresh to skip listing directories that have not changed.
+    """
+
+    directory = models.ForeignKey(ServedDirectory, on_delete=models.CASCADE, related_name='indexed_directories')
+    relative_path = models.CharField('Relative Path', max_length=300)
+    mtime = models.BigIntegerField('Directory Last Modified (ns)')
+
+    class Meta:
+        unique_together = [('directory', 'relative_path')]
+
+    def __str__(self) -> str:
+        return self.relative_path or '.'
 
 
 class File(models.Model):
@@ -100,82 +797,133 @@ class File(models.Model):
     """
 
     path = models.CharField('Full Filepath', max_length=300)
+    relative_path = models.CharField('Path Relative To Directory', max_length=300, default='')
     filename = models.CharField('Filename', max_length=160)
     mediatype = models.CharField('Mediatype', max_length=30)
     directory = models.ForeignKey(ServedDirectory, on_delete=models.CASCADE, related_name='files')
-    thumbnail = models.CharField('Thumbnail Filename', max_length=160, null=True, default=None)
+    thumbnail = models.ForeignKey('Thumbnail', on_delete=models.SET_NULL, related_name='files', db_column='thumbnail',
+                                  null=True, default=None)
 
     lastModified = models.DateTimeField(auto_now=True)
     initialCreation = models.DateTimeField(auto_now_add=True)
     lastRefreshed = models.DateTimeField(default=timezone.now)
 
     fileLastModified = models.DateTimeField(null=True, default=None)
-    size = models.PositiveIntegerField(null=True)
-    resolution = models.OneToOneField(ImageResolution, on_delete=models.CASCADE, related_name='file', null=True)
-    thumbnailResolution = models.OneToOneField(ImageResolution, on_delete=models.CASCADE, related_name='real_file',
-                                               null=True)
+    size = models.PositiveBigIntegerField(null=True)
+    width = models.PositiveBigIntegerField(null=True)
+    height = models.PositiveBigIntegerField(null=True)
+    thumbnail_width = models.PositiveIntegerField(null=True)
+    thumbnail_height = models.PositiveIntegerField(null=True)
 
-    @classmethod
-    def create(cls, full_path: str, parent: ServedDirectory, refresh: bool = True) -> 'File':
-        """
-        Simple shortcut for creating a File database entry with just the path.
-        Refreshes the file after creation.
+    THUMBNAIL_MEDIATYPES = ('image', 'video')
+    # Columns loaded to compare a File against the disk during a refresh, and updated along with it. The directory is
+    # needed as the related manager sets it on every File loaded, which would otherwise take a query for each
+    REFRESH_FIELDS = ('id', 'directory', 'relative_path', 'mediatype', 'size', 'fileLastModified', 'thumbnail',
+                      'width', 'height', 'thumbnail_width', 'thumbnail_height')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['directory', 'relative_path'], name='unique_file_path'),
+        ]
+        indexes = [
+            models.Index(fields=['directory', 'filename']),
+            models.Index(fields=['directory', 'fileLastModified']),
+        ]
+
+    def apply_stat(self, stat: os.stat_result) -> bool:
         """
-        file = File(
-            path=full_path,
-            filename=os.path.basename(full_path),
-            mediatype=File.get_mediatype(full_path),
-            directory=parent,
-            resolution=ImageResolution(),
-            thumbnailResolution=ImageResolution()
-        )
+        Copies the size and modification time from a stat result onto this File.
 
-        # Save references to ImageResolution objects
-        file.resolution.save()
-        file.thumbnailResolution.save()
+        :return: True if either value differs from what was previously stored.
+        """
+        # Built in UTC, as stored, which is many times cheaper than converting to the local timezone for every file
+        fileLastModified = datetime.fromtimestamp(stat.st_mtime, tz=datetime_timezone.utc)
+        updated = fileLastModified != self.fileLastModified or stat.st_size != self.size
+        self.fileLastModified, self.size = fileLastModified, stat.st_size
+        return updated
 
-        if refresh:
-            file.refresh()
-        return file
+    def rename(self, relative_path: str, directory: ServedDirectory) -> None:
+        """Points this File at a new path within its directory, without saving."""
+        self.relative_path = relative_path
+        self.path = os.path.join(directory.path, relative_path)
+        self.filename = posixpath.basename(relative_path)
+        self.mediatype = File.guess_mediatype(self.filename)
 
     def refresh(self) -> None:
-        """Refresh this file's metadata"""
-        self.lastRefreshed = timezone.now()
+        """Refresh this file's metadata, queueing a new thumbnail if the file changed or has none yet."""
+        with metrics.measure('file_refresh'):
+            self.lastRefreshed = timezone.now()
+            updated = self.apply_stat(os.stat(self.path))
 
-        fileLastModified = datetime.fromtimestamp(os.path.getmtime(self.path), tz=tzlocal())
-        updated = fileLastModified != self.fileLastModified
-        self.fileLastModified = fileLastModified
-
-        # thumbnail regeneration logic
-        if self.mediatype == 'image' or self.mediatype == 'video':
-            # if the file modification time changed, regenerate it
+            # if the file modification time changed, the old thumbnail is out of date
+            if updated and self.thumbnail_id:
+                self.delete_thumbnail()
+            self.save()
             if updated:
-                self.generate_thumbnail(regenerate=True)
-            # if the thumbnail hasn't been generated, attempt to generate it
-            elif not self.thumbnail:
-                self.generate_thumbnail()
+                ServedDirectory.mark_changed(self.directory_id)
 
-        if updated:
-            self.resolution.set(helpers.get_resolution(self.path))
-            self.thumbnailResolution.set(helpers.get_resolution(self.__thumbs_path))
-            self.size = os.path.getsize(self.path)
+            if self.mediatype in File.THUMBNAIL_MEDIATYPES and not self.thumbnail_id:
+                self.queue_thumbnail()
 
-        self.save()
+    def queue_thumbnail(self) -> None:
+        """Schedules a thumbnail to be generated for this file by the thumbnail worker."""
+        ThumbnailJob.enqueue([self.id])
+
+    def apply_thumbnail(self, thumbnail: 'Thumbnail') -> None:
+        """
+        Points this File at a generated thumbnail, copying over the resolutions read alongside it.
+
+        Only the affected columns are saved, so a File deleted while its thumbnail was being generated is not revived.
+        """
+        released = self.thumbnail_id
+        self.thumbnail = thumbnail
+        self.width, self.height = thumbnail.source_width, thumbnail.source_height
+        self.thumbnail_width, self.thumbnail_height = thumbnail.width, thumbnail.height
+
+        self.save(update_fields=['thumbnail', 'width', 'height', 'thumbnail_width', 'thumbnail_height',
+                                 'lastModified'])
+        if not released:
+            ServedDirectory.add_stats(self.directory_id, {'thumbnail_count': 1})
+        elif released != thumbnail.key:
+            Thumbnail.release([released])
+
+    def serialize(self) -> dict:
+        """A JSON serializable summary of this File, as shown in the directory listing."""
+        return {
+            'id': self.id,
+            'path': self.relative_path,
+            'url': reverse('file', args=(self.directory_id, self.relative_path)),
+            'mediatype': self.mediatype,
+            'size': self.size,
+            'human_size': self.human_size,
+            'modified': self.fileLastModified,
+            'resolution': self.resolution,
+            'thumbnail': Thumbnail.url_for(self.thumbnail_id) if self.thumbnail_id else None,
+            'thumbnail_large': Thumbnail.url_for(self.thumbnail_id, 'large') if self.thumbnail_id else None,
+            'sprite': self.thumbnail.sprite_url if self.thumbnail_id else None,
+            'sprite_frames': self.thumbnail.sprite_frames if self.thumbnail_id else 0,
+            'thumbnail_width': self.thumbnail_width,
+            'thumbnail_height': self.thumbnail_height,
+        }
 
     def get_url(self, directory: ServedDirectory) -> str:
         """Retrieve the direct URL for a given file."""
-        return reverse('file', args=(directory.id, self.filename))
+        return reverse('file', args=(directory.id, self.relative_path))
 
     def delete_thumbnail(self) -> None:
-        """Delete the thumbnail for this File if it exists and forget the filename."""
-        if self.thumbnail:
-            try:
-                os.remove(self.__thumbs_path)
-            except FileNotFoundError:
-                pass
-            finally:
-                self.thumbnail = None
-                self.save()
+        """Forget the thumbnail for this File, deleting it if no other File shares it."""
+        if self.thumbnail_id:
+            released = self.thumbnail_id
+            self.thumbnail = None
+            self.save()
+            ServedDirectory.add_stats(self.directory_id, {'thumbnail_count': -1})
+            Thumbnail.release([released])
+
+    @property
+    def resolution(self) -> Optional[str]:
+        """The resolution of the file as shown in listings, e.g. '1920 x 1080', if known."""
+        if self.width is not None:
+            return f'{self.width} x {self.height}'
 
     @property
     def human_size(self) -> str:
@@ -183,65 +931,490 @@ class File(models.Model):
         return humanize.naturalsize(self.size)
 
     @property
-    def thumbnail_static_path(self) -> str:
-        """Used for accessing the thumbnail via the static URL"""
-        return f'/thumbnails/{self.thumbnail}'
+    def thumbnail_url(self) -> str:
+        """Used for accessing the default size of the thumbnail"""
+        return Thumbnail.url_for(self.thumbnail_id)
+
+    @staticmethod
+    def guess_mediatype(filename) -> str:
+        """Media type categorization using only the filename, for files already known to exist."""
+        mimetype = mimetypes.guess_type(filename)[0]
+        if mimetype is not None:
+            if mimetype.startswith('image'):
+                return 'image'
+            elif mimetype.startswith('video'):
+                return 'video'
+        return 'file'
+
+    def __str__(self) -> str:
+        return self.filename
+
+
+class Thumbnail(models.Model):
+    """
+    A thumbnail image on disk, keyed by the identity of the file it was generated from (see `helpers.file_identity`).
+
+    Every File with the same identity shares one Thumbnail, so media served from several directories (or removed and
+    added again) is only ever thumbnailed once. The resolution of the source file is stored alongside, so that a File
+    adopting an existing thumbnail does not need to be probed either.
+
+    Each thumbnail is stored in several sizes and formats (see THUMBNAIL_SIZES and THUMBNAIL_FORMATS). The default size
+    as a JPEG, along with THUMBNAIL_EAGER_VARIANTS, is generated by the worker, and every other variant is produced on
+    first request. Videos also get a sprite sheet of frames sampled across the video, scrubbed through on hover.
+    The size in bytes covers every variant.
+
+    Thumbnails no longer referenced by any File are deleted as soon as they are released, or by the `thumbnail_gc`
+    command, and the least recently used are evicted whenever the store grows beyond THUMBNAIL_CACHE_BUDGET bytes.
+    """
+
+    key = models.CharField('Identity Hash', max_length=64, primary_key=True)
+    size = models.PositiveIntegerField('Size In Bytes', default=0)
+    # Resolution of the default size
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    source_width = models.PositiveIntegerField(null=True)
+    source_height = models.PositiveIntegerField(null=True)
+    sprite_frames = models.PositiveIntegerField('Hover Preview Frames', default=0)
+
+    lastUsed = models.DateTimeField(default=timezone.now, db_index=True)
+    initialCreation = models.DateTimeField(auto_now_add=True)
+
+    # How stale lastUsed may get before a listing bothers to update it
+    TOUCH_INTERVAL = timedelta(hours=1)
+
+    @staticmethod
+    def filename_for(key: str, size: Optional[str] = None, extension: str = 'jpeg') -> str:
+        """
+        The filename of a thumbnail variant. The default size as a JPEG is simply `<key>.jpeg`,
+        every other variant is named `<key>@<size>.<extension>`.
+        """
+        size = size or settings.THUMBNAIL_DEFAULT_SIZE
+        if size == settings.THUMBNAIL_DEFAULT_SIZE and extension == 'jpeg':
+            return f'{key}.jpeg'
+        return f'{key}@{size}.{extension}'
+
+    @staticmethod
+    def key_from_filename(filename: str) -> str:
+        """The key of the thumbnail a variant's filename belongs to."""
+        return os.path.splitext(filename.split('@')[0])[0]
+
+    @staticmethod
+    def path_for(key: str, size: Optional[str] = None, extension: str = 'jpeg') -> str:
+        """A string path to the thumbnail variant with the given key."""
+        return os.path.join(THUMBNAILS_DIR, Thumbnail.filename_for(key, size, extension))
+
+    @staticmethod
+    def url_for(key: str, size: Optional[str] = None) -> str:
+        """The URL serving a thumbnail, in the default size unless another is given."""
+        url = reverse('thumbnail', args=(key,))
+        return f'{url}?size={size}' if size else url
+
+    @staticmethod
+    def sprite_path_for(key: str) -> str:
+        """A string path to the hover preview sprite sheet with the given key."""
+        return os.path.join(THUMBNAILS_DIR, f'{key}@sprite.jpeg')
 
     @property
-    def __thumbs_dir(self) -> str:
-        """A string path to the directory containing thumbnails."""
-        return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'thumbnails')
+    def path(self) -> str:
+        return Thumbnail.path_for(self.key)
 
     @property
-    def __thumbs_path(self) -> str:
-        """A string path to the thumbnail file."""
-        if self.thumbnail:
-            return os.path.join(self.__thumbs_dir, self.thumbnail)
+    def sprite_url(self) -> Optional[str]:
+        if self.sprite_frames:
+            return reverse('thumbnail_sprite', args=(self.key,))
+
+    @staticmethod
+    def variants_for(key: str) -> List[str]:
+        """Paths to every variant a thumbnail could have, whether or not they have been produced yet."""
+        return [Thumbnail.path_for(key, size, extension)
+                for size in settings.THUMBNAIL_SIZES for extension in helpers.IMAGE_FORMATS] \
+            + [Thumbnail.sprite_path_for(key)]
 
-    def generate_thumbnail(self, regenerate=False) -> None:
+    def get_variant(self, size: str, extension: str) -> str:
         """
-        Generates a new thumbnail for a given image or video file.
-        Will not generate thumbnails if the thumbnail already exists.
+        Retrieves the path to a thumbnail variant, producing it first if it does not exist yet.
+        Sizes up to the default are scaled down from the default thumbnail, while larger sizes are decoded from the
+        source file again.
 
-        :param regenerate: Generate the thumbnail even if the thumbnail already exists.
+        :raises FileNotFoundError: If the variant could not be produced, as the source file is gone or has changed.
         """
-        #  TODO: Add django-background-task scheduling
+        path = Thumbnail.path_for(self.key, size, extension)
+        if os.path.exists(path):
+            return path
 
-        # Only generate again if regenerate is True, make sure to delete old thumbnail file
-        if self.thumbnail:
-            if not regenerate:
-                return
+        box = settings.THUMBNAIL_SIZES[size]
+        if box <= settings.THUMBNAIL_SIZES[settings.THUMBNAIL_DEFAULT_SIZE]:
+            with metrics.measure('thumbnail', kind='resize'):
+                _, written = helpers.resize_thumbnail(self.path, path, box, extension, settings.THUMBNAIL_ENCODING)
+        else:
+            for source in self.files.values_list('path', flat=True):
+                try:
+                    if helpers.file_identity(os.stat(source)) == self.key:
+                        break
+                except OSError:
+                    pass
             else:
-                self.delete_thumbnail()
+                raise FileNotFoundError(f'No unchanged source file remains for thumbnail {self.key}')
+            with metrics.measure('thumbnail', kind='decode'):
+                _, _, written, _ = helpers.create_thumbnail(source, [(path, box, extension)],
+                                                            settings.THUMBNAIL_ENCODING)
 
-        # Name the thumbnail a random UUID and remember it
-        thumb_file = f'{uuid.uuid4()}.jpeg'
-        self.thumbnail = thumb_file
+        Thumbnail.objects.filter(key=self.key).update(size=models.F('size') + written)
+        return path
 
-        # Generate thumbnail
-        try:
-            helpers.generate_thumbnail(self.path, self.__thumbs_path)
-        except Exception:
-            traceback.print_exc()
-            print(f'Could not thumbnail: {self.filename}')
-            self.delete_thumbnail()
+    @classmethod
+    def touch(cls, keys: Iterable[str]) -> None:
+        """Marks thumbnails as recently used, so they are the last to be evicted."""
+        now = timezone.now()
+        for chunk in helpers.chunked([key for key in set(keys) if key], 500):
+            cls.objects.filter(key__in=chunk, lastUsed__lt=now - cls.TOUCH_INTERVAL).update(lastUsed=now)
 
-        self.save()
+    @classmethod
+    def release(cls, keys: Iterable[str]) -> int:
+        """
+        Deletes whichever of the given thumbnails are no longer referenced by any File.
+
+        :return: The number of bytes reclaimed.
+        """
+        reclaimed = 0
+        for chunk in helpers.chunked([key for key in set(keys) if key], 500):
+            reclaimed += cls.remove(cls.objects.filter(key__in=chunk, files__isnull=True))
+        return reclaimed
+
+    @classmethod
+    def evict(cls, budget: Optional[int]) -> int:
+        """
+        Deletes the least recently used thumbnails until the store fits within the given budget.
+        Files using an evicted thumbnail simply lose it, and have it queued again on their next refresh.
+
+        :param budget: The maximum total size of all thumbnails in bytes, or None for no limit.
+        :return: The number of bytes reclaimed.
+        """
+        if budget is None:
+            return 0
+        total = cls.objects.aggregate(total=models.Sum('size'))['total'] or 0
+        reclaimed = 0
+        while total - reclaimed > budget:
+            oldest = list(cls.objects.order_by('lastUsed').values_list('key', 'size')[:500])
+            if not oldest:
+                break
+            batch, excess = [], total - reclaimed - budget
+            for key, size in oldest:
+                batch.append(key)
+                excess -= size
+                if excess <= 0:
+                    break
+            reclaimed += cls.remove(cls.objects.filter(key__in=batch))
+        return reclaimed
 
     @staticmethod
-    def get_mediatype(path) -> str:
-        """Simple media type categorization based on the given path."""
-        if os.path.exists(path):
-            if os.path.isdir(path):
-                return 'folder'
-            mimetype = mimetypes.guess_type(path)[0]
-            if mimetype is not None:
-                if mimetype.startswith('image'):
-                    return 'image'
-                elif mimetype.startswith('video'):
-                    return 'video'
-            return 'file'
-        return 'unknown'
+    def remove(thumbnails: models.QuerySet) -> int:
+        """
+        Deletes the given thumbnails from both the database and the disk.
+
+        :return: The number of bytes reclaimed.
+        """
+        thumbnails = list(thumbnails.values_list('key', 'size'))
+        keys = [key for key, _ in thumbnails]
+        # Any File still using an evicted thumbnail loses it
+        for directory_id, count in File.objects.filter(thumbnail__in=keys).values('directory') \
+                .annotate(count=Count('id')).values_list('directory', 'count'):
+            ServedDirectory.add_stats(directory_id, {'thumbnail_count': -count})
+        Thumbnail.objects.filter(key__in=keys).delete()
+        for key, _ in thumbnails:
+            for path in Thumbnail.variants_for(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return sum(size for _, size in thumbnails)
 
     def __str__(self) -> str:
-        return self.filename
+        return self.key
+
+
+class MediaProbe(models.Model):
+    """
+    The metadata read from a file's content, keyed by the file's identity (see `helpers.file_identity`).
+
+    Probes are recorded whenever the thumbnail worker opens a file, and consulted by every refresh before anything
+    would be opened again, so media that is modified back, served from another directory or whose thumbnail was
+    evicted keeps its metadata without being decoded. Entries outlive the Files and Thumbnails they were read for,
+    and are only pruned by `thumbnail_gc` once unused for PROBE_CACHE_RETENTION days.
+    """
+
+    key = models.CharField('Identity Hash', max_length=64, primary_key=True)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    duration = models.FloatField('Duration In Seconds', null=True, default=None)
+    frame_count = models.PositiveIntegerField(null=True, default=None)
+    codec = models.CharField(max_length=16, blank=True, default='')
+
+    lastUsed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    # How stale lastUsed may get before a lookup bothers to update it
+    TOUCH_INTERVAL = timedelta(days=1)
+
+    @classmethod
+    def record(cls, key: str, info: helpers.MediaInfo) -> 'MediaProbe':
+        """Stores the metadata probed from the file with the given identity."""
+        probe, _ = cls.objects.update_or_create(key=key, defaults={
+            'width': info.width,
+            'height': info.height,
+            'duration': info.duration,
+            'frame_count': info.frame_count,
+            'codec': (info.codec or '')[:16],
+            'lastUsed': timezone.now()
+        })
+        return probe
+
+    @classmethod
+    def lookup(cls, keys: Iterable[str]) -> Dict[str, 'MediaProbe']:
+        """Finds the cached probes of the given identities, marking them as used."""
+        now = timezone.now()
+        probes = {}
+        for chunk in helpers.chunked(list(set(keys)), 500):
+            probes.update((probe.key, probe) for probe in cls.objects.filter(key__in=chunk))
+        stale = [key for key, probe in probes.items() if probe.lastUsed < now - cls.TOUCH_INTERVAL]
+        for chunk in helpers.chunked(stale, 500):
+            cls.objects.filter(key__in=chunk).update(lastUsed=now)
+        return probes
+
+    @classmethod
+    def prune(cls, retention: timedelta) -> int:
+        """Forgets probes unused for longer than the given time, returning how many were removed."""
+        return cls.objects.filter(lastUsed__lt=timezone.now() - retention).delete()[0]
+
+    def __str__(self) -> str:
+        return f'{self.key} ({self.width}x{self.height})'
+
+
+class ThumbnailCleanup(models.Model):
+    """
+    The thumbnails used by a deleted directory, to be removed unless another directory still uses them.
+
+    Thumbnails are released in batches, recording progress after each so that it can be shown while the cleanup runs
+    and resumed if it was interrupted. A cleanup runs on a background thread of the process that deleted the directory,
+    cleanups that were abandoned are picked up by the thumbnail worker and `manage.py thumbnail_gc`.
+    """
+
+    # Seconds without progress after which a cleanup is considered abandoned
+    STALE_AFTER = 60
+
+    path = models.CharField('Deleted Directory Path', max_length=260)
+    keys = jsonfield.JSONField('Thumbnail Keys', default=list)
+    total = models.PositiveIntegerField('Number Of Thumbnails', default=0)
+    done = models.PositiveIntegerField('Thumbnails Checked', default=0)
+    reclaimed = models.BigIntegerField('Bytes Reclaimed', default=0)
+    finished = models.DateTimeField(null=True, default=None)
+
+    lastModified = models.DateTimeField(auto_now=True)
+    initialCreation = models.DateTimeField(auto_now_add=True)
+
+    def start(self) -> None:
+        """Runs this cleanup on a background thread, so that the request deleting the directory returns at once."""
+
+        def run():
+            try:
+                self.run()
+            except Exception:
+                logger.exception(f'Could not clean up the thumbnails of {self.path}')
+            finally:
+                connection.close()
+
+        if self.finished is None:
+            _cleanup_pool.submit(run)
+
+    def run(self, batch_size: int = 500) -> None:
+        """Releases the remaining thumbnails, a batch at a time."""
+        while self.done < self.total:
+            batch = self.keys[self.done:self.done + batch_size]
+            self.reclaimed += Thumbnail.release(batch)
+            self.done += len(batch)
+            if self.done >= self.total:
+                self.finished = timezone.now()
+            self.save(update_fields=['done', 'reclaimed', 'finished', 'lastModified'])
+        logger.info(f'Removed the thumbnails of {self.path}, reclaiming {humanize.naturalsize(self.reclaimed)}')
+
+    @classmethod
+    def resume(cls, stale_after: float = STALE_AFTER) -> int:
+        """
+        Runs every unfinished cleanup that has made no progress for a while, and forgets those finished a day ago.
+
+        :return: The number of cleanups run.
+        """
+        now = timezone.now()
+        cls.objects.filter(finished__lt=now - timedelta(days=1)).delete()
+        abandoned = list(cls.objects.filter(finished__isnull=True,
+                                            lastModified__lt=now - timedelta(seconds=stale_after)))
+        for cleanup in abandoned:
+            cleanup.run()
+        return len(abandoned)
+
+    def serialize(self) -> dict:
+        """A JSON serializable summary of this cleanup's progress."""
+        return {
+            'id': self.id,
+            'path': self.path,
+            'total': self.total,
+            'done': self.done,
+            'reclaimed': self.reclaimed,
+            'finished': self.finished,
+        }
+
+    def __str__(self) -> str:
+        return f'{self.path} ({self.done}/{self.total})'
+
+
+class ThumbnailJob(models.Model):
+    """
+    A persistent request to generate the thumbnail for a File, drained by the `thumbnail_worker` management command.
+
+    Each File has at most one job, which is reset to the queue whenever another thumbnail is requested for it.
+    Failed jobs are retried with exponential backoff until THUMBNAIL_MAX_ATTEMPTS is reached. Running jobs are leased
+    to their worker, which renews the lease for as long as it is working on them, so the jobs of a worker that died
+    are returned to the queue once the lease expires without disturbing those of live workers.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    file = models.OneToOneField(File, on_delete=models.CASCADE, related_name='thumbnail_job')
+    status = models.CharField('Job Status', max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField('Failed Attempts', default=0)
+    available = models.DateTimeField('Next Attempt', default=timezone.now)
+    error = models.TextField('Last Error', blank=True, default='')
+    leaseExpires = models.DateTimeField('Running Lease Expiry', null=True, default=None)
+
+    lastModified = models.DateTimeField(auto_now=True)
+    initialCreation = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'available'])]
+
+    @classmethod
+    def enqueue(cls, file_ids: Iterable[int]) -> None:
+        """
+        Queues thumbnail generation for the given File ids.
+        Files with a job already queued or running are left alone, finished jobs are reset.
+        """
+        now = timezone.now()
+        for chunk in helpers.chunked(list(set(file_ids)), 500):
+            cls.objects.filter(file_id__in=chunk, status__in=[cls.DONE, cls.FAILED]) \
+                .update(status=cls.QUEUED, attempts=0, available=now, error='', lastModified=now)
+            cls.objects.bulk_create([cls(file_id=file_id, available=now) for file_id in chunk],
+                                    ignore_conflicts=True)
+
+    @classmethod
+    def claim(cls, limit: int) -> List['ThumbnailJob']:
+        """
+        Marks up to `limit` available jobs as running and returns them, oldest first, leased for
+        THUMBNAIL_LEASE_TIMEOUT. Each job is claimed with a conditional update so concurrent workers never pick up the
+        same job.
+        """
+        now = timezone.now()
+        expires = now + timedelta(seconds=settings.THUMBNAIL_LEASE_TIMEOUT)
+        candidates = cls.objects.filter(status=cls.QUEUED, available__lte=now) \
+                         .order_by('available').values_list('id', flat=True)[:limit]
+        claimed = [job_id for job_id in candidates
+                   if cls.objects.filter(id=job_id, status=cls.QUEUED).update(status=cls.RUNNING,
+                                                                                leaseExpires=expires)]
+        return list(cls.objects.filter(id__in=claimed).select_related('file'))
+
+    @classmethod
+    def renew(cls, job_ids: Iterable[int]) -> None:
+        """Extends the lease on running jobs, which their worker is still working on."""
+        expires = timezone.now() + timedelta(seconds=settings.THUMBNAIL_LEASE_TIMEOUT)
+        for chunk in helpers.chunked(list(job_ids), 500):
+            cls.objects.filter(id__in=chunk, status=cls.RUNNING).update(leaseExpires=expires)
+
+    @classmethod
+    def release_expired(cls) -> int:
+        """Returns running jobs whose lease has expired, as their worker exited uncleanly, to the queue."""
+        return cls.objects.filter(Q(leaseExpires__isnull=True) | Q(leaseExpires__lt=timezone.now()),
+                                  status=cls.RUNNING).update(status=cls.QUEUED, leaseExpires=None)
+
+    @staticmethod
+    def status_counts(directory: ServedDirectory) -> Dict[str, int]:
+        """Counts the thumbnail jobs for every File in a directory by their status."""
+        counts = {status: 0 for status, _ in ThumbnailJob.STATUS_CHOICES}
+        for row in ThumbnailJob.objects.filter(file__directory=directory) \
+                .values('status').annotate(count=models.Count('id')).order_by():
+            counts[row['status']] = row['count']
+        return counts
+
+    def complete(self, thumbnail: Thumbnail) -> None:
+        """Applies a generated (or shared) thumbnail to the File and marks this job as done."""
+        self.file.apply_thumbnail(thumbnail)
+        ThumbnailJob.objects.filter(id=self.id).update(status=ThumbnailJob.DONE, error='', leaseExpires=None,
+                                                       lastModified=timezone.now())
+        DirectoryEvent.emit(self.file.directory_id, changed=[self.file.relative_path])
+
+    def fail(self, error: Optional[str]) -> None:
+        """Records a failed attempt, scheduling a retry with exponential backoff or giving up entirely."""
+        self.attempts += 1
+        if self.attempts >= settings.THUMBNAIL_MAX_ATTEMPTS:
+            self.status = ThumbnailJob.FAILED
+        else:
+            self.status = ThumbnailJob.QUEUED
+            self.available = timezone.now() + timedelta(
+                seconds=settings.THUMBNAIL_RETRY_BACKOFF * 2 ** (self.attempts - 1))
+        ThumbnailJob.objects.filter(id=self.id).update(status=self.status, attempts=self.attempts,
+                                                       available=self.available, error=error or '',
+                                                       leaseExpires=None, lastModified=timezone.now())
+
+    def __str__(self) -> str:
+        return f'{self.file} ({self.status})'
+
+
+class DirectoryEvent(models.Model):
+    """
+    A change to a directory's listing, picked up by the websocket relay (see viewer.consumers) and pushed to every open
+    browse page of that directory.
+
+    Events are written by whichever process made the change (a refresh, the watcher or the thumbnail worker), so they
+    pass through the database rather than the channel layer, which only reaches consumers in the same process.
+    Changed files are referred to by path as Files created in bulk have no id yet, removed files by their id. Changes
+    too many to send file by file, such as a directory's first refresh, are recorded as a single reload event instead.
+    """
+
+    CHANGED = 'changed'
+    REMOVED = 'removed'
+    RELOAD = 'reload'
+    KIND_CHOICES = [(CHANGED, 'Changed'), (REMOVED, 'Removed'), (RELOAD, 'Reload')]
+
+    directory = models.ForeignKey(ServedDirectory, on_delete=models.CASCADE, related_name='events')
+    kind = models.CharField('Event Kind', max_length=10, choices=KIND_CHOICES)
+    relative_path = models.CharField('Path Relative To Directory', max_length=300, blank=True, default='')
+    file_id = models.PositiveIntegerField('Removed File ID', null=True)
+
+    initialCreation = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @classmethod
+    def emit(cls, directory_id: uuid.UUID, changed: Iterable[str] = (), removed: Iterable[int] = ()) -> None:
+        """
+        Records Files added, updated or removed from a directory, marking its listing as changed. More than
+        DIRECTORY_EVENT_LIMIT changes are recorded as a single reload event. Old events are pruned at most once a
+        minute.
+        """
+        global _last_pruned
+        changed, removed = list(changed), list(removed)
+        if len(changed) + len(removed) > settings.DIRECTORY_EVENT_LIMIT:
+            events = [cls(directory_id=directory_id, kind=cls.RELOAD)]
+        else:
+            events = [cls(directory_id=directory_id, kind=cls.CHANGED, relative_path=path) for path in changed] + \
+                     [cls(directory_id=directory_id, kind=cls.REMOVED, file_id=file_id) for file_id in removed]
+        cls.objects.bulk_create(events, batch_size=500)
+        if events:
+            ServedDirectory.mark_changed(directory_id)
+
+        if time.monotonic() - _last_pruned > 60:
+            _last_pruned = time.monotonic()
+            cls.objects.filter(initialCreation__lt=timezone.now() - timedelta(
+                seconds=settings.DIRECTORY_EVENT_RETENTION)).delete()
+
+    def __str__(self) -> str:
+        return f'{self.kind} {self.relative_path or self.file_id}'
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from viewer import consumers
+
+websocket_urlpatterns = [
+    path('<uuid:directory_id>/events', consumers.DirectoryConsumer.as_asgi(), name='events'),
+]
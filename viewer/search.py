@@ -0,0 +1,170 @@
+"""
+search.py
+
+Contains the global search across the Files of every served directory, and the database index backing it.
+
+On SQLite, paths are indexed by an FTS5 table using the trigram tokenizer, so that any part of a path of at least three
+characters can be looked up without scanning every File. The table is external content over viewer_file, kept in sync
+by triggers, so every write made by a refresh, the watcher or a deletion updates it without any further code.
+On PostgreSQL, a pg_trgm GIN index serves the same substring lookups. Other databases fall back to scanning.
+
+The index is created by the migration 0016_file_search. SQLite drops the triggers whenever it remakes viewer_file, so
+every migration altering File must recreate them, as 0017_refresh_leases does.
+"""
+import re
+from datetime import datetime, time
+from typing import List, Mapping, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q, QuerySet
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from viewer.models import File
+
+SEARCH_TABLE = 'viewer_file_search'
+
+# Shortest term the trigram index can look up, shorter ones are matched by scanning
+MIN_TERM_LENGTH = 3
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+# Whether the FTS5 table exists, checked once per process
+_fts_available: Optional[bool] = None
+
+
+def uses_fts() -> bool:
+    """Whether searches are answered by the FTS5 table."""
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = connection.vendor == 'sqlite' and SEARCH_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def parse_size(value: str) -> int:
+    """
+    Reads a file size in bytes, optionally suffixed with a binary unit, e.g. '1500', '20K' or '1.5 GB'.
+
+    :raises ValueError: If the size could not be read.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', value, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Invalid size: {value!r}')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_resolution(value: str) -> int:
+    """
+    Reads a resolution given as 'WIDTHxHEIGHT', e.g. '1920x1080', as its number of pixels.
+
+    :raises ValueError: If the resolution could not be read.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*[x×*]\s*(\d+)\s*', value, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Invalid resolution: {value!r}')
+    return int(match.group(1)) * int(match.group(2))
+
+
+def parse_moment(value: str, end_of_day: bool = False) -> datetime:
+    """
+    Reads a date or date and time in ISO 8601 format. Dates are taken as the start of the day in the current
+    timezone, or its end for upper bounds, so that a range of days includes the last one.
+
+    :raises ValueError: If the moment could not be read.
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'Invalid date: {value!r}')
+        moment = datetime.combine(date, time.max if end_of_day else time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def get_filters(params: Mapping[str, str]) -> Q:
+    """
+    Translates the search parameters other than the text into a filter on File. Each range may be open on either end.
+
+    `mediatype`: One of 'image', 'video' or 'file'.
+    `size_min`, `size_max`: Sizes as read by `parse_size`.
+    `resolution_min`, `resolution_max`: Resolutions as read by `parse_resolution`, compared by number of pixels.
+    `modified_after`, `modified_before`: Dates as read by `parse_moment`.
+
+    :raises ValueError: If any parameter could not be read.
+    """
+    condition = Q()
+    if params.get('mediatype'):
+        condition &= Q(mediatype=params['mediatype'])
+    if params.get('size_min'):
+        condition &= Q(size__gte=parse_size(params['size_min']))
+    if params.get('size_max'):
+        condition &= Q(size__lte=parse_size(params['size_max']))
+    if params.get('resolution_min'):
+        condition &= Q(pixels__gte=parse_resolution(params['resolution_min']))
+    if params.get('resolution_max'):
+        condition &= Q(pixels__lte=parse_resolution(params['resolution_max']))
+    if params.get('modified_after'):
+        condition &= Q(fileLastModified__gte=parse_moment(params['modified_after']))
+    if params.get('modified_before'):
+        condition &= Q(fileLastModified__lte=parse_moment(params['modified_before'], end_of_day=True))
+    return condition
+
+
+def match_expression(terms: List[str]) -> str:
+    """An FTS5 query requiring every term to appear somewhere in the path, each quoted to be taken literally."""
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+def search_files(params: Mapping[str, str], cursor: Optional[str] = None,
+                 limit: int = settings.BROWSE_PAGE_SIZE) -> Tuple[List[File], Optional[str]]:
+    """
+    Finds Files in every served directory whose path contains each word of the `q` parameter, filtered by the other
+    parameters (see `get_filters`). Results are ordered newest first and paged by id, which the FTS5 table returns in
+    order, so a page stops reading the index as soon as it is full however many Files match.
+
+    :param cursor: The cursor returned alongside the previous page, or None for the first page.
+    :return: The Files on this page and the cursor for the next page, or None if this was the last page.
+    :raises ValueError: If the cursor or any parameter could not be read.
+    """
+    files: QuerySet = File.objects.select_related('thumbnail') \
+        .annotate(pixels=F('width') * F('height')).filter(get_filters(params))
+
+    terms = params.get('q', '').split()
+    if uses_fts():
+        indexed = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+        terms = [term for term in terms if len(term) < MIN_TERM_LENGTH]
+    else:
+        indexed = []
+    for term in terms:
+        files = files.filter(path__icontains=term)
+
+    if cursor:
+        try:
+            last_id = int(cursor)
+        except ValueError as e:
+            raise ValueError('Invalid cursor') from e
+    else:
+        last_id = None
+
+    if indexed:
+        where = [f'{SEARCH_TABLE}.rowid = viewer_file.id', f'{SEARCH_TABLE} MATCH %s']
+        where_params = [match_expression(indexed)]
+        if last_id is not None:
+            where.append(f'{SEARCH_TABLE}.rowid < %s')
+            where_params.append(last_id)
+        # Ordered by the index's own rowid, as ordering by the File id would sort every match first
+        files = files.extra(select={'match_id': f'{SEARCH_TABLE}.rowid'}, tables=[SEARCH_TABLE],
+                            where=where, params=where_params).order_by('-match_id')
+    else:
+        if last_id is not None:
+            files = files.filter(id__lt=last_id)
+        files = files.order_by('-id')
+
+    page = list(files[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, str(page[-1].id)
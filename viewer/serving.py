@@ -0,0 +1,197 @@
+"""
+serving.py
+
+Contains the functions used to serve files over HTTP, handling conditional requests, byte ranges and handing delivery
+off to a fronting web server when one is configured.
+"""
+import mimetypes
+import os
+import uuid
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+
+# Requests asking for more ranges than this are answered with the whole file instead
+MAX_RANGES = 16
+
+
+def get_etag(stat: os.stat_result) -> str:
+    """A strong ETag for a file, derived from its size and modification time."""
+    return quote_etag(f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+
+
+def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a Range header into a sorted list of non-overlapping byte ranges.
+
+    :param header: The value of the Range header, e.g. 'bytes=0-499,-500'.
+    :param size: The size of the file in bytes.
+    :return: A list of inclusive (start, end) tuples, an empty list if none of the ranges can be satisfied,
+             or None if the header is malformed and should be ignored.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        start, dash, end = spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not start:
+                # Suffix range, the last N bytes of the file
+                length = int(end)
+                if length <= 0 or size == 0:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+            else:
+                start, end = int(start), int(end) if end else None
+                if end is not None and start > end:
+                    return None
+                if start < size:
+                    ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+        except ValueError:
+            return None
+
+    # Merge overlapping or adjacent ranges so the same bytes are never sent twice
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = merged[-1][0], max(merged[-1][1], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def read_range(file: BinaryIO, start: int, end: int) -> Iterator[bytes]:
+    """Reads the inclusive byte range from an open file in chunks."""
+    file.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = file.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def stream_range(path: str, start: int, end: int) -> Iterator[bytes]:
+    """Streams a single inclusive byte range of a file, closing it once done."""
+    with open(path, 'rb') as file:
+        yield from read_range(file, start, end)
+
+
+def stream_multipart(path: str, parts: List[Tuple[bytes, int, int]], closing: bytes) -> Iterator[bytes]:
+    """Streams a multipart/byteranges body, given the header and inclusive range of every part."""
+    with open(path, 'rb') as file:
+        for header, start, end in parts:
+            yield header
+            yield from read_range(file, start, end)
+        yield closing
+
+
+def if_range_matches(request, etag: str, last_modified: float) -> bool:
+    """Checks whether the If-Range precondition (if any) still holds, otherwise the Range header must be ignored."""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    if_range_date = parse_http_date_safe(if_range)
+    return if_range_date is not None and int(last_modified) <= if_range_date
+
+
+def sendfile_response(path: str, content_type: str) -> Optional[HttpResponse]:
+    """
+    Builds a response asking the fronting web server to deliver the file itself, if FILE_SENDFILE is configured.
+    The web server is then responsible for ranges and conditional requests.
+
+    X-Accel-Redirect takes a URI, which nginx unquotes, so the path is quoted. X-Sendfile takes the path as it is,
+    so files whose paths cannot be sent in a header return None and are served by Python instead.
+    """
+    if settings.FILE_SENDFILE == 'x-sendfile':
+        if not path.isprintable() or not is_latin1(path):
+            return None
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+    elif settings.FILE_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.FILE_ACCEL_REDIRECT_PREFIX.rstrip('/') + quote(os.fsencode(path))
+        return response
+    return None
+
+
+def is_latin1(value: str) -> bool:
+    try:
+        value.encode('latin-1')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def serve_file(request, path: str) -> HttpResponse:
+    """
+    Serves a file, answering conditional requests with 304 responses and Range requests with 206 responses.
+
+    :param request: The request being answered.
+    :param path: The absolute path to the file, which must exist.
+    """
+    stat = os.stat(path)
+    etag, last_modified = get_etag(stat), stat.st_mtime
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if response is None:
+        response = sendfile_response(path, content_type)
+    if response is None:
+        response = range_response(request, path, stat.st_size, content_type, etag, last_modified)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def range_response(request, path: str, size: int, content_type: str, etag: str,
+                   last_modified: float) -> HttpResponse:
+    """Builds the response for a file's content, honouring the Range header if there is one."""
+    header = request.META.get('HTTP_RANGE')
+    ranges = None
+    if header and if_range_matches(request, etag, last_modified):
+        ranges = parse_range(header, size)
+
+    if ranges is None or len(ranges) > MAX_RANGES:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        # Read in the same chunks as ranges, rather than the much smaller default
+        response.block_size = CHUNK_SIZE
+        return response
+
+    if not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(stream_range(path, start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+        return response
+
+    boundary = uuid.uuid4().hex
+    parts = [(f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+              f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode(), start, end) for start, end in ranges]
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+
+    response = StreamingHttpResponse(stream_multipart(path, parts, closing), status=206,
+                                     content_type=f'multipart/byteranges; boundary={boundary}')
+    response['Content-Length'] = sum(len(header) + end - start + 1 for header, start, end in parts) + len(closing)
+    return response
@@ -0,0 +1,144 @@
+/*
+ * Loads further pages of the directory listing from the JSON API as the bottom of the page comes into view, and keeps
+ * the rows shown up to date with changes pushed over a websocket.
+ */
+$(function () {
+    const $more = $('#file-list-more');
+    const $list = $('#file-list');
+    const template = document.getElementById('file-template');
+
+    function render(file) {
+        const $row = $(template.content.firstElementChild.cloneNode(true));
+        if (file.id) {
+            $row.attr('id', `file-${file.id}`);
+            $row.find('.media-select').val(file.id);
+            $row.find('.media-anchor').attr('href', `#file-${file.id}`);
+            $row.find('.media-fileid').text(file.id);
+        } else {
+            // Files in subdirectories scanned on demand are not indexed, and so have no id
+            $row.find('.media-anchor, .media-select').remove();
+        }
+        if (file.thumbnail) {
+            $row.find('.image-placeholder').css({
+                'min-width': `${file.thumbnail_height}px`,
+                'min-height': `${file.thumbnail_height}px`
+            });
+            $row.find('img').attr({
+                src: file.thumbnail,
+                srcset: `${file.thumbnail} 1x, ${file.thumbnail_large} 2x`,
+                width: file.thumbnail_width,
+                height: file.thumbnail_height
+            });
+            if (file.sprite) {
+                $row.find('.image-placeholder').attr({'data-sprite': file.sprite, 'data-frames': file.sprite_frames});
+            }
+        } else {
+            $row.find('img').remove();
+        }
+        $row.find('.media-filename a').attr('href', file.url).text(`/${file.path}`);
+        $row.find('.media-resolution').text(file.resolution || '');
+        $row.find('.media-size i').text(file.human_size);
+        return $row;
+    }
+
+    /*
+     * Infinite scrolling
+     */
+    let loading = false;
+    let observer = null;
+
+    function loadMore() {
+        if (loading || !$more.data('next')) return;
+        loading = true;
+
+        $.getJSON($more.data('url'), {after: $more.data('next')}).done(function (data) {
+            $list.append(data.files.map(render));
+            $more.data('next', data.next);
+            if (!data.next) {
+                observer.disconnect();
+                $more.remove();
+            }
+        }).always(function () {
+            loading = false;
+            // Observing again reports whether the end is still in view, in case the page was too short to scroll
+            if ($more.data('next')) {
+                observer.unobserve($more[0]);
+                observer.observe($more[0]);
+            }
+        });
+    }
+
+    if ($more.length) {
+        observer = new IntersectionObserver(function (entries) {
+            if (entries.some(entry => entry.isIntersecting)) loadMore();
+        }, {rootMargin: '600px'});
+        observer.observe($more[0]);
+    }
+
+    /*
+     * Downloading a selection of files
+     */
+    const $download = $('#download-form button');
+
+    $(document).on('change', '.media-select', function () {
+        const selected = $('.media-select:checked').length;
+        $download.prop('disabled', !selected)
+            .text(selected ? `Download ${selected.toLocaleString()} selected` : 'Download selected');
+    });
+
+    /*
+     * Live updates
+     */
+    const directory = $('#browse').data('directory');
+    // Only changes at or below the subdirectory browsed are shown
+    const path = $('#browse').attr('data-path');
+    const prefix = path ? `${path}/` : '';
+    let retryDelay = 1000;
+
+    function applyChanges(changes) {
+        if (changes.reload) {
+            // Too many files changed to be sent one by one, so the listing has to be loaded again
+            $('#listing-changed').removeClass('is-hidden');
+        }
+        for (const id of changes.removed || []) {
+            $(`#file-${id}`).remove();
+        }
+        for (const file of changes.files || []) {
+            if (!file.path.startsWith(prefix)) continue;
+            const $existing = $(`#file-${file.id}`);
+            if ($existing.length) {
+                const $row = render(file);
+                $row.find('.media-select').prop('checked', $existing.find('.media-select').prop('checked'));
+                $existing.replaceWith($row);
+            } else if (!$more.parent().length) {
+                // New files are only added once the whole listing is shown, otherwise they arrive with a later page
+                $list.append(render(file));
+            }
+        }
+        if (changes.file_count !== undefined && !path) {
+            $('#file-count').text(`${changes.file_count.toLocaleString()} files`);
+        }
+        if (changes.thumbnails) {
+            const pending = changes.thumbnails.queued + changes.thumbnails.running;
+            $('#thumbnail-progress').text(pending ? `(${pending.toLocaleString()} thumbnails pending)` : '');
+        }
+    }
+
+    function connect() {
+        const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const socket = new WebSocket(`${protocol}//${location.host}/${directory}/events`);
+        socket.onopen = function () {
+            retryDelay = 1000;
+        };
+        socket.onmessage = function (message) {
+            applyChanges(JSON.parse(message.data));
+        };
+        socket.onclose = function () {
+            // Servers without websocket support refuse every attempt, so back off up to a minute between them
+            setTimeout(connect, retryDelay);
+            retryDelay = Math.min(retryDelay * 2, 60000);
+        };
+    }
+
+    if (window.WebSocket) connect();
+});
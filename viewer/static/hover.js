@@ -1 +1,26 @@
-asdas
+/*
+ * Scrubs through a video's hover preview as the mouse moves across its thumbnail.
+ * Previews are a single sprite sheet of frames laid out left to right, shown as a scaled background image.
+ */
+$(function () {
+    $('#file-list').on('mousemove', '.image-placeholder[data-sprite]', function (event) {
+        const $placeholder = $(this);
+        const $img = $placeholder.find('img');
+        const frames = parseInt($placeholder.attr('data-frames'));
+        const bounds = $img[0].getBoundingClientRect();
+        const frame = Math.min(frames - 1, Math.max(0, Math.floor((event.clientX - bounds.left) / bounds.width * frames)));
+
+        if (!$placeholder.data('previewing')) {
+            $placeholder.data('previewing', true);
+            $img.css({
+                'background-image': `url(${$placeholder.attr('data-sprite')})`,
+                'background-size': `${frames * 100}% 100%`,
+                'object-position': '-9999px 0'
+            });
+        }
+        $img.css('background-position', `${frames > 1 ? frame / (frames - 1) * 100 : 0}% 0`);
+    }).on('mouseleave', '.image-placeholder[data-sprite]', function () {
+        $(this).data('previewing', false);
+        $(this).find('img').css({'background-image': '', 'object-position': ''});
+    });
+});
@@ -0,0 +1,57 @@
+/*
+ * The collapsible directory tree beside the listing, loading the children of each subdirectory from the JSON API the
+ * first time it is expanded. The subdirectories leading down to the one browsed are expanded on load.
+ */
+$(function () {
+    const $tree = $('#directory-tree');
+    const current = $('#browse').attr('data-path');
+
+    function render(directory) {
+        const $node = $('<li>').attr('data-path', directory.path);
+        $('<a class="tree-toggle">').append('<i class="fas fa-caret-right"></i>').appendTo($node);
+        $('<a>').attr('href', directory.url).text(` ${directory.name}`)
+            .toggleClass('has-text-weight-bold', directory.path === current).appendTo($node);
+        $('<ul>').hide().appendTo($node);
+        return $node;
+    }
+
+    function setOpen($node, open) {
+        $node.toggleClass('is-open', open).children('ul').toggle(open);
+    }
+
+    function expand($node) {
+        const $children = $node.children('ul');
+        if ($node.data('loaded')) {
+            setOpen($node, true);
+            return $.Deferred().resolve().promise();
+        }
+        return $.getJSON($tree.data('url'), {path: $node.attr('data-path')}).done(function (data) {
+            $node.data('loaded', true);
+            $children.empty().append(data.directories.map(render));
+            if (!data.directories.length) $node.children('.tree-toggle').css('visibility', 'hidden');
+            setOpen($node, true);
+        });
+    }
+
+    $tree.on('click', '.tree-toggle', function () {
+        const $node = $(this).parent();
+        if ($node.hasClass('is-open')) {
+            setOpen($node, false);
+        } else {
+            expand($node);
+        }
+    });
+
+    // Open every subdirectory down to the current one, each only once its parent has loaded
+    const parts = current ? current.split('/') : [];
+    let chain = expand($tree.children('li').first());
+    parts.forEach(function (part, i) {
+        const path = parts.slice(0, i + 1).join('/');
+        chain = chain.then(function () {
+            const $node = $tree.find('li').filter(function () {
+                return $(this).attr('data-path') === path;
+            });
+            return $node.length ? expand($node) : $.Deferred().reject().promise();
+        });
+    });
+});
@@ -0,0 +1,104 @@
+"""
+streaming.py
+
+Contains the ASGI handler serving streaming responses, such as file and archive downloads, without blocking the event
+loop or tying up a thread for each connection.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.http import HttpResponse
+
+# Every chunk of every stream is read on this pool, one chunk at a time, so it never needs to grow with the number of
+# open streams
+_read_pool = ThreadPoolExecutor(max_workers=settings.FILE_STREAM_THREADS, thread_name_prefix='file-stream')
+
+
+class ResponseChannel:
+    """
+    The ASGI send callable of a single request, which also carries what the handler needs to know about the connection
+    once the response is ready, as Django only passes send on to `send_response`.
+    """
+
+    def __init__(self, send, receive, method: str):
+        self.send = send
+        self.receive = receive
+        self.method = method
+
+    async def __call__(self, message) -> None:
+        await self.send(message)
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django's ASGI handler, iterating streaming responses off the event loop. Requests pass through the middleware and
+    views as usual, so downloads are checked, measured and answered exactly as under WSGI.
+
+    Django iterates a streaming response on the event loop, blocking it on every read. Here each chunk is read on a
+    small shared thread pool instead, and the next chunk is only read once the server has accepted the previous one, and
+    not at all once the client has gone away. With uvicorn, whose send() waits for the client to keep up, each
+    connection holds at most one chunk in memory however slow the client is. Daphne (and so `runserver`) sends without
+    waiting, buffering whatever a slow client has not received yet, which is why uvicorn is required in production.
+
+    At most FILE_STREAM_LIMIT responses are streamed at once, further requests are answered with 503 Service
+    Unavailable.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.streams = 0
+
+    async def __call__(self, scope, receive, send):
+        await super().__call__(scope, receive, ResponseChannel(send, receive, scope.get('method', 'GET')))
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        if self.streams >= settings.FILE_STREAM_LIMIT:
+            await sync_to_async(response.close, thread_sensitive=True)()
+            busy = HttpResponse('Too many files are being streamed, try again shortly.', status=503,
+                                content_type='text/plain')
+            busy['Retry-After'] = 5
+            await super().send_response(busy, send)
+            return
+
+        self.streams += 1
+        loop = asyncio.get_running_loop()
+        disconnected = asyncio.Event()
+        listener = asyncio.ensure_future(self.wait_for_disconnect(send.receive, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': self.get_headers(response)})
+            if send.method != 'HEAD':
+                chunks = iter(response)
+                while not disconnected.is_set():
+                    chunk = await loop.run_in_executor(_read_pool, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            listener.cancel()
+            self.streams -= 1
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+    @staticmethod
+    def get_headers(response: HttpResponse):
+        """The headers of a response, cookies included, encoded as `ASGIHandler.send_response` does."""
+        headers = [(header.encode('ascii'), str(value).encode('latin1')) for header, value in response.items()]
+        headers.extend((b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                       for cookie in response.cookies.values())
+        return headers
+
+    @staticmethod
+    async def wait_for_disconnect(receive, disconnected: asyncio.Event) -> None:
+        """Drains the request until the client goes away, so that an abandoned stream stops reading the file."""
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
@@ -1,3 +1,1057 @@
-from django.test import TestCase
+import io
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy
+from PIL import Image
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from viewer import archives, helpers, metrics, search, serving, views
+from viewer.archives import ArchiveEntry, TarStream, ZipStream
+from viewer.models import File, MediaProbe, RefreshResult, ServedDirectory, Thumbnail, ThumbnailJob
+from viewer.watcher import Inotify, Watcher
+
+
+class DirectoryTestCase(TestCase):
+    """Serves a temporary directory, which each test fills with the files it needs."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.directory = ServedDirectory.objects.create(path=self.root, recursive=True)
+
+    def write(self, relative_path: str, size: int = 0, mtime: float = None) -> str:
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
+class ParseRangeTests(SimpleTestCase):
+
+    def test_single_range(self):
+        self.assertEqual(serving.parse_range('bytes=0-499', 1000), [(0, 499)])
+        self.assertEqual(serving.parse_range('bytes=500-', 1000), [(500, 999)])
+
+    def test_end_is_clamped_to_the_file(self):
+        self.assertEqual(serving.parse_range('bytes=900-5000', 1000), [(900, 999)])
+
+    def test_suffix_range(self):
+        self.assertEqual(serving.parse_range('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(serving.parse_range('bytes=-5000', 1000), [(0, 999)])
+        self.assertEqual(serving.parse_range('bytes=-0', 1000), [])
+
+    def test_empty_file_is_unsatisfiable(self):
+        self.assertEqual(serving.parse_range('bytes=-5', 0), [])
+        self.assertEqual(serving.parse_range('bytes=0-', 0), [])
+        self.assertEqual(serving.parse_range('bytes=0-10', 0), [])
+
+    def test_start_beyond_the_file(self):
+        self.assertEqual(serving.parse_range('bytes=1000-', 1000), [])
+        self.assertEqual(serving.parse_range('bytes=0-9,2000-3000', 1000), [(0, 9)])
+
+    def test_overlapping_and_adjacent_ranges_are_merged(self):
+        self.assertEqual(serving.parse_range('bytes=50-60,0-10,5-20', 1000), [(0, 20), (50, 60)])
+        self.assertEqual(serving.parse_range('bytes=0-9,10-19', 1000), [(0, 19)])
+        self.assertEqual(serving.parse_range('bytes=0-9,-995', 1000), [(0, 999)])
+
+    def test_malformed_headers_are_ignored(self):
+        for header in ('items=0-9', 'bytes=', 'bytes=9-0', 'bytes=a-b', 'bytes=5', 'bytes=0-9,x'):
+            with self.subTest(header=header):
+                self.assertIsNone(serving.parse_range(header, 1000))
+
+
+class ServeFileTests(DirectoryTestCase):
+
+    def get(self, path: str, **headers):
+        return serving.serve_file(RequestFactory().get('/', **headers), path)
+
+    def test_range(self):
+        path = self.write('file.bin', 100)
+        response = self.get(path, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response), b'x' * 10)
+
+    def test_suffix_range_of_empty_file(self):
+        path = self.write('empty.bin')
+        response = self.get(path, HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */0')
+
+    def test_stale_if_range_sends_whole_file(self):
+        path = self.write('file.bin', 100)
+        response = self.get(path, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(b''.join(response)), 100)
+
+    def test_accel_redirect_is_quoted(self):
+        with self.settings(FILE_SENDFILE='x-accel-redirect', FILE_ACCEL_REDIRECT_PREFIX='/protected/'):
+            response = serving.sendfile_response('/media/a b/100%?.mp4', 'video/mp4')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/media/a%20b/100%25%3F.mp4')
+
+    def test_sendfile_falls_back_for_paths_unfit_for_headers(self):
+        with self.settings(FILE_SENDFILE='x-sendfile'):
+            self.assertEqual(serving.sendfile_response('/media/café.mp4', 'video/mp4')['X-Sendfile'],
+                             '/media/café.mp4')
+            self.assertIsNone(serving.sendfile_response('/media/日本.mp4', 'video/mp4'))
+            self.assertIsNone(serving.sendfile_response('/media/a\nb.mp4', 'video/mp4'))
+
+
+class ArchiveTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.contents = {'a.txt': b'alpha', 'sub/b.bin': os.urandom(200 * 1024), 'empty': b'',
+                         'ünïcödé/' + 'long' * 40 + '.txt': b'long name'}
+        self.entries = []
+        for name, content in self.contents.items():
+            path = os.path.join(self.root, name.replace('/', '_'))
+            with open(path, 'wb') as file:
+                file.write(content)
+            self.entries.append((name, path))
+
+    def test_zip(self):
+        stream = ZipStream(archives.get_entries(self.entries))
+        data = b''.join(stream)
+        self.assertEqual(len(data), stream.length)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({name: archive.read(name) for name in archive.namelist()}, self.contents)
+
+    def test_tar(self):
+        stream = TarStream(archives.get_entries(self.entries))
+        data = b''.join(stream)
+        self.assertEqual(len(data), stream.length)
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            self.assertEqual({member.name: archive.extractfile(member).read() for member in archive.getmembers()},
+                             self.contents)
+
+    def test_missing_files_are_skipped(self):
+        entries = archives.get_entries(self.entries + [('gone', os.path.join(self.root, 'gone'))])
+        self.assertEqual([entry.name for entry in entries], list(self.contents))
+
+    def test_truncated_file_raises(self):
+        entries = archives.get_entries(self.entries)
+        with open(entries[1].path, 'wb'):
+            pass
+        with self.assertRaises(OSError):
+            b''.join(ZipStream(entries))
+
+    def test_zip64_sizes_and_offsets(self):
+        # The large entry is never read from disk: its data is the same chunk of zeros, skipped over in the output
+        zeros = bytes(serving.CHUNK_SIZE)
+        size = archives.ZIP64_LIMIT + 10
+
+        def read_entry(entry):
+            if entry.name != 'large.bin':
+                yield from original(entry)
+                return
+            for _ in range(entry.size // len(zeros)):
+                yield zeros
+            yield bytes(entry.size % len(zeros))
+
+        original = archives.read_entry
+        entries = [ArchiveEntry('large.bin', '', size, time.time())] + archives.get_entries(self.entries[:1])
+        stream = ZipStream(entries)
+        with tempfile.TemporaryFile() as output, mock.patch('viewer.archives.read_entry', read_entry):
+            for chunk in stream:
+                if chunk is zeros:
+                    output.seek(len(chunk), os.SEEK_CUR)
+                else:
+                    output.write(chunk)
+            self.assertEqual(output.tell(), stream.length)
+
+            with zipfile.ZipFile(output) as archive:
+                large, small = archive.infolist()
+                self.assertEqual(large.file_size, size)
+                self.assertGreater(small.header_offset, archives.ZIP64_LIMIT)
+                self.assertEqual(archive.read('a.txt'), b'alpha')
+
+    def test_zip64_entry_count(self):
+        path = os.path.join(self.root, 'empty')
+        count = archives.ZIP_COUNT_LIMIT + 1
+        stream = ZipStream([ArchiveEntry(f'{i}.txt', path, 0, 0.0) for i in range(count)])
+        data = b''.join(stream)
+        self.assertEqual(len(data), stream.length)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = archive.namelist()
+        self.assertEqual(len(names), count)
+        self.assertEqual(names[-1], f'{count - 1}.txt')
+
+
+class FilePageTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        now = time.time()
+        # Repeated sizes, times and resolutions, so that ties have to be broken by id
+        for i, (size, age) in enumerate([(30, 5), (10, 1), (30, 3), (20, 5), (10, 2), (40, 4), (20, 1)]):
+            self.write(f'{"sub/" if i % 2 else ""}file{i}.txt', size, now - age * 60)
+        self.directory.refresh()
+        for i, file in enumerate(self.directory.files.order_by('id')):
+            File.objects.filter(id=file.id).update(width=i % 3 * 10, height=10)
+
+    def expected(self, sort: str, descending: bool, path: str = ''):
+        files = list(views.get_indexed_files(self.directory, path).annotate(sort_key=views.SORT_KEYS[sort]))
+        files.sort(key=lambda file: (file.sort_key, file.id), reverse=descending)
+        return [file.id for file in files]
+
+    def page_through(self, sort: str, descending: bool, path: str = ''):
+        ids, cursor = [], None
+        while True:
+            page, cursor = views.get_file_page(self.directory, sort, descending, cursor, limit=2, path=path)
+            self.assertLessEqual(len(page), 2)
+            ids.extend(file.id for file in page)
+            if cursor is None:
+                return ids
+
+    def test_every_order_pages_through_every_file_once(self):
+        for sort in views.SORT_KEYS:
+            for descending in (False, True):
+                with self.subTest(sort=sort, descending=descending):
+                    ids = self.page_through(sort, descending)
+                    self.assertEqual(len(ids), 7)
+                    self.assertEqual(ids, self.expected(sort, descending))
+
+    def test_subdirectory(self):
+        ids = self.page_through('name', False, 'sub')
+        self.assertEqual(ids, self.expected('name', False, 'sub'))
+        self.assertEqual(len(ids), 3)
+
+    def test_last_page_has_no_cursor(self):
+        page, cursor = views.get_file_page(self.directory, 'name', False, limit=7)
+        self.assertEqual(len(page), 7)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            views.get_file_page(self.directory, 'size', False, 'not a cursor')
+
+
+class SearchTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        now = time.time()
+        self.write('holiday/beach.jpg', 3000, now)
+        self.write('holiday/sunset.jpg', 500, now - 10 * 86400)
+        self.write('work/beach-report.txt', 100, now)
+        self.write('clips/beach.mp4', 2 * 1024 ** 2, now - 10 * 86400)
+        self.directory.refresh()
+        File.objects.filter(filename='beach.jpg').update(width=1920, height=1080)
+        File.objects.filter(filename='sunset.jpg').update(width=640, height=480)
+
+    def search(self, **params):
+        files, _ = search.search_files(params)
+        return sorted(file.relative_path for file in files)
+
+    def test_terms(self):
+        self.assertEqual(self.search(q='beach'),
+                         ['clips/beach.mp4', 'holiday/beach.jpg', 'work/beach-report.txt'])
+        self.assertEqual(self.search(q='beach holiday'), ['holiday/beach.jpg'])
+        # Shorter than a trigram, matched by scanning instead
+        self.assertEqual(self.search(q='.m'), ['clips/beach.mp4'])
+
+    def test_filters(self):
+        self.assertEqual(self.search(q='beach', mediatype='image'), ['holiday/beach.jpg'])
+        self.assertEqual(self.search(size_min='1k', size_max='1m'), ['holiday/beach.jpg'])
+        self.assertEqual(self.search(size_min='1.5 MB'), ['clips/beach.mp4'])
+        self.assertEqual(self.search(resolution_min='1280x720'), ['holiday/beach.jpg'])
+        self.assertEqual(self.search(resolution_max='800x600'), ['holiday/sunset.jpg'])
+
+        week_ago = (timezone.localdate() - timedelta(days=7)).isoformat()
+        self.assertEqual(self.search(q='jpg', modified_after=week_ago), ['holiday/beach.jpg'])
+        self.assertEqual(self.search(q='jpg', modified_before=week_ago), ['holiday/sunset.jpg'])
+
+    def test_invalid_filters(self):
+        for params in ({'size_min': 'big'}, {'resolution_min': '1080p'}, {'modified_after': 'yesterday'}):
+            with self.subTest(params=params), self.assertRaises(ValueError):
+                search.search_files(params)
+
+    def test_pages(self):
+        ids, cursor = [], None
+        while True:
+            page, cursor = search.search_files({'q': 'beach'}, cursor, limit=1)
+            ids.extend(file.id for file in page)
+            if cursor is None:
+                break
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(ids), 3)
+
+    def test_renamed_files_are_reindexed(self):
+        file = File.objects.get(filename='sunset.jpg')
+        File.objects.filter(id=file.id).update(path=os.path.join(self.root, 'holiday/dusk.jpg'))
+        self.assertEqual(self.search(q='sunset'), [])
+        self.assertEqual(self.search(q='dusk'), ['holiday/sunset.jpg'])
+
+
+class RefreshLeaseTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('a.txt', 1)
+
+    def set_lease(self, seconds: float, requested: int = ServedDirectory.NOT_REQUESTED) -> None:
+        ServedDirectory.objects.filter(id=self.directory.id).update(
+            refreshLeaseExpires=timezone.now() + timedelta(seconds=seconds), refresh_requested=requested)
+
+    def get_state(self):
+        return ServedDirectory.objects.values_list('refreshLeaseExpires', 'refresh_requested') \
+            .get(id=self.directory.id)
+
+    def test_refresh_releases_its_lease(self):
+        result = self.directory.refresh()
+        self.assertEqual(result.added, 1)
+        self.assertFalse(result.coalesced)
+        self.assertEqual(self.get_state(), (None, ServedDirectory.NOT_REQUESTED))
+
+    def test_running_refresh_is_coalesced_into(self):
+        self.set_lease(60)
+        result = self.directory.refresh()
+        self.assertTrue(result.coalesced)
+        self.assertEqual(self.directory.files.count(), 0)
+        self.assertEqual(self.get_state()[1], ServedDirectory.REQUESTED)
+
+        # A full refresh takes precedence over an incremental one, and is never downgraded
+        self.directory.refresh(full=True)
+        self.directory.refresh()
+        self.assertEqual(self.get_state()[1], ServedDirectory.FULL_REQUESTED)
+
+    def test_expired_lease_is_taken_over(self):
+        self.set_lease(-1, ServedDirectory.REQUESTED)
+        result = self.directory.refresh()
+        self.assertFalse(result.coalesced)
+        self.assertEqual(result.added, 1)
+        self.assertEqual(self.get_state(), (None, ServedDirectory.NOT_REQUESTED))
+
+    def test_refresh_requested_while_running_is_performed(self):
+        calls = []
+
+        def scan(directory, full=False):
+            calls.append(full)
+            if len(calls) == 1:
+                # Another refresh asks for a full scan while this one is running
+                self.assertTrue(ServedDirectory.objects.get(id=directory.id).refresh(full=True).coalesced)
+            return RefreshResult()
+
+        with mock.patch.object(ServedDirectory, 'scan', autospec=True, side_effect=scan):
+            result = self.directory.refresh()
+        self.assertEqual(calls, [False, True])
+        self.assertFalse(result.coalesced)
+        self.assertEqual(self.get_state(), (None, ServedDirectory.NOT_REQUESTED))
+
+    def test_lease_is_renewed_while_scanning(self):
+        self.write('sub/b.txt')
+        renewed = []
+        with self.settings(REFRESH_LEASE_TIMEOUT=0), mock.patch.object(
+                ServedDirectory, 'renew_lease', autospec=True, side_effect=lambda directory: renewed.append(
+                    self.get_state()[0])):
+            self.directory.refresh()
+        # Once before each of the two directories, while the lease is held
+        self.assertEqual(len(renewed), 2)
+        self.assertNotIn(None, renewed)
+
+    def test_renew_lease(self):
+        self.set_lease(60)
+        self.directory.renew_lease()
+        self.assertGreater(self.get_state()[0], timezone.now() + timedelta(seconds=3000))
+
+        # A released lease is not taken again
+        ServedDirectory.objects.filter(id=self.directory.id).update(refreshLeaseExpires=None)
+        self.directory.renew_lease()
+        self.assertIsNone(self.get_state()[0])
+
+    def test_failed_refresh_releases_its_lease(self):
+        with mock.patch.object(ServedDirectory, 'scan', side_effect=OSError('unreadable')):
+            with self.assertRaises(OSError):
+                self.directory.refresh()
+        self.assertIsNone(self.get_state()[0])
+
+    def test_deleted_directory_raises(self):
+        ServedDirectory.objects.filter(id=self.directory.id).delete()
+        with self.assertRaises(ServedDirectory.DoesNotExist):
+            self.directory.refresh()
+
+    def test_directory_deleted_while_refreshing(self):
+        def scan(directory, full=False):
+            ServedDirectory.objects.filter(id=directory.id).delete()
+            return RefreshResult()
+
+        with mock.patch.object(ServedDirectory, 'scan', autospec=True, side_effect=scan):
+            result = self.directory.refresh()
+        self.assertFalse(result.coalesced)
+
+
+class ApplyChangesTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('a.txt', 1)
+        self.write('b.txt', 2)
+        self.write('dir/c.txt', 3)
+        self.directory.refresh()
+        self.ids = dict(self.directory.files.values_list('relative_path', 'id'))
+
+    def get_files(self):
+        return dict(self.directory.files.values_list('relative_path', 'id'))
+
+    def test_changes(self):
+        self.write('new.txt', 4)
+        self.write('b.txt', 5)
+        os.remove(os.path.join(self.root, 'a.txt'))
+        result = self.directory.apply_changes(['new.txt', 'b.txt', 'a.txt', 'missing.txt'])
+        self.assertEqual((result.added, result.updated, result.removed), (1, 1, 1))
+        self.assertEqual(set(self.get_files()), {'b.txt', 'dir/c.txt', 'new.txt'})
+        self.assertEqual(self.directory.files.get(relative_path='b.txt').size, 5)
+
+    def test_move_keeps_the_row(self):
+        os.rename(os.path.join(self.root, 'a.txt'), os.path.join(self.root, 'd.txt'))
+        result = self.directory.apply_changes([], [('a.txt', 'd.txt')])
+        self.assertEqual(result.moved, 1)
+        self.assertEqual(self.get_files()['d.txt'], self.ids['a.txt'])
+        self.assertNotIn('a.txt', self.get_files())
+
+    def test_move_onto_an_existing_file(self):
+        os.replace(os.path.join(self.root, 'a.txt'), os.path.join(self.root, 'b.txt'))
+        result = self.directory.apply_changes([], [('a.txt', 'b.txt')])
+        self.assertEqual((result.moved, result.removed), (1, 1))
+        self.assertEqual(self.get_files(), {'b.txt': self.ids['a.txt'], 'dir/c.txt': self.ids['dir/c.txt']})
+        self.assertEqual(ServedDirectory.objects.get(id=self.directory.id).file_count, 2)
+
+    def test_directory_move(self):
+        os.rename(os.path.join(self.root, 'dir'), os.path.join(self.root, 'renamed'))
+        self.directory.apply_changes([], [('dir', 'renamed')])
+        self.assertEqual(self.get_files()['renamed/c.txt'], self.ids['dir/c.txt'])
+
+    def test_removed_directory(self):
+        shutil.rmtree(os.path.join(self.root, 'dir'))
+        result = self.directory.apply_changes(['dir'])
+        self.assertEqual(result.removed, 1)
+        self.assertEqual(set(self.get_files()), {'a.txt', 'b.txt'})
+
+
+class WatcherTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.root, 'dir'))
+        self.watcher = Watcher(Inotify(), debounce=0)
+        self.addCleanup(self.watcher.inotify.close)
+        self.watcher.watch(self.directory.id, self.root, recursive=True)
+
+    def take(self):
+        self.watcher.poll(1)
+        self.assertTrue(self.watcher.ready())
+        return self.watcher.take()[self.directory.id]
+
+    def test_changes(self):
+        self.write('a.txt')
+        self.write('dir/b.txt')
+        self.assertEqual(self.take().changed, {'a.txt', 'dir/b.txt'})
+
+    def test_moves_are_paired(self):
+        path = self.write('a.txt')
+        self.take()
+        os.rename(path, os.path.join(self.root, 'dir', 'a.txt'))
+        batch = self.take()
+        self.assertEqual(batch.moves, [('a.txt', 'dir/a.txt')])
+        self.assertEqual(batch.changed, set())
+
+    def test_new_directories_are_watched(self):
+        self.write('new/a.txt')
+        self.take()
+        self.write('new/b.txt')
+        self.assertIn('new/b.txt', self.take().changed)
+
+
+class AggregateTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('a.jpg', 10)
+        self.write('b.mp4', 20)
+        self.write('sub/c.txt', 30)
+
+    def get_stats(self):
+        return ServedDirectory.objects.values(*ServedDirectory.STAT_FIELDS).get(id=self.directory.id)
+
+    def assertCounted(self):
+        """The incrementally adjusted aggregates match a recount from the Files."""
+        stats = self.get_stats()
+        self.directory.update_stats()
+        self.assertEqual(stats, self.get_stats())
+
+    def test_refresh(self):
+        self.directory.refresh()
+        self.assertEqual(self.get_stats(), {'file_count': 3, 'total_size': 60, 'image_count': 1, 'video_count': 1,
+                                            'other_count': 1, 'thumbnail_count': 0})
+
+    def test_changes(self):
+        self.directory.refresh()
+        self.write('a.jpg', 15)
+        self.write('d.png', 5)
+        os.remove(os.path.join(self.root, 'b.mp4'))
+        self.directory.refresh()
+        self.assertCounted()
+        self.assertEqual(self.get_stats()['total_size'], 50)
+
+        os.rename(os.path.join(self.root, 'd.png'), os.path.join(self.root, 'd.txt'))
+        self.directory.apply_changes([], [('d.png', 'd.txt')])
+        self.assertCounted()
+        self.assertEqual(self.get_stats()['other_count'], 2)
+
+    def test_file_indexed_during_a_refresh_is_counted_once(self):
+        apply_probes, raced = ServedDirectory.apply_probes, []
+
+        def race(files, stats, result):
+            # The watcher indexes one of the new files before the refresh writes them
+            if not raced:
+                raced.append(True)
+                ServedDirectory.objects.get(id=self.directory.id).apply_changes(['a.jpg'])
+            apply_probes(files, stats, result)
+
+        with mock.patch.object(ServedDirectory, 'apply_probes', side_effect=race):
+            result = self.directory.refresh()
+        self.assertEqual(result.added, 2)
+        self.assertEqual(self.get_stats()['file_count'], 3)
+        self.assertCounted()
+
+
+class RemoveTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(50):
+            self.write(f'sub{i % 5}/photo{i}.jpg', i)
+        self.directory.refresh()
+        self.thumbnail = Thumbnail.objects.create(key='a' * 64)
+        self.directory.files.filter(filename='photo0.jpg').update(thumbnail=self.thumbnail)
+        # Another directory serving part of the same files is left alone
+        self.other = ServedDirectory.objects.create(path=os.path.join(self.root, 'sub0'))
+        self.other.refresh()
+
+    def test_remove(self):
+        with metrics.measure() as measurement:
+            cleanup = self.directory.remove()
+        self.assertLess(measurement.queries, 20)
+        self.assertFalse(ServedDirectory.objects.filter(id=self.directory.id).exists())
+        self.assertEqual(File.objects.count(), 10)
+        self.assertEqual(set(File.objects.values_list('directory', flat=True)), {self.other.id})
+        self.assertEqual(ThumbnailJob.objects.count(), 10)
+        self.assertEqual((cleanup.keys, cleanup.total, cleanup.finished), ([self.thumbnail.key], 1, None))
+
+        # The search index no longer holds the removed Files
+        files, _ = search.search_files({'q': 'photo'})
+        self.assertEqual({file.directory_id for file in files}, {self.other.id})
+
+
+class BulkRefreshTests(DirectoryTestCase):
+
+    def refresh(self, count: int):
+        """Writes `count` more files and refreshes, returning the number of queries made."""
+        start = self.directory.files.count()
+        for i in range(start, start + count):
+            self.write(f'file{i}.txt', i)
+        with metrics.measure() as measurement:
+            self.assertEqual(self.directory.refresh(full=True).added, count)
+        return measurement.queries
+
+    def test_queries_do_not_grow_with_files(self):
+        self.refresh(5)
+        # Only the inserts are batched by SQLite's limit on query parameters
+        self.assertLessEqual(self.refresh(100), self.refresh(10) + 2)
+
+    def test_changes(self):
+        self.refresh(3)
+        self.write('file0.txt', 50)
+        os.remove(os.path.join(self.root, 'file1.txt'))
+        result = self.directory.refresh(full=True)
+        self.assertEqual((result.added, result.updated, result.removed, result.unchanged), (0, 1, 1, 1))
+        self.assertEqual(dict(self.directory.files.values_list('relative_path', 'size')),
+                         {'file0.txt': 50, 'file2.txt': 2})
+
+
+class ScanTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write('top.txt', 1)
+        self.write('a/middle.txt', 2)
+        self.write('a/b/bottom.txt', 3)
+
+    def touch_in_place(self, relative_path: str, size: int) -> None:
+        """Overwrites a file without changing its directory's modification time, as editing it in place would."""
+        directory = os.path.dirname(os.path.join(self.root, relative_path))
+        mtime = os.stat(directory).st_mtime_ns
+        self.write(relative_path, size, time.time() + 10)
+        os.utime(directory, ns=(mtime, mtime))
+
+    def test_recursive(self):
+        result = self.directory.refresh()
+        self.assertEqual(result.added, 3)
+        self.assertEqual(set(self.directory.files.values_list('relative_path', flat=True)),
+                         {'top.txt', 'a/middle.txt', 'a/b/bottom.txt'})
+        self.assertEqual(set(self.directory.indexed_directories.values_list('relative_path', flat=True)),
+                         {'', 'a', 'a/b'})
+
+    def test_not_recursive(self):
+        directory = ServedDirectory.objects.create(path=self.root, recursive=False)
+        self.assertEqual(directory.refresh().added, 1)
+        self.assertEqual(list(directory.files.values_list('relative_path', flat=True)), ['top.txt'])
+        self.assertEqual(directory.known_subdirectories, [os.path.join(self.root, 'a')])
+
+    def test_unchanged_directories_are_pruned(self):
+        self.directory.refresh()
+        result = self.directory.refresh()
+        self.assertEqual((result.pruned, result.unchanged, result.added), (3, 3, 0))
+
+        self.write('a/b/new.txt', 4)
+        result = self.directory.refresh()
+        self.assertEqual((result.pruned, result.unchanged, result.added), (2, 3, 1))
+
+    def test_removed_directory(self):
+        self.directory.refresh()
+        shutil.rmtree(os.path.join(self.root, 'a', 'b'))
+        result = self.directory.refresh()
+        self.assertEqual(result.removed, 1)
+        self.assertEqual(set(self.directory.indexed_directories.values_list('relative_path', flat=True)), {'', 'a'})
+
+    def test_full_refresh_sees_files_edited_in_place(self):
+        self.directory.refresh()
+        self.touch_in_place('a/middle.txt', 20)
+        self.assertEqual(self.directory.refresh().updated, 0)
+
+        result = self.directory.refresh(full=True)
+        self.assertEqual((result.updated, result.pruned), (1, 0))
+        self.assertEqual(self.directory.files.get(relative_path='a/middle.txt').size, 20)
+
+    def test_changed_options_scan_in_full(self):
+        self.directory.refresh()
+        self.touch_in_place('top.txt', 10)
+        self.directory.extensions = 'txt'
+        self.directory.save()
+        self.assertEqual(self.directory.refresh().updated, 1)
+
+
+class FileFilterTests(SimpleTestCase):
+
+    def test_everything_matches_by_default(self):
+        self.assertTrue(helpers.FileFilter().matches('a.txt', '/root/a.txt'))
+
+    def test_extensions(self):
+        file_filter = helpers.FileFilter(extensions=['jpg', '.PNG', ''])
+        self.assertTrue(file_filter.matches('a.JPG', '/root/a.JPG'))
+        self.assertTrue(file_filter.matches('a.png', '/root/a.png'))
+        self.assertFalse(file_filter.matches('a.txt', '/root/a.txt'))
+        self.assertFalse(file_filter.matches('jpg', '/root/jpg'))
+
+    def test_patterns(self):
+        file_filter = helpers.FileFilter(include=['^IMG', 'holiday', ''], exclude=['_thumb'])
+        self.assertTrue(file_filter.matches('IMG_1.jpg', '/root/IMG_1.jpg'))
+        self.assertTrue(file_filter.matches('holiday.jpg', '/root/holiday.jpg'))
+        self.assertFalse(file_filter.matches('IMG_1_thumb.jpg', '/root/IMG_1_thumb.jpg'))
+        self.assertFalse(file_filter.matches('DSC_1.jpg', '/root/holiday/DSC_1.jpg'))
+
+    def test_full_path(self):
+        file_filter = helpers.FileFilter(include=['holiday/'], match_filename=False)
+        self.assertTrue(file_filter.matches('DSC_1.jpg', '/root/holiday/DSC_1.jpg'))
+        self.assertFalse(file_filter.matches('holiday.jpg', '/root/holiday.jpg'))
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(re.error):
+            helpers.FileFilter(include=['('])
+
+
+class FilteredScanTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for relative_path in ('a.jpg', 'b.txt', 'sub/c.jpg', 'sub/skip.jpg'):
+            self.write(relative_path)
+
+    def get_paths(self):
+        return set(self.directory.files.values_list('relative_path', flat=True))
+
+    def test_filtered_files_are_not_indexed(self):
+        self.directory.extensions = 'jpg'
+        self.directory.regex, self.directory.exclude_pattern = True, 'skip'
+        self.directory.save()
+        result = self.directory.refresh()
+        self.assertEqual((result.added, result.filtered), (2, 2))
+        self.assertEqual(self.get_paths(), {'a.jpg', 'sub/c.jpg'})
+
+    def test_files_no_longer_matching_are_removed(self):
+        self.directory.refresh()
+        self.directory.extensions = 'txt'
+        self.directory.save()
+        result = self.directory.refresh()
+        self.assertEqual((result.removed, result.pruned), (3, 0))
+        self.assertEqual(self.get_paths(), {'b.txt'})
+
+
+class RefreshViewTests(DirectoryTestCase):
+
+    def test_files_edited_in_place_are_picked_up(self):
+        mtime = time.time() - 60
+        path = self.write('sub/a.txt', 1, mtime)
+        self.directory.refresh()
+        # Overwriting a file leaves its directory's modification time alone
+        directory_mtime = os.stat(os.path.dirname(path)).st_mtime_ns
+        self.write('sub/a.txt', 5, mtime + 10)
+        os.utime(os.path.dirname(path), ns=(directory_mtime, directory_mtime))
+
+        response = self.client.get(reverse('refresh', args=(self.directory.id,)))
+        self.assertRedirects(response, reverse('browse', args=(self.directory.id,)), fetch_redirect_response=False)
+        self.assertEqual(self.directory.files.get().size, 5)
+
+
+class ProbeCacheTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cached = self.write('cached.jpg', 10)
+        self.write('unknown.jpg', 20)
+        self.key = helpers.file_identity(os.stat(self.cached))
+        MediaProbe.record(self.key, helpers.MediaInfo(640, 480))
+
+    def test_refresh_uses_cached_probes(self):
+        result = self.directory.refresh()
+        self.assertEqual((result.probe_hits, result.probe_misses), (1, 1))
+        self.assertEqual(self.directory.files.get(filename='cached.jpg').resolution, '640 x 480')
+        self.assertIsNone(self.directory.files.get(filename='unknown.jpg').resolution)
+
+    def test_existing_thumbnail_is_adopted(self):
+        Thumbnail.objects.create(key=self.key, width=128, height=96)
+        self.directory.refresh()
+        file = self.directory.files.get(filename='cached.jpg')
+        self.assertEqual((file.thumbnail_id, file.thumbnail_width), (self.key, 128))
+        # Only the file without a thumbnail is queued
+        self.assertEqual(list(ThumbnailJob.objects.values_list('file__filename', flat=True)), ['unknown.jpg'])
+
+    def test_modified_file_is_probed_again(self):
+        self.write('cached.jpg', 11)
+        self.assertEqual(self.directory.refresh().probe_hits, 0)
+
+    def test_lookup_marks_stale_probes_used(self):
+        long_ago = timezone.now() - timedelta(days=30)
+        MediaProbe.objects.update(lastUsed=long_ago)
+        self.assertEqual(set(MediaProbe.lookup([self.key, 'missing'])), {self.key})
+        self.assertGreater(MediaProbe.objects.get().lastUsed, long_ago)
+
+    def test_prune(self):
+        MediaProbe.objects.update(lastUsed=timezone.now() - timedelta(days=30))
+        self.assertEqual(MediaProbe.prune(timedelta(days=60)), 0)
+        self.assertEqual(MediaProbe.prune(timedelta(days=7)), 1)
+        self.assertFalse(MediaProbe.objects.exists())
+
+
+class ListingCacheTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.write('a.txt')
+        self.write('sub/b.txt')
+        self.directory.refresh()
+
+    def list(self, directory: ServedDirectory = None, path: str = ''):
+        directory = directory or self.directory
+        response = self.client.get(reverse('files', args=(directory.id,)), {'path': path} if path else {})
+        return sorted(file['path'] for file in response.json()['files'])
+
+    def test_listing_is_cached_until_the_directory_changes(self):
+        self.assertEqual(self.list(), ['a.txt', 'sub/b.txt'])
+        # Written behind the directory's back, so the cached listing is still served
+        File.objects.filter(relative_path='a.txt').update(relative_path='hidden.txt')
+        self.assertEqual(self.list(), ['a.txt', 'sub/b.txt'])
+
+        # The refresh also puts the renamed row right again
+        self.write('c.txt')
+        self.directory.refresh()
+        self.assertEqual(self.list(), ['a.txt', 'c.txt', 'sub/b.txt'])
+
+    def test_watcher_changes_invalidate(self):
+        self.assertEqual(self.list(path='sub'), ['sub/b.txt'])
+        self.write('sub/c.txt')
+        self.directory.apply_changes(['sub/c.txt'])
+        self.assertEqual(self.list(path='sub'), ['sub/b.txt', 'sub/c.txt'])
+
+    def test_mark_changed_invalidates(self):
+        self.assertEqual(self.list(), ['a.txt', 'sub/b.txt'])
+        File.objects.filter(relative_path='a.txt').delete()
+        ServedDirectory.mark_changed(self.directory.id)
+        self.assertEqual(self.list(), ['sub/b.txt'])
+
+    def test_scanned_subdirectory_is_cached_until_it_changes(self):
+        directory = ServedDirectory.objects.create(path=self.root, recursive=False)
+        directory.refresh()
+        path = self.write('sub/c.txt', 1, time.time() - 60)
+        self.assertEqual(self.list(directory, 'sub'), ['sub/b.txt', 'sub/c.txt'])
+
+        # Edited in place, which the cached scan does not notice
+        mtime = os.stat(os.path.dirname(path)).st_mtime_ns
+        self.write('sub/c.txt', 5)
+        os.utime(os.path.dirname(path), ns=(mtime, mtime))
+        response = self.client.get(reverse('files', args=(directory.id,)), {'path': 'sub'})
+        self.assertEqual([file['size'] for file in response.json()['files'] if file['path'] == 'sub/c.txt'], [1])
+
+        os.remove(path)
+        self.assertEqual(self.list(directory, 'sub'), ['sub/b.txt'])
+
+    def test_index_lists_new_directories(self):
+        self.assertNotContains(self.client.get(reverse('index')), 'elsewhere')
+        ServedDirectory.objects.create(path=os.path.join(self.root, 'elsewhere'))
+        self.assertContains(self.client.get(reverse('index')), 'elsewhere')
+
+
+class ThumbnailTestCase(DirectoryTestCase):
+    """Keeps the thumbnails generated by each test in a temporary directory of their own."""
+
+    def setUp(self):
+        super().setUp()
+        thumbnails = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, thumbnails)
+        patcher = mock.patch('viewer.models.THUMBNAILS_DIR', thumbnails)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_image(self, relative_path: str, size=(800, 600), color=(200, 40, 40)) -> str:
+        path = self.write(relative_path)
+        Image.new('RGB', size, color).save(path)
+        return path
+
+    def write_video(self, relative_path: str, size=(320, 240), frames: int = 30) -> str:
+        path = self.write(relative_path)
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, size)
+        for i in range(frames):
+            writer.write(numpy.full((size[1], size[0], 3), i * 8, numpy.uint8))
+        writer.release()
+        return path
+
+    def run_worker(self) -> str:
+        output = io.StringIO()
+        call_command('thumbnail_worker', once=True, processes=1, stdout=output)
+        return output.getvalue()
+
+
+class ThumbnailJobTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            self.write(f'photo{i}.jpg')
+        self.directory.refresh()
+        self.file_ids = list(self.directory.files.values_list('id', flat=True))
+
+    def test_refresh_queues_media(self):
+        self.assertEqual(ThumbnailJob.status_counts(self.directory),
+                         {ThumbnailJob.QUEUED: 3, ThumbnailJob.RUNNING: 0, ThumbnailJob.DONE: 0,
+                          ThumbnailJob.FAILED: 0})
+        # Queued jobs are left alone
+        ThumbnailJob.enqueue(self.file_ids)
+        self.assertEqual(ThumbnailJob.objects.count(), 3)
+
+    def test_claim_leases_jobs(self):
+        jobs = ThumbnailJob.claim(2)
+        self.assertEqual(len(jobs), 2)
+        self.assertTrue(all(job.status == ThumbnailJob.RUNNING and job.leaseExpires > timezone.now()
+                            for job in jobs))
+        self.assertEqual(len(ThumbnailJob.claim(5)), 1)
+        self.assertEqual(ThumbnailJob.claim(5), [])
+
+    def test_only_expired_leases_are_released(self):
+        live, dead = ThumbnailJob.claim(2)
+        ThumbnailJob.objects.filter(id=dead.id).update(leaseExpires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(ThumbnailJob.release_expired(), 1)
+        self.assertEqual(ThumbnailJob.objects.get(id=live.id).status, ThumbnailJob.RUNNING)
+        self.assertEqual(ThumbnailJob.objects.get(id=dead.id).status, ThumbnailJob.QUEUED)
+
+    def test_renew(self):
+        job, *_ = ThumbnailJob.claim(1)
+        ThumbnailJob.objects.filter(id=job.id).update(leaseExpires=timezone.now() + timedelta(seconds=1))
+        ThumbnailJob.renew([job.id])
+        self.assertEqual(ThumbnailJob.release_expired(), 0)
+        self.assertGreater(ThumbnailJob.objects.get(id=job.id).leaseExpires, timezone.now() + timedelta(seconds=60))
+
+    def test_failures_back_off_then_give_up(self):
+        job, *_ = ThumbnailJob.claim(1)
+        job.fail('unreadable')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.leaseExpires), (ThumbnailJob.QUEUED, 1, None))
+        self.assertGreater(job.available, timezone.now())
+        self.assertNotIn(job.id, [claimed.id for claimed in ThumbnailJob.claim(5)])
+
+        for _ in range(job.attempts, settings.THUMBNAIL_MAX_ATTEMPTS):
+            job.fail('unreadable')
+        self.assertEqual(ThumbnailJob.objects.get(id=job.id).status, ThumbnailJob.FAILED)
+
+        # Permanently failed jobs are only retried when asked for
+        ThumbnailJob.enqueue([job.file_id])
+        self.assertEqual(ThumbnailJob.objects.get(id=job.id).status, ThumbnailJob.QUEUED)
+
+
+class ThumbnailWorkerTests(ThumbnailTestCase):
+
+    def test_worker_drains_the_queue(self):
+        self.write_image('a.jpg', (800, 600))
+        self.write_image('b.png', (100, 200), (0, 0, 255))
+        missing = self.write_image('missing.jpg')
+        self.directory.refresh()
+        os.remove(missing)
+
+        with self.assertLogs('viewer.management.commands.thumbnail_worker', 'WARNING'):
+            output = self.run_worker()
+        self.assertIn('Generated 2 thumbnails', output)
+        self.assertIn('1 failed', output)
+
+        a, b = self.directory.files.get(filename='a.jpg'), self.directory.files.get(filename='b.png')
+        self.assertEqual((a.width, a.height, a.thumbnail_width, a.thumbnail_height), (800, 600, 300, 225))
+        self.assertEqual((b.width, b.height, b.thumbnail_width, b.thumbnail_height), (100, 200, 100, 200))
+        self.assertTrue(os.path.exists(a.thumbnail.path))
+        self.assertEqual(MediaProbe.objects.count(), 2)
+
+        counts = ThumbnailJob.status_counts(self.directory)
+        self.assertEqual((counts[ThumbnailJob.DONE], counts[ThumbnailJob.QUEUED]), (2, 1))
+        self.assertEqual(ThumbnailJob.objects.get(file__filename='missing.jpg').attempts, 1)
+        self.assertEqual(ServedDirectory.objects.get(id=self.directory.id).thumbnail_count, 2)
+
+    def test_interrupted_jobs_are_picked_up(self):
+        self.write_image('a.jpg')
+        self.directory.refresh()
+        ThumbnailJob.objects.update(status=ThumbnailJob.RUNNING, leaseExpires=timezone.now() - timedelta(seconds=1))
+        self.assertIn('Returned 1 interrupted jobs', self.run_worker())
+        self.assertIsNotNone(self.directory.files.get().thumbnail_id)
+
+
+class ThumbnailStoreTests(ThumbnailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write_image('a.jpg')
+        self.write_image('sub/b.jpg', color=(0, 200, 0))
+        # The same files served again from a second directory
+        self.other = ServedDirectory.objects.create(path=os.path.join(self.root, 'sub'))
+        self.directory.refresh()
+        self.other.refresh()
+        self.run_worker()
+
+    def get_stats(self, directory: ServedDirectory) -> int:
+        return ServedDirectory.objects.get(id=directory.id).thumbnail_count
+
+    def test_files_with_the_same_identity_share_a_thumbnail(self):
+        self.assertEqual(Thumbnail.objects.count(), 2)
+        keys = set(File.objects.filter(filename='b.jpg').values_list('thumbnail', flat=True))
+        self.assertEqual(len(keys), 1)
+        self.assertEqual((self.get_stats(self.directory), self.get_stats(self.other)), (2, 1))
+
+    def test_existing_thumbnails_are_reused(self):
+        ThumbnailJob.objects.update(status=ThumbnailJob.QUEUED)
+        self.assertIn('(3 shared with existing thumbnails)', self.run_worker())
+
+    def test_thumbnails_are_only_released_once_unused(self):
+        b = Thumbnail.objects.get(files__filename='b.jpg', files__directory=self.other)
+        self.other.remove().run()
+        self.assertTrue(os.path.exists(b.path))
+
+        os.remove(os.path.join(self.root, 'sub', 'b.jpg'))
+        self.directory.refresh()
+        self.assertFalse(Thumbnail.objects.filter(key=b.key).exists())
+        self.assertEqual([path for path in Thumbnail.variants_for(b.key) if os.path.exists(path)], [])
+        self.assertEqual(self.get_stats(self.directory), 1)
+
+    def test_least_recently_used_are_evicted(self):
+        old = Thumbnail.objects.get(files__filename='a.jpg')
+        Thumbnail.objects.filter(key=old.key).update(lastUsed=timezone.now() - timedelta(days=1))
+        total = sum(Thumbnail.objects.values_list('size', flat=True))
+        self.assertEqual(Thumbnail.evict(total), 0)
+
+        self.assertEqual(Thumbnail.evict(total - 1), old.size)
+        self.assertFalse(Thumbnail.objects.filter(key=old.key).exists())
+        self.assertEqual(Thumbnail.objects.count(), 1)
+        self.assertFalse(os.path.exists(old.path))
+        self.assertIsNone(self.directory.files.get(filename='a.jpg').thumbnail_id)
+        self.assertEqual(self.get_stats(self.directory), 1)
+
+        # Evicted thumbnails are queued again on the next refresh
+        self.directory.refresh()
+        self.assertEqual(ThumbnailJob.objects.get(file__filename='a.jpg').status, ThumbnailJob.QUEUED)
+
+
+class ThumbnailVariantTests(ThumbnailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image = self.write_image('a.jpg', (1600, 1200))
+        self.write_video('b.avi')
+        self.directory.refresh()
+        self.run_worker()
+        self.thumbnail = Thumbnail.objects.get(files__filename='a.jpg')
+
+    def get_image(self, key: str, **params) -> Image.Image:
+        headers = {'HTTP_ACCEPT': params.pop('accept')} if 'accept' in params else {}
+        response = self.client.get(reverse('thumbnail', args=(key,)), params, **headers)
+        self.assertEqual(response.status_code, 200)
+        return Image.open(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_eager_variants(self):
+        self.assertTrue(os.path.exists(Thumbnail.path_for(self.thumbnail.key)))
+        self.assertTrue(os.path.exists(Thumbnail.path_for(self.thumbnail.key, 'medium', 'webp')))
+        self.assertFalse(os.path.exists(Thumbnail.path_for(self.thumbnail.key, 'small', 'jpeg')))
+
+    def test_smaller_variants_are_resized_on_demand(self):
+        path = self.thumbnail.get_variant('small', 'jpeg')
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (150, 113))
+        self.assertGreater(Thumbnail.objects.get(key=self.thumbnail.key).size, self.thumbnail.size)
+
+    def test_larger_variants_are_decoded_from_the_source(self):
+        with Image.open(self.thumbnail.get_variant('large', 'jpeg')) as image:
+            self.assertEqual(image.size, (600, 450))
+
+        # A changed source no longer has the thumbnail's identity
+        self.write_image('a.jpg', (1600, 1200), (0, 0, 0))
+        with self.assertRaises(FileNotFoundError):
+            self.thumbnail.get_variant('large', 'webp')
+
+    def test_format_is_negotiated(self):
+        self.assertEqual(self.get_image(self.thumbnail.key).format, 'JPEG')
+        self.assertEqual(self.get_image(self.thumbnail.key, accept='image/webp,*/*').format, 'WEBP')
+        self.assertEqual(self.get_image(self.thumbnail.key, accept='image/webp', format='jpeg').format, 'JPEG')
+        image = self.get_image(self.thumbnail.key, size='small', format='webp')
+        self.assertEqual((image.format, image.size), ('WEBP', (150, 113)))
+        # Unknown sizes fall back on the default
+        self.assertEqual(self.get_image(self.thumbnail.key, size='huge').size, (300, 225))
+
+    def test_video_sprite(self):
+        video = self.directory.files.get(filename='b.avi')
+        self.assertEqual(video.resolution, '320 x 240')
+        self.assertEqual(video.thumbnail.sprite_frames, settings.THUMBNAIL_SPRITE_FRAMES)
+        sprite = self.client.get(video.thumbnail.sprite_url)
+        self.assertEqual(sprite.status_code, 200)
+        with Image.open(io.BytesIO(b''.join(sprite.streaming_content))) as image:
+            self.assertEqual(image.height, 112)
+
+        # Images have no hover preview
+        self.assertIsNone(self.thumbnail.sprite_url)
+        self.assertEqual(self.client.get(reverse('thumbnail_sprite', args=(self.thumbnail.key,))).status_code, 404)
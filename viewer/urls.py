@@ -6,10 +6,20 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('add/', views.add, name='add'),
     path('add/submit', views.submit_new, name='add_submit'),
+    path('metrics', views.export_metrics, name='metrics'),
+    path('search/', views.search, name='search'),
+    path('search/files', views.search_results, name='search_results'),
+    path('cleanups/<int:cleanup_id>', views.cleanup_status, name='cleanup_status'),
+    path('thumbnails/<str:key>/', views.thumbnail, name='thumbnail'),
+    path('thumbnails/<str:key>/sprite', views.thumbnail_sprite, name='thumbnail_sprite'),
     path('<uuid:directory_id>/', views.browse, name='browse'),
+    path('<uuid:directory_id>/files', views.files, name='files'),
+    path('<uuid:directory_id>/tree', views.tree, name='tree'),
+    path('<uuid:directory_id>/download', views.download, name='download'),
     path('<uuid:directory_id>/refresh', views.refresh, name='refresh'),
+    path('<uuid:directory_id>/thumbnails', views.thumbnail_status, name='thumbnail_status'),
     path('<uuid:directory_id>/delete/', views.delete, name='delete'),
     path('<uuid:directory_id>/delete/confirm', views.confirm_delete, name='confirm_delete'),
-    path('<uuid:directory_id>/<str:file>/', views.file, name='file'),
-    path('<uuid:directory_id>/<str:file>/generate', views.generate_thumb, name='generate_thumb')
+    path('<uuid:directory_id>/<path:file>/generate', views.generate_thumb, name='generate_thumb'),
+    path('<uuid:directory_id>/<path:file>/', views.file, name='file')
 ]
@@ -1,28 +1,278 @@
+import base64
+import hashlib
+import json
 import os
+import posixpath
+import re
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
 
-from django.http import FileResponse, HttpResponseRedirect
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max, Q, QuerySet
+from django.db.models.functions import Coalesce, Substr
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_datetime
 
-from viewer.models import ServedDirectory
+from viewer import archives, helpers, metrics, serving
+from viewer.models import File, ServedDirectory, Thumbnail, ThumbnailCleanup, ThumbnailJob
+from viewer.search import search_files
+
+# Expressions each listing can be sorted by, none of which can be NULL so that they are usable as keyset cursors.
+# Every File is stat-ed before it is first saved, so the modification time is always set and can be read from its index.
+SORT_KEYS = {
+    'name': F('relative_path'),
+    'size': Coalesce('size', 0),
+    'mtime': F('fileLastModified'),
+    'resolution': Coalesce(F('width') * F('height'), 0),
+}
+
+# The same orders for files scanned on demand, whose resolution is not known until they are indexed
+SCANNED_SORT_KEYS = {
+    'name': lambda file: file.relative_path,
+    'size': lambda file: (file.size or 0, file.relative_path),
+    'mtime': lambda file: (file.fileLastModified, file.relative_path),
+    'resolution': lambda file: file.relative_path,
+}
+
+
+def cached_listing(key: str, build: Callable[[], dict]) -> dict:
+    """
+    Retrieves a rendered listing from the cache, building and caching it if missing.
+
+    Keys hold the lastModified of whatever is listed, which every change to a directory's listing bumps (see
+    `ServedDirectory.mark_changed`), even when made by another process, so entries never need to be deleted and
+    outdated ones simply expire.
+    """
+    listing = cache.get(key)
+    metrics.increment('listing_cache_lookups', result='miss' if listing is None else 'hit')
+    if listing is None:
+        listing = build()
+        cache.set(key, listing, settings.LISTING_CACHE_TIMEOUT)
+    return listing
+
+
+def get_listing_key(directory: ServedDirectory, *parts) -> str:
+    """The cache key of a page of a directory's listing, given whatever else (sorting, cursor) decides its content."""
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+    return f'listing:{directory.id}:{directory.lastModified.timestamp()}:{digest}'
+
+
+def get_scan(directory: ServedDirectory, path: str) -> dict:
+    """
+    Scans a subdirectory on demand (see `ServedDirectory.scan_subdirectory`), cached until its modification time
+    changes. Files are only listed for subdirectories that are not indexed.
+
+    Files changed in place do not change the time of the directory holding them, and so are only picked up once the
+    cached scan expires.
+
+    :return: The names of the child `directories`, the `files` found and the `version` of the scan.
+    :raises OSError: If the subdirectory could not be read.
+    """
+    mtime = os.stat(os.path.join(directory.path, path)).st_mtime_ns
+    files = not directory.indexes(path)
+    digest = hashlib.sha1(path.encode()).hexdigest()
+
+    def build() -> dict:
+        directories, found = directory.scan_subdirectory(path, files)
+        return {'directories': directories, 'files': found, 'version': mtime}
+
+    return cached_listing(f'scan:{directory.id}:{digest}:{mtime}:{directory.get_scan_options()}:{files}', build)
+
+
+def get_subdirectories(directory: ServedDirectory, path: str) -> List[Dict[str, str]]:
+    """
+    The children of a subdirectory, each with its name, path relative to the directory and browse URL. Those of the
+    directory itself are known from its last refresh, the rest are scanned as they are browsed into.
+    """
+    if path:
+        names = get_scan(directory, path)['directories']
+    else:
+        names = sorted((os.path.basename(child) for child in directory.known_subdirectories or []), key=str.lower)
+    browse_url = reverse('browse', args=(directory.id,))
+    children = []
+    for name in names:
+        child = posixpath.join(path, name)
+        children.append({'name': name, 'path': child, 'url': f'{browse_url}?{urlencode({"path": child})}',
+                         'absolute_path': os.path.join(directory.path, child)})
+    return children
+
+
+def get_subdirectory(params, directory: ServedDirectory) -> str:
+    """
+    Reads the subdirectory requested by the `path` parameter, normalized relative to the directory, or '' for the
+    directory itself.
+
+    :raises Http404: If the subdirectory is outside of the directory or does not exist.
+    """
+    path = params.get('path', '')
+    if not path.strip('/'):
+        return ''
+    absolute = directory.resolve_directory(path)
+    if absolute is None:
+        raise Http404('No such subdirectory')
+    path = os.path.relpath(absolute, directory.path).replace(os.sep, '/')
+    return '' if path == '.' else path
 
 
 def index(request):
     """Index view for the simple-viewer project."""
-    directories = ServedDirectory.objects.all()
+    # Any directory added, removed or changed moves either the count or the most recent modification
+    state = ServedDirectory.objects.aggregate(count=Count('id'), last=Max('lastModified'))
+    key = f'index:{state["count"]}:{state["last"].timestamp() if state["last"] else 0}'
+    listing = cached_listing(key, lambda: {'html': render_to_string('directory_list.html', {
+        'directories': ServedDirectory.objects.all()
+    })})
     context = {'title': 'Index',
-               'directories': directories}
+               'directory_list': listing['html'],
+               'cleanups': ThumbnailCleanup.objects.filter(finished__isnull=True).order_by('initialCreation')}
     return render(request, 'index.html', context)
 
 
+def get_sorting(request) -> Tuple[str, bool]:
+    """Reads the sort key and direction requested for a file listing, falling back to sorting by name."""
+    sort = request.GET.get('sort')
+    if sort not in SORT_KEYS:
+        sort = 'name'
+    return sort, request.GET.get('order') == 'desc'
+
+
+def get_indexed_files(directory: ServedDirectory, path: str = '') -> QuerySet:
+    """The Files of a directory at or below one of its subdirectories, or all of them for ''."""
+    files = directory.files.all()
+    if path:
+        prefix = f'{path}/'
+        # Compared exactly rather than with startswith, as LIKE ignores case on SQLite
+        files = files.annotate(path_prefix=Substr('relative_path', 1, len(prefix))).filter(path_prefix=prefix)
+    return files
+
+
+def get_file_page(directory: ServedDirectory, sort: str, descending: bool, cursor: Optional[str] = None,
+                  limit: int = settings.BROWSE_PAGE_SIZE, path: str = '') -> Tuple[List[File], Optional[str]]:
+    """
+    Retrieves a single page of a directory's files using keyset pagination, so that deep pages are as cheap as the
+    first. The thumbnail is joined in the same query.
+
+    :param cursor: An opaque cursor returned alongside the previous page, or None for the first page.
+    :param path: Only list the files at or below this subdirectory.
+    :return: The files on this page and the cursor for the next page, or None if this was the last page.
+    :raises ValueError: If the cursor could not be decoded.
+    """
+    files = get_indexed_files(directory, path).select_related('thumbnail').annotate(sort_key=SORT_KEYS[sort])
+    lookup = 'lt' if descending else 'gt'
+
+    if cursor:
+        try:
+            value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid cursor') from e
+        if sort == 'mtime':
+            value = parse_datetime(value)
+        files = files.filter(Q(**{f'sort_key__{lookup}': value}) | Q(sort_key=value, **{f'id__{lookup}': last_id}))
+
+    prefix = '-' if descending else ''
+    page = list(files.order_by(f'{prefix}sort_key', f'{prefix}id')[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+
+    page = page[:limit]
+    value = page[-1].sort_key
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return page, base64.urlsafe_b64encode(json.dumps([value, page[-1].id]).encode()).decode()
+
+
+def get_scanned_page(files: List[File], sort: str, descending: bool, cursor: Optional[str] = None,
+                     limit: int = settings.BROWSE_PAGE_SIZE) -> Tuple[List[File], Optional[str]]:
+    """
+    Retrieves a single page of files scanned on demand, sorted as `get_file_page` would. These have no ids to break
+    ties with, so the cursor simply holds an offset.
+
+    :raises ValueError: If the cursor could not be decoded.
+    """
+    offset = 0
+    if cursor:
+        try:
+            offset = int(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid cursor') from e
+
+    page = sorted(files, key=SCANNED_SORT_KEYS[sort], reverse=descending)[offset:offset + limit]
+    if offset + limit >= len(files):
+        return page, None
+    return page, base64.urlsafe_b64encode(json.dumps(offset + limit).encode()).decode()
+
+
+def get_listing_page(directory: ServedDirectory, path: str, sort: str, descending: bool,
+                     cursor: Optional[str] = None) -> Tuple[List[File], Optional[str]]:
+    """
+    Retrieves a page of the files in a subdirectory (or the directory itself for ''), from the database if indexed or
+    from a scan otherwise. Listings built from it must be keyed on `get_listing_version`.
+    """
+    if directory.indexes(path):
+        return get_file_page(directory, sort, descending, cursor, path=path)
+    return get_scanned_page(get_scan(directory, path)['files'], sort, descending, cursor)
+
+
+def get_listing_version(directory: ServedDirectory, path: str) -> Optional[int]:
+    """What the listing of a subdirectory depends on beyond the directory itself, the scan if it is not indexed."""
+    return None if directory.indexes(path) else get_scan(directory, path)['version']
+
+
 def browse(request, directory_id):
     directory = get_object_or_404(ServedDirectory, id=directory_id)
 
     if os.path.isdir(directory.path):
+        path = get_subdirectory(request.GET, directory)
+        sort, descending = get_sorting(request)
+
+        def build() -> dict:
+            files, cursor = get_listing_page(directory, path, sort, descending)
+            if not path:
+                count = directory.file_count
+            elif directory.indexes(path):
+                count = get_indexed_files(directory, path).count()
+            else:
+                count = len(get_scan(directory, path)['files'])
+            return {'html': render_to_string('file_list.html', {'files': files, 'directory': directory}),
+                    'next': cursor,
+                    'count': count,
+                    'thumbnails': [file.thumbnail_id for file in files if file.thumbnail_id]}
+
+        try:
+            listing = cached_listing(get_listing_key(directory, 'browse', path, get_listing_version(directory, path),
+                                                     sort, descending), build)
+            subdirectories = get_subdirectories(directory, path)
+        except OSError:
+            raise Http404('The subdirectory could not be read')
+        Thumbnail.touch(listing['thumbnails'])
+
+        # Links to every subdirectory from the top down to the one browsed, and up to its parent
+        browse_url = reverse('browse', args=(directory.id,))
+        parents, breadcrumbs, parent_url = '', [], reverse('index')
+        for name in path.split('/') if path else []:
+            parent_url = f'{browse_url}?{urlencode({"path": parents})}' if parents else browse_url
+            parents = posixpath.join(parents, name)
+            breadcrumbs.append({'name': name, 'url': f'{browse_url}?{urlencode({"path": parents})}'})
         context = {
             'title': f'Browse - {os.path.dirname(directory.path)}',
-            'files': directory.files.all(),
-            'directory': directory
+            'file_list': listing['html'],
+            'file_count': listing['count'],
+            'next_cursor': listing['next'],
+            'sort': sort,
+            'descending': descending,
+            'sort_keys': SORT_KEYS.keys(),
+            'directory': directory,
+            'path': path,
+            'path_query': f'&{urlencode({"path": path})}' if path else '',
+            'breadcrumbs': breadcrumbs,
+            'parent_url': parent_url,
+            'subdirectories': subdirectories,
         }
         return render(request, 'browse.html', context)
     else:
@@ -35,12 +285,81 @@ def browse(request, directory_id):
         return render(request, 'message.html', context, status=500)
 
 
+def files(request, directory_id):
+    """A JSON API view listing a page of a directory's files, used by the browse page to load more as it scrolls."""
+    directory = get_object_or_404(ServedDirectory, id=directory_id)
+    path = get_subdirectory(request.GET, directory)
+    sort, descending = get_sorting(request)
+    after = request.GET.get('after')
+
+    def build() -> dict:
+        page, cursor = get_listing_page(directory, path, sort, descending, after)
+        return {'files': [file.serialize() for file in page], 'next': cursor,
+                'thumbnails': [file.thumbnail_id for file in page if file.thumbnail_id]}
+
+    try:
+        listing = cached_listing(get_listing_key(directory, 'files', path, get_listing_version(directory, path),
+                                                 sort, descending, after), build)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except OSError:
+        raise Http404('The subdirectory could not be read')
+    Thumbnail.touch(listing['thumbnails'])
+    return JsonResponse({'files': listing['files'], 'next': listing['next']})
+
+
+def tree(request, directory_id):
+    """
+    A JSON API view listing the child directories of a subdirectory (given by `path`, the directory itself if empty),
+    used by the browse page to expand its directory tree one level at a time.
+    """
+    directory = get_object_or_404(ServedDirectory, id=directory_id)
+    path = get_subdirectory(request.GET, directory)
+    try:
+        return JsonResponse({'directories': get_subdirectories(directory, path)})
+    except OSError:
+        raise Http404('The subdirectory could not be read')
+
+
+def search(request):
+    """Searches the files of every served directory, see `search.search_files` for the parameters."""
+    context = {'title': 'Search',
+               'params': request.GET,
+               'mediatypes': ['image', 'video', 'file'],
+               'searched': any(value for key, value in request.GET.items() if key != 'after')}
+    if context['searched']:
+        try:
+            files, cursor = search_files(request.GET, request.GET.get('after'))
+        except ValueError as e:
+            return render(request, 'message.html', status=400,
+                          context={'title': 'Invalid Search', 'message': str(e)})
+        Thumbnail.touch(file.thumbnail_id for file in files)
+        context['files'] = files
+        if cursor:
+            params = request.GET.copy()
+            params['after'] = cursor
+            context['next_url'] = f'?{params.urlencode()}'
+    return render(request, 'search.html', context)
+
+
+def search_results(request):
+    """A JSON API view returning a page of search results, taking the same parameters as the search page."""
+    try:
+        page, cursor = search_files(request.GET, request.GET.get('after'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    Thumbnail.touch(file.thumbnail_id for file in page)
+    return JsonResponse({'files': [dict(file.serialize(), directory=file.directory_id, full_path=file.path)
+                                   for file in page],
+                         'next': cursor})
+
+
 def file(request, directory_id, file):
     directory = get_object_or_404(ServedDirectory, id=directory_id)
     if os.path.isdir(directory.path):
-        path = os.path.join(directory.path, file)
-        if os.path.exists(path):
-            return FileResponse(open(path, 'rb'))
+        path = directory.resolve(file)
+        if path is not None and os.path.isfile(path):
+            return serving.serve_file(request, path)
         else:
             context = {
                 'title': 'Invalid File',
@@ -56,6 +375,55 @@ def file(request, directory_id, file):
     return render(request, 'message.html', context, status=500)
 
 
+def download(request, directory_id):
+    """
+    Streams an archive of a directory's files, those picked by `files` (File ids, given any number of times) or else
+    every file at or below the subdirectory `path`. Archives are ZIPs unless `format` is 'tar', and the parameters can
+    also be sent as a form, for selections too large for a URL.
+    """
+    directory = get_object_or_404(ServedDirectory, id=directory_id)
+    params = request.POST if request.method == 'POST' else request.GET
+    stream = archives.FORMATS.get(params.get('format', 'zip'))
+    if stream is None:
+        return render(request, 'message.html', status=400,
+                      context={'title': 'Invalid Format',
+                               'message': f'Archives can be downloaded as {" or ".join(archives.FORMATS)}.'})
+
+    try:
+        ids = [int(file_id) for file_id in params.getlist('files')]
+    except ValueError:
+        return render(request, 'message.html', status=400,
+                      context={'title': 'Invalid Selection', 'message': 'The files selected were not valid.'})
+
+    if ids:
+        path = ''
+        files = []
+        for chunk in helpers.chunked(ids, 500):
+            files.extend(directory.files.filter(id__in=chunk).values_list('relative_path', 'path'))
+        files.sort()
+    else:
+        path = get_subdirectory(params, directory)
+        if directory.indexes(path):
+            files = list(get_indexed_files(directory, path).order_by('relative_path')
+                         .values_list('relative_path', 'path').iterator())
+        else:
+            try:
+                files = sorted((file.relative_path, file.path) for file in get_scan(directory, path)['files'])
+            except OSError:
+                raise Http404('The subdirectory could not be read')
+
+    # Entries are placed in a folder named after what was downloaded, relative to it
+    name = posixpath.basename(path) if path else os.path.basename(os.path.normpath(directory.path))
+    prefix = f'{path}/' if path else ''
+    archive = stream(archives.get_entries((posixpath.join(name, relative_path[len(prefix):]), absolute_path)
+                                          for relative_path, absolute_path in files))
+
+    response = StreamingHttpResponse(archive, content_type=archive.content_type)
+    response['Content-Length'] = archive.length
+    response['Content-Disposition'] = f'attachment; filename*=UTF-8\'\'{quote(f"{name}.{archive.extension}")}'
+    return response
+
+
 def add(request):
     context = {'title': 'Add New Directory',
                'content_column_size': 'is-half'}
@@ -65,9 +433,12 @@ def add(request):
 
 
 def refresh(request, directory_id):
-    """A simple API view for refreshing a directory. May schedule new thumbnail generation."""
+    """
+    A simple API view for refreshing a directory. May schedule new thumbnail generation.
+    Refreshes asked for by hand rescan every file, as files edited in place would otherwise go unnoticed.
+    """
     directory = get_object_or_404(ServedDirectory, id=directory_id)
-    directory.refresh()
+    directory.refresh(full=True)
     return HttpResponseRedirect(reverse('browse', args=(directory.id,)))
 
 
@@ -75,13 +446,16 @@ def submit_new(request):
     try:
         s = ServedDirectory(
             path=request.POST['path'],
-            regex_pattern=request.POST.get('regex'),
-            regex=request.POST.get('regex') is not None,
-            match_filename=request.POST.get('match_filename', False),
-            recursive=request.POST.get('recursive', False)
+            regex_pattern=request.POST.get('regex', '').strip(),
+            exclude_pattern=request.POST.get('exclude', '').strip(),
+            extensions=request.POST.get('extensions', '').strip(),
+            match_filename='match_filename' in request.POST,
+            recursive='recursive' in request.POST
         )
+        s.regex = bool(s.regex_pattern or s.exclude_pattern)
         if not os.path.isdir(request.POST['path']):
             raise ValueError('A invalid Directory was specified in the request.')
+        s.get_filter()
         s.save()
         s.refresh()
     except KeyError:
@@ -94,34 +468,107 @@ def submit_new(request):
                       context={'title': 'Invalid Directory',
                                'message': 'The directory you specified was not a valid directory, either it doesn\'t '
                                           'exist or it isn\'t a directory.'})
+    except re.error as e:
+        return render(request, 'message.html', status=400,
+                      context={'title': 'Invalid Pattern',
+                               'message': f'One of the RegEx patterns you specified could not be compiled: {e}'})
     return HttpResponseRedirect(reverse('browse', args=(s.id,)))
 
 
 def generate_thumb(request, directory_id, file: str):
-    """View for regenerating a thumbnail for a specific file."""
+    """View for regenerating a thumbnail for a specific file. The thumbnail is generated by the thumbnail worker."""
     directory = get_object_or_404(ServedDirectory, id=directory_id)
-    file = directory.files.filter(filename=file).first()
-    file.generate_thumbnail()
+    file = get_object_or_404(directory.files, relative_path=file)
+    file.queue_thumbnail()
     return HttpResponseRedirect(reverse('browse', args=(directory.id,)))
 
 
-def confirm_delete(request, directory_id):
+def get_thumbnail_format(request) -> str:
+    """
+    Picks the format to serve a thumbnail in, either as requested explicitly or the most preferred of
+    THUMBNAIL_FORMATS that the browser accepts.
+    """
+    available = [extension for extension in settings.THUMBNAIL_FORMATS if extension in helpers.supported_formats()]
+    requested = request.GET.get('format')
+    if requested in available:
+        return requested
+
+    accept = request.META.get('HTTP_ACCEPT', '')
+    for extension in available:
+        if f'image/{extension}' in accept:
+            return extension
+    return 'jpeg'
+
+
+def thumbnail(request, key):
+    """
+    Serves a thumbnail in the size given by the `size` parameter, producing that variant first if it is missing.
+    Thumbnails are named after the content they were generated from, so they can be cached indefinitely.
+    """
+    thumbnail = get_object_or_404(Thumbnail, key=key)
+    size = request.GET.get('size')
+    if size not in settings.THUMBNAIL_SIZES:
+        size = settings.THUMBNAIL_DEFAULT_SIZE
+
+    try:
+        path = thumbnail.get_variant(size, get_thumbnail_format(request))
+    except (OSError, ValueError):
+        # Fall back on the default thumbnail rather than showing nothing
+        path = thumbnail.path
+        if not os.path.exists(path):
+            raise Http404('Thumbnail is missing')
+    Thumbnail.touch([key])
+
+    response = serving.serve_file(request, path)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    if 'format' not in request.GET:
+        patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def thumbnail_sprite(request, key):
+    """Serves the hover preview sprite sheet of a video's thumbnail."""
+    thumbnail = get_object_or_404(Thumbnail, key=key, sprite_frames__gt=0)
+    path = Thumbnail.sprite_path_for(thumbnail.key)
+    if not os.path.exists(path):
+        raise Http404('Sprite sheet is missing')
+
+    response = serving.serve_file(request, path)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def thumbnail_status(request, directory_id):
+    """A simple API view reporting how many of a directory's thumbnail jobs are queued, running, done or failed."""
     directory = get_object_or_404(ServedDirectory, id=directory_id)
+    return JsonResponse(ThumbnailJob.status_counts(directory))
 
-    # Delete all the file thumbnail's, then files from db
-    for file in directory.files.all():
-        file.delete_thumbnail()
-        file.delete()
 
-    # Remove directory from db
-    directory.delete()
+def confirm_delete(request, directory_id):
+    directory = get_object_or_404(ServedDirectory, id=directory_id)
+
+    # The rows go at once, the thumbnails they used are removed in the background while the index shows the progress
+    directory.remove().start()
 
     return HttpResponseRedirect(reverse('index'))
 
 
+def export_metrics(request):
+    """Exposes the metrics recorded by this process in the Prometheus text format, if enabled."""
+    if not metrics.enabled():
+        raise Http404('Metrics are not enabled')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def cleanup_status(request, cleanup_id):
+    """A simple API view reporting the progress of removing a deleted directory's thumbnails."""
+    cleanup = get_object_or_404(ThumbnailCleanup, id=cleanup_id)
+    return JsonResponse(cleanup.serialize())
+
+
 def delete(request, directory_id):
     directory = get_object_or_404(ServedDirectory, id=directory_id)
     context = {'content_column_size': 'is-one-third',
-               'num_files': len(directory.files.all()),
+               'num_files': directory.file_count,
                'directory': directory}
     return render(request, 'delete.html', context=context)
@@ -0,0 +1,272 @@
+"""
+watcher.py
+
+Contains a minimal inotify binding and the bookkeeping needed to turn raw inotify events for every directory below the
+served directories into batches of changes, to be applied with `ServedDirectory.apply_changes`.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import posixpath
+import select
+import struct
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Written files are only reported once closed, so a large copy is not reported for every block written
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+             | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Event(NamedTuple):
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """
+    A thin wrapper around the Linux inotify API, called through ctypes so that no extra dependency is needed.
+
+    :raises OSError: If inotify is not available on this platform.
+    """
+
+    def __init__(self):
+        library = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(library, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        """
+        Watches a directory, returning its watch descriptor. Watching the same directory twice returns the same one.
+
+        :raises OSError: If the directory cannot be watched, e.g. once the watch limit is reached (ENOSPC).
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def remove_watch(self, wd: int) -> None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float) -> List[Event]:
+        """Waits up to `timeout` seconds for events, returning every event available."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append(Event(wd, mask, cookie, name))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Batch:
+    """The changes collected for a single ServedDirectory since its last batch was applied."""
+
+    def __init__(self):
+        self.changed: Set[str] = set()
+        self.moves: List[Tuple[str, str]] = []
+        self.overflow = False
+
+
+class Watcher:
+    """
+    Watches every directory below a set of served directories, collecting events into a Batch per directory.
+
+    The same directory may be served more than once (or lie inside another served directory), in which case its single
+    watch reports to every ServedDirectory containing it. Moves are paired up by their cookie, and are only treated as
+    moves when both ends lie inside the same ServedDirectory. Batches are flushed once no events have arrived for
+    `debounce` seconds, or at the latest `max_delay` seconds after the first event, so bursts are applied together.
+    """
+
+    def __init__(self, inotify: Inotify, debounce: float = 1.0, max_delay: float = 10.0):
+        self.inotify = inotify
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        # Each watch descriptor's directory, relative to every ServedDirectory it was watched for
+        self.watches: Dict[int, Set[Tuple[uuid.UUID, str]]] = defaultdict(set)
+        self.descriptors: Dict[Tuple[uuid.UUID, str], int] = {}
+        self.roots: Dict[uuid.UUID, Tuple[str, bool]] = {}
+
+        self.batches: Dict[uuid.UUID, Batch] = defaultdict(Batch)
+        # Halves of moves waiting for their other half, keyed by cookie
+        self.moved_from: Dict[int, List[Tuple[uuid.UUID, str]]] = {}
+        self.first_event: Optional[float] = None
+        self.last_event: Optional[float] = None
+
+    def watch(self, directory_id: uuid.UUID, path: str, recursive: bool) -> None:
+        """
+        Starts watching a ServedDirectory, and every directory below it when matching recursively.
+
+        :raises OSError: If any directory could not be watched, after removing the watches already added.
+        """
+        self.roots[directory_id] = path, recursive
+        try:
+            self.watch_tree(directory_id, '')
+        except OSError:
+            self.unwatch(directory_id)
+            raise
+
+    def watch_tree(self, directory_id: uuid.UUID, relative_dir: str) -> None:
+        """Adds watches for a directory below a ServedDirectory, and those below it when matching recursively."""
+        root, recursive = self.roots[directory_id]
+        stack = [relative_dir]
+        while stack:
+            current = stack.pop()
+            absolute_dir = os.path.join(root, current)
+            try:
+                wd = self.inotify.add_watch(absolute_dir)
+            except FileNotFoundError:
+                continue
+            self.watches[wd].add((directory_id, current))
+            self.descriptors[directory_id, current] = wd
+
+            if recursive:
+                try:
+                    with os.scandir(absolute_dir) as entries:
+                        stack.extend(posixpath.join(current, entry.name) if current else entry.name
+                                     for entry in entries if entry.is_dir(follow_symlinks=False))
+                except FileNotFoundError:
+                    pass
+
+    def unwatch(self, directory_id: uuid.UUID, relative_dir: Optional[str] = None) -> None:
+        """Stops watching a ServedDirectory, or only a directory below it and everything under that directory."""
+        for key in [key for key in self.descriptors if key[0] == directory_id and (
+                relative_dir is None or key[1] == relative_dir or key[1].startswith(relative_dir + '/'))]:
+            wd = self.descriptors.pop(key)
+            self.watches[wd].discard(key)
+            if not self.watches[wd]:
+                del self.watches[wd]
+                self.inotify.remove_watch(wd)
+        if relative_dir is None:
+            self.roots.pop(directory_id, None)
+            self.batches.pop(directory_id, None)
+
+    def rename_watches(self, directory_id: uuid.UUID, source: str, destination: str) -> None:
+        """Follows a directory moved within a ServedDirectory, as its watches stay attached to the moved directories."""
+        prefix = source + '/'
+        for key in [key for key in self.descriptors
+                    if key[0] == directory_id and (key[1] == source or key[1].startswith(prefix))]:
+            wd = self.descriptors.pop(key)
+            renamed = directory_id, destination + key[1][len(source):]
+            self.watches[wd].discard(key)
+            self.watches[wd].add(renamed)
+            self.descriptors[renamed] = wd
+
+    def poll(self, timeout: float) -> None:
+        """Waits up to `timeout` seconds for events, adding them to the pending batches."""
+        events = self.inotify.read(timeout)
+        if not events:
+            return
+
+        now = time.monotonic()
+        self.first_event = self.first_event or now
+        self.last_event = now
+        for event in events:
+            self.handle(event)
+
+    def handle(self, event: Event) -> None:
+        if event.mask & IN_Q_OVERFLOW:
+            # Events were lost, every directory has to be rescanned
+            for directory_id in self.roots:
+                self.batches[directory_id].overflow = True
+            return
+
+        is_dir = event.mask & IN_ISDIR
+        # Where the other half of a move came from, for each ServedDirectory it was seen in
+        sources = dict(self.moved_from.pop(event.cookie, ())) if event.mask & IN_MOVED_TO else {}
+
+        for directory_id, relative_dir in list(self.watches.get(event.wd, ())):
+            relative_path = posixpath.join(relative_dir, event.name) if relative_dir else event.name
+            batch = self.batches[directory_id]
+
+            if event.mask & IN_IGNORED:
+                # The watch was removed by the kernel, as its directory was deleted
+                self.descriptors.pop((directory_id, relative_dir), None)
+                self.watches.pop(event.wd, None)
+            elif event.mask & IN_DELETE_SELF:
+                batch.changed.add(relative_dir)
+            elif event.mask & IN_MOVED_FROM:
+                self.moved_from.setdefault(event.cookie, []).append((directory_id, relative_path))
+                batch.changed.add(relative_path)
+            elif event.mask & IN_MOVED_TO:
+                source = sources.pop(directory_id, None)
+                if source is not None:
+                    batch.changed.discard(source)
+                    batch.moves.append((source, relative_path))
+                    if is_dir:
+                        self.rename_watches(directory_id, source, relative_path)
+                else:
+                    batch.changed.add(relative_path)
+                    if is_dir and self.roots[directory_id][1]:
+                        self.watch_tree(directory_id, relative_path)
+            else:
+                batch.changed.add(relative_path)
+                if is_dir and event.mask & IN_CREATE and self.roots[directory_id][1]:
+                    self.watch_tree(directory_id, relative_path)
+
+        # Directories moved out of a ServedDirectory are gone from its point of view
+        if is_dir:
+            for directory_id, relative_path in sources.items():
+                self.unwatch(directory_id, relative_path)
+
+    def ready(self) -> bool:
+        """Whether the pending batches should be applied now."""
+        if self.first_event is None:
+            return False
+        now = time.monotonic()
+        return now - self.last_event >= self.debounce or now - self.first_event >= self.max_delay
+
+    def take(self) -> Dict[uuid.UUID, Batch]:
+        """Returns every pending batch, starting new ones."""
+        # Moves without a second half left the served directories entirely, stop watching anything moved away
+        for sources in self.moved_from.values():
+            for directory_id, relative_path in sources:
+                self.unwatch(directory_id, relative_path)
+        self.moved_from.clear()
+
+        batches, self.batches = self.batches, defaultdict(Batch)
+        self.first_event = self.last_event = None
+        return {directory_id: batch for directory_id, batch in batches.items() if directory_id in self.roots}